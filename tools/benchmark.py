@@ -0,0 +1,540 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks for tuning_box hot paths.
+
+Run as:
+
+    python tools/benchmark.py <benchmark> [options]
+
+By default every benchmark uses a fresh in-memory SQLite database, pass
+--database-url to run it against something else.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # 2.x
+
+import sqlalchemy.event
+import sqlalchemy.exc
+
+from tuning_box import app as tb_app
+from tuning_box import db
+from tuning_box import jsoncodec
+
+
+@contextlib.contextmanager
+def app_context(database_url, concurrent=False):
+    app = tb_app.build_app()
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    with app.app_context():
+        if db.db.engine.dialect.name == 'sqlite':
+            db.fix_sqlite(immediate=concurrent)
+        db.db.create_all()
+        yield app
+
+
+@contextlib.contextmanager
+def count_round_trips():
+    counter = [0]
+
+    def before_cursor_execute(*args):
+        counter[0] += 1
+
+    engine = db.db.engine
+    sqlalchemy.event.listen(
+        engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        sqlalchemy.event.remove(
+            engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def create_environment(depth):
+    levels = []
+    level = None
+    for i in range(depth):
+        level = db.EnvironmentHierarchyLevel(name='lvl%d' % (i,),
+                                             parent=level)
+        levels.append(level)
+    environment = db.Environment(hierarchy_levels=levels)
+    db.db.session.add(environment)
+    db.db.session.commit()
+    return environment
+
+
+def bench_resolve(args):
+    """Round trips and time needed to resolve level path of each depth"""
+    with app_context(args.database_url):
+        environment = create_environment(args.depth)
+        levels = [('lvl%d' % (i,), str(i)) for i in range(args.depth)]
+        tb_app.get_environment_level_value(environment, levels)
+        db.db.session.commit()
+        print('depth  round trips  ms/resolve')
+        for depth in range(args.depth + 1):
+            with count_round_trips() as round_trips:
+                start = time.time()
+                for _ in range(args.repeat):
+                    tb_app.get_environment_level_value(environment,
+                                                       levels[:depth])
+                elapsed = time.time() - start
+            print('%5d  %11d  %10.3f' % (
+                depth,
+                round_trips[0] // args.repeat,
+                elapsed * 1000 / args.repeat,
+            ))
+
+
+def make_document(size):
+    """Build settings-like document of about size bytes of JSON"""
+    document = {}
+    i = 0
+    while len(json.dumps(document)) < size:
+        document['section%d' % (i,)] = {
+            'enabled': i % 2 == 0,
+            'timeout': i * 10,
+            'ratio': i / 7.0,
+            'name': 'service-%d.example.com' % (i,),
+            'hosts': ['10.0.%d.%d' % (i % 256, j) for j in range(8)],
+            'options': {'opt%d' % (j,): 'value%d' % (j,) for j in range(8)},
+        }
+        i += 1
+    return document
+
+
+def bench_codec(args):
+    """Encoding and decoding time of stored JSON with each codec"""
+    document = make_document(args.size * 1024)
+    print('backend   compress  stored KB  ms/dumps  ms/loads')
+    for backend in sorted(jsoncodec.BACKENDS):
+        for threshold in (0, 1):
+            codec = jsoncodec.JsonCodec(backend, compress_threshold=threshold)
+            start = time.time()
+            for _ in range(args.repeat):
+                data = codec.dumps(document)
+            dumps_time = time.time() - start
+            start = time.time()
+            for _ in range(args.repeat):
+                codec.loads(data)
+            loads_time = time.time() - start
+            print('%-8s  %8s  %9.1f  %8.3f  %8.3f' % (
+                backend,
+                'yes' if threshold else 'no',
+                len(data) / 1024.0,
+                dumps_time * 1000 / args.repeat,
+                loads_time * 1000 / args.repeat,
+            ))
+
+
+def _write_values(app, environment_id, resdef_id, level_paths, repeat,
+                  errors):
+    with app.app_context():
+        env_levels = db.EnvironmentHierarchyLevel.get_for_environment(
+            db.Environment.query.get(environment_id))
+        for i in range(repeat):
+            try:
+                ids = db.EnvironmentHierarchyLevelValue.get_or_create_ids(
+                    env_levels, level_paths)
+                db.ResourceValues.set_values(environment_id, [
+                    (resdef_id, ids[levels], {'key': i})
+                    for levels in level_paths])
+                db.db.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                db.db.session.rollback()
+                errors.append(i)
+        db.db.session.remove()
+
+
+def bench_upsert(args):
+    """Concurrent writers of the same level values and resource values"""
+    tmpdir = None
+    if args.database_url == 'sqlite:///':
+        # in-memory database can't be shared between threads
+        tmpdir = tempfile.mkdtemp()
+    native = db.supports_upsert
+    try:
+        print('mode      writers  writes/s  integrity errors')
+        for mode in ('native', 'fallback'):
+            db.supports_upsert = native if mode == 'native' else (
+                lambda: False)
+            database_url = args.database_url
+            if tmpdir is not None:
+                database_url = 'sqlite:///%s?timeout=60' % (
+                    os.path.join(tmpdir, mode + '.db'),)
+            with app_context(database_url, concurrent=True) as app:
+                environment = create_environment(args.depth)
+                component = db.Component(name='bench_%s' % (mode,))
+                resdef = db.ResourceDefinition(name='res',
+                                               component=component)
+                db.db.session.add(resdef)
+                db.db.session.commit()
+                level_paths = [
+                    tuple(('lvl%d' % (d,), str(i)) for d in range(depth))
+                    for i in range(args.paths)
+                    for depth in range(args.depth + 1)]
+                ids = (environment.id, resdef.id)
+                db.db.session.remove()  # don't hold locks while writers run
+                errors = []
+                threads = [threading.Thread(target=_write_values, args=(
+                    (app,) + ids + (level_paths, args.repeat, errors)))
+                    for _ in range(args.writers)]
+                start = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.time() - start
+                print('%-8s  %7d  %8.1f  %16d' % (
+                    mode,
+                    args.writers,
+                    args.writers * args.repeat * len(level_paths) / elapsed,
+                    len(errors),
+                ))
+                db.db.drop_all()
+    finally:
+        db.supports_upsert = native
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+def write_import_file(f, rows, resources, depth):
+    """Write NDJSON export of environment with rows values rows"""
+    resdef_names = ['resdef%d' % (i,) for i in range(resources)]
+    level_names = ['lvl%d' % (i,) for i in range(depth)]
+    f.write(json.dumps({
+        'type': 'component',
+        'name': 'bench',
+        'resource_definitions': [{'name': name, 'content': {}}
+                                 for name in resdef_names],
+    }) + '\n')
+    f.write(json.dumps({
+        'type': 'environment',
+        'components': ['bench'],
+        'hierarchy_levels': level_names,
+    }) + '\n')
+    for i in range(rows // resources):
+        # spread paths over all levels, 100 children per level value
+        levels = [[name, str(i // 100 ** (depth - d - 1) % 100)]
+                  for d, name in enumerate(level_names)]
+        for name in resdef_names:
+            f.write(json.dumps({
+                'type': 'values',
+                'levels': levels,
+                'resource': name,
+                'values': {'key': i, 'name': 'value-%d' % (i,)},
+            }) + '\n')
+
+
+def bench_import(args):
+    """Time and memory needed to import environment from NDJSON"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'export.ndjson')
+        with open(filename, 'w') as f:
+            write_import_file(f, args.rows, args.resources, args.depth)
+        database_url = args.database_url
+        if database_url == 'sqlite:///':
+            # a file like in real deployments, not memory
+            database_url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        with app_context(database_url):
+            importer = tb_app.EnvironmentImporter(args.chunk_size)
+            with count_round_trips() as round_trips:
+                start = time.time()
+                with open(filename, 'rb') as f:
+                    importer.run(tb_app.iter_import_records(f))
+                elapsed = time.time() - start
+            db.db.session.remove()
+            db.db.drop_all()
+        # ru_maxrss is in kilobytes on Linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('rows      chunk  round trips  seconds  rows/s   max RSS MB')
+        print('%-8d  %5d  %11d  %7.1f  %7.0f  %10.1f' % (
+            args.rows - args.rows % args.resources,
+            args.chunk_size,
+            round_trips[0],
+            elapsed,
+            args.rows / elapsed,
+            max_rss / 1024.0,
+        ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_clone(args):
+    """Time needed to clone environment with all its values"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'export.ndjson')
+        with open(filename, 'w') as f:
+            write_import_file(f, args.rows, args.resources, args.depth)
+        database_url = args.database_url
+        if database_url == 'sqlite:///':
+            database_url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        with app_context(database_url):
+            with open(filename, 'rb') as f:
+                environment = tb_app.EnvironmentImporter(1000).run(
+                    tb_app.iter_import_records(f))
+            with count_round_trips() as round_trips:
+                start = time.time()
+                db.clone_environment(environment)
+                db.db.session.commit()
+                elapsed = time.time() - start
+            db.db.session.remove()
+            db.db.drop_all()
+        print('rows      round trips  seconds  rows/s')
+        print('%-8d  %11d  %7.1f  %7.0f' % (
+            args.rows, round_trips[0], elapsed, args.rows / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_delete(args):
+    """Time and memory needed to delete environment with all its values"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'export.ndjson')
+        with open(filename, 'w') as f:
+            write_import_file(f, args.rows, args.resources, args.depth)
+        database_url = args.database_url
+        if database_url == 'sqlite:///':
+            database_url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        with app_context(database_url):
+            with open(filename, 'rb') as f:
+                environment_id = tb_app.EnvironmentImporter(1000).run(
+                    tb_app.iter_import_records(f)).id
+            db.db.session.remove()
+            if tracemalloc is not None:
+                tracemalloc.start()
+            with count_round_trips() as round_trips:
+                start = time.time()
+                db.delete_environment(environment_id)
+                db.db.session.commit()
+                elapsed = time.time() - start
+            peak = 0
+            if tracemalloc is not None:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            remaining = db.ResourceValues.query.count()
+            db.db.session.remove()
+            db.db.drop_all()
+        print('rows      round trips  seconds  peak Python MB  rows left')
+        print('%-8d  %11d  %7.1f  %14.1f  %9d' % (
+            args.rows, round_trips[0], elapsed, peak / 1024.0 / 1024.0,
+            remaining))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_fanout(args):
+    """Values of every node in a rack: one GET per node vs wildcard GET"""
+    with app_context(args.database_url) as app:
+        app.config['VALUES_CACHE_SIZE'] = 0
+        environment = create_environment(2)
+        component = db.Component(name='bench')
+        db.db.session.add(db.ResourceDefinition(name='res', content={},
+                                                component=component))
+        environment.components.append(component)
+        db.db.session.commit()
+        url = '/environments/%d/%sresources/res/values'
+        client = app.test_client()
+        document = make_document(args.size * 1024)
+        for path in ['', 'lvl0/1/']:
+            client.put(url % (environment.id, path),
+                       data=json.dumps(document),
+                       content_type='application/json')
+        client.put('/environments/%d/values/batch' % (environment.id,),
+                   data=json.dumps([{
+                       'levels': [['lvl0', '1'], ['lvl1', str(i)]],
+                       'resource': 'res',
+                       'values': {'node': i},
+                   } for i in range(args.nodes)]),
+                   content_type='application/json')
+        print('mode      nodes  round trips  seconds')
+        with count_round_trips() as round_trips:
+            start = time.time()
+            for i in range(args.nodes):
+                client.get(url % (environment.id, 'lvl0/1/lvl1/%d/' % (i,)))
+            elapsed = time.time() - start
+        print('%-8s  %5d  %11d  %7.2f' % (
+            'per node', args.nodes, round_trips[0], elapsed))
+        with count_round_trips() as round_trips:
+            start = time.time()
+            client.get(url % (environment.id, 'lvl0/1/lvl1/*/')).data
+            elapsed = time.time() - start
+        print('%-8s  %5d  %11d  %7.2f' % (
+            'wildcard', args.nodes, round_trips[0], elapsed))
+
+
+def bench_overrides(args):
+    """Levels overriding a key: decoding all values vs reverse index"""
+    with app_context(args.database_url) as app:
+        environment = create_environment(2)
+        component = db.Component(name='bench')
+        db.db.session.add(db.ResourceDefinition(name='res', content={},
+                                                component=component))
+        environment.components.append(component)
+        db.db.session.commit()
+        client = app.test_client()
+        document = make_document(args.size * 1024)
+        entries = []
+        for i in range(args.nodes):
+            values = dict(document, node={'id': i})
+            if i % 100 == 0:
+                values['override'] = {'key': i}
+            entries.append({
+                'levels': [['lvl0', '1'], ['lvl1', str(i)]],
+                'resource': 'res',
+                'values': values,
+            })
+        for start in range(0, args.nodes, 1000):
+            client.put('/environments/%d/values/batch' % (environment.id,),
+                       data=json.dumps(entries[start:start + 1000]),
+                       content_type='application/json')
+        print('mode      nodes  found  seconds')
+        start = time.time()
+        found = 0
+        for values, in db.db.session.query(db.ResourceValues.values).filter(
+                db.ResourceValues.environment_id == environment.id):
+            found += 'key' in values.get('override', {})
+        print('%-8s  %5d  %5d  %7.3f' % (
+            'decode', args.nodes, found, time.time() - start))
+        start = time.time()
+        res = client.get('/environments/%d/resources/res/overrides'
+                         '?key=override.key' % (environment.id,))
+        print('%-8s  %5d  %5d  %7.3f' % (
+            'index', args.nodes, len(json.loads(res.data.decode('utf-8'))),
+            time.time() - start))
+
+
+def bench_keys(args):
+    """Reading a few keys of large values: whole, projected, key storage"""
+    print('mode       size KB  seconds/GET')
+    for mode in ('whole', 'projected', 'storage'):
+        with app_context(args.database_url) as app:
+            app.config['VALUES_CACHE_SIZE'] = 0
+            app.config['VALUES_KEY_STORAGE'] = mode == 'storage'
+            environment = create_environment(args.depth)
+            component = db.Component(name='bench')
+            db.db.session.add(db.ResourceDefinition(name='res', content={},
+                                                    component=component))
+            environment.components.append(component)
+            db.db.session.commit()
+            client = app.test_client()
+            document = make_document(args.size * 1024)
+            paths = [''.join('lvl%d/1/' % (j,) for j in range(i))
+                     for i in range(args.depth + 1)]
+            for path in paths:
+                client.put('/environments/%d/%sresources/res/values' % (
+                    environment.id, path), data=json.dumps(document),
+                    content_type='application/json')
+            url = '/environments/%d/%sresources/res/values' % (
+                environment.id, paths[-1])
+            if mode != 'whole':
+                url += '?keys=section1.timeout,section2'
+            start = time.time()
+            for _ in range(args.repeat):
+                assert client.get(url).status_code == 200
+            elapsed = time.time() - start
+            db.db.session.remove()
+            db.db.drop_all()
+        print('%-9s  %7d  %11.4f' % (mode, args.size,
+                                     elapsed / args.repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='sqlite:///')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parser_resolve = subparsers.add_parser(
+        'resolve', help=bench_resolve.__doc__)
+    parser_resolve.add_argument('--depth', type=int, default=6)
+    parser_resolve.add_argument('--repeat', type=int, default=100)
+    parser_resolve.set_defaults(func=bench_resolve)
+
+    parser_codec = subparsers.add_parser('codec', help=bench_codec.__doc__)
+    parser_codec.add_argument('--size', type=int, default=256,
+                              help='document size in KB')
+    parser_codec.add_argument('--repeat', type=int, default=20)
+    parser_codec.set_defaults(func=bench_codec)
+
+    parser_upsert = subparsers.add_parser('upsert',
+                                          help=bench_upsert.__doc__)
+    parser_upsert.add_argument('--writers', type=int, default=8)
+    parser_upsert.add_argument('--depth', type=int, default=3)
+    parser_upsert.add_argument('--paths', type=int, default=10,
+                               help='level paths of each depth to write')
+    parser_upsert.add_argument('--repeat', type=int, default=20)
+    parser_upsert.set_defaults(func=bench_upsert)
+
+    parser_import = subparsers.add_parser('import',
+                                          help=bench_import.__doc__)
+    parser_import.add_argument('--rows', type=int, default=1000000)
+    parser_import.add_argument('--resources', type=int, default=10)
+    parser_import.add_argument('--depth', type=int, default=3)
+    parser_import.add_argument('--chunk-size', type=int, default=1000)
+    parser_import.set_defaults(func=bench_import)
+
+    parser_clone = subparsers.add_parser('clone', help=bench_clone.__doc__)
+    parser_clone.add_argument('--rows', type=int, default=100000)
+    parser_clone.add_argument('--resources', type=int, default=10)
+    parser_clone.add_argument('--depth', type=int, default=3)
+    parser_clone.set_defaults(func=bench_clone)
+
+    parser_delete = subparsers.add_parser('delete',
+                                          help=bench_delete.__doc__)
+    parser_delete.add_argument('--rows', type=int, default=500000)
+    parser_delete.add_argument('--resources', type=int, default=10)
+    parser_delete.add_argument('--depth', type=int, default=3)
+    parser_delete.set_defaults(func=bench_delete)
+
+    parser_fanout = subparsers.add_parser('fanout',
+                                          help=bench_fanout.__doc__)
+    parser_fanout.add_argument('--nodes', type=int, default=2000)
+    parser_fanout.add_argument('--size', type=int, default=16,
+                               help='size of shared values in KB')
+    parser_fanout.set_defaults(func=bench_fanout)
+
+    parser_overrides = subparsers.add_parser('overrides',
+                                             help=bench_overrides.__doc__)
+    parser_overrides.add_argument('--nodes', type=int, default=10000)
+    parser_overrides.add_argument('--size', type=int, default=4,
+                                  help='size of values of each node in KB')
+    parser_overrides.set_defaults(func=bench_overrides)
+
+    parser_keys = subparsers.add_parser('keys', help=bench_keys.__doc__)
+    parser_keys.add_argument('--size', type=int, default=256,
+                             help='size of values on each level in KB')
+    parser_keys.add_argument('--depth', type=int, default=3)
+    parser_keys.add_argument('--repeat', type=int, default=20)
+    parser_keys.set_defaults(func=bench_keys)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
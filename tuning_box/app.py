@@ -10,18 +10,30 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import itertools
+import collections
+import hashlib
+import threading
+import time
 
 import flask
 import flask_restful
 from flask_restful import fields
 from werkzeug import exceptions
+from werkzeug import http
+from werkzeug import urls
 
+from tuning_box import cache
 from tuning_box import converters
 from tuning_box import db
+from tuning_box import jsoncodec
+from tuning_box import patching
 
 api = flask_restful.Api()
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Value of trailing levels in GET of values that matches any value
+WILDCARD = '*'
+
 resource_definition_fields = {
     'id': fields.Integer,
     'name': fields.String,
@@ -39,11 +51,32 @@ component_fields = {
 
 @api.resource('/components')
 class ComponentsCollection(flask_restful.Resource):
-    method_decorators = [flask_restful.marshal_with(component_fields)]
-
     def get(self):
-        return db.Component.query.all()
+        requested = parse_fields(component_fields, {
+            'resource_definitions': resource_definition_fields,
+        })
+        if requested is None:
+            requested = dict.fromkeys(component_fields, set())
+        marshal_fields = {}
+        columns = {'id'}
+        options = []
+        for name, subnames in requested.items():
+            if name != 'resource_definitions':
+                marshal_fields[name] = component_fields[name]
+                columns.add(name)
+                continue
+            subnames = subnames or set(resource_definition_fields)
+            marshal_fields[name] = fields.List(fields.Nested(dict(
+                (subname, resource_definition_fields[subname])
+                for subname in subnames)))
+            options.append(db.db.selectinload('resource_definitions')
+                           .load_only(*subnames | {'id', 'component_id'}))
+        query = db.Component.query.options(db.db.load_only(*columns),
+                                           *options)
+        components, headers = paginate(query, db.Component)
+        return flask_restful.marshal(components, marshal_fields), 200, headers
 
+    @flask_restful.marshal_with(component_fields)
     def post(self):
         component = db.Component(name=flask.request.json['name'])
         component.resource_definitions = []
@@ -53,6 +86,7 @@ class ComponentsCollection(flask_restful.Resource):
             component.resource_definitions.append(resdef)
         db.db.session.add(component)
         db.db.session.commit()
+        get_resource_definitions_cache().invalidate()
         return component, 201
 
 
@@ -61,12 +95,18 @@ class Component(flask_restful.Resource):
     method_decorators = [flask_restful.marshal_with(component_fields)]
 
     def get(self, component_id):
-        return db.Component.query.get_or_404(component_id)
+        return db.Component.query.options(
+            db.db.selectinload('resource_definitions').undefer('content'),
+        ).get_or_404(component_id)
 
     def delete(self, component_id):
-        component = db.Component.query.get_or_404(component_id)
-        db.db.session.delete(component)
+        db.Component.query.get_or_404(component_id)
+        resdef_ids = db.delete_component(component_id)
         db.db.session.commit()
+        get_resource_definitions_cache().invalidate()
+        values_cache = get_values_cache()
+        for resdef_id in resdef_ids:
+            values_cache.invalidate(resource_definition_id=resdef_id)
         return None, 204
 
 environment_fields = {
@@ -78,11 +118,25 @@ environment_fields = {
 
 @api.resource('/environments')
 class EnvironmentsCollection(flask_restful.Resource):
-    method_decorators = [flask_restful.marshal_with(environment_fields)]
-
     def get(self):
-        return db.Environment.query.all()
+        requested = parse_fields(environment_fields)
+        if requested is None:
+            requested = environment_fields
+        marshal_fields = dict(
+            (name, environment_fields[name]) for name in requested)
+        options = []
+        if 'components' in requested:
+            options.append(db.db.selectinload('components')
+                           .load_only('id'))
+        if 'hierarchy_levels' in requested:
+            options.append(db.db.selectinload('hierarchy_levels')
+                           .load_only('name'))
+        query = db.Environment.query.options(*options)
+        environments, headers = paginate(query, db.Environment)
+        return (flask_restful.marshal(environments, marshal_fields), 200,
+                headers)
 
+    @flask_restful.marshal_with(environment_fields)
     def post(self):
         component_ids = flask.request.json['components']
         # TODO(yorik-sar): verify that resource names do not clash
@@ -109,33 +163,176 @@ class Environment(flask_restful.Resource):
         return db.Environment.query.get_or_404(environment_id)
 
     def delete(self, environment_id):
-        environment = db.Environment.query.get_or_404(environment_id)
-        db.db.session.delete(environment)
+        db.Environment.query.get_or_404(environment_id)
+        db.delete_environment(environment_id)
         db.db.session.commit()
+        get_resource_definitions_cache().invalidate(environment_id)
+        get_values_cache().invalidate(environment_id=environment_id)
         return None, 204
 
 
-def iter_environment_level_values(environment, levels):
+@api.resource('/environments/<int:environment_id>/clone')
+class EnvironmentClone(flask_restful.Resource):
+    @flask_restful.marshal_with(environment_fields)
+    def post(self, environment_id):
+        """Copy environment with all its values"""
+        environment = db.Environment.query.get_or_404(environment_id)
+        clone = db.clone_environment(environment)
+        db.db.session.commit()
+        return clone, 201
+
+
+def get_int_arg(name):
+    value = flask.request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise exceptions.BadRequest(
+            "Argument '%s' must be a non-negative integer." % (name,))
+    return value
+
+
+def paginate(query, model):
+    """Apply keyset pagination from request arguments to query.
+
+    Items are ordered by id. Argument after skips all items with id less
+    than or equal to it, positive limit caps number of returned items. If
+    there are more items, the returned headers contain Link to the next
+    page.
+    """
+    query = query.order_by(model.id)
+    after = get_int_arg('after')
+    if after is not None:
+        query = query.filter(model.id > after)
+    limit = get_int_arg('limit')
+    if limit is None:
+        return query.all(), {}
+    if limit == 0:
+        # an empty page would link to itself
+        raise exceptions.BadRequest("Argument 'limit' must be positive.")
+    items = query.limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, {}
+    items = items[:limit]
+    args = flask.request.args.copy()
+    args['after'] = items[-1].id
+    next_url = flask.request.base_url + '?' + urls.url_encode(args)
+    return items, {'Link': '<%s>; rel="next"' % (next_url,)}
+
+
+def parse_fields(known_fields, nested_fields=None):
+    """Parse comma separated list of fields from fields request argument.
+
+    Returns None if it is not given. Otherwise returns dict mapping each
+    requested field to set of requested subfields of it. Subfields of
+    nested fields are requested by dotted names, e.g. "a.b". Empty set
+    means that no subfields were specified.
+    """
+    value = flask.request.args.get('fields')
+    if value is None:
+        return None
+    nested_fields = nested_fields or {}
+    requested = {}
+    for field in value.split(','):
+        name, _, subname = field.strip().partition('.')
+        if name not in known_fields or (
+                subname and subname not in nested_fields.get(name, ())):
+            raise exceptions.BadRequest("Unknown field '%s'." % (field,))
+        subnames = requested.setdefault(name, set())
+        if subname:
+            subnames.add(subname)
+    return requested
+
+
+def get_values_cache():
+    app = flask.current_app
+    try:
+        return app.extensions['tuning_box_values_cache']
+    except KeyError:
+        values_cache = cache.ValuesCache(app.config['VALUES_CACHE_SIZE'])
+        return app.extensions.setdefault('tuning_box_values_cache',
+                                         values_cache)
+
+
+def get_resource_definitions_cache():
+    app = flask.current_app
+    try:
+        return app.extensions['tuning_box_resource_definitions_cache']
+    except KeyError:
+        resdefs_cache = cache.ResourceDefinitionsCache(
+            app.config['RESOURCE_DEFINITIONS_CACHE'])
+        return app.extensions.setdefault(
+            'tuning_box_resource_definitions_cache', resdefs_cache)
+
+
+def get_resource_definitions(environment):
+    """Get resource definitions of environment by their ids and names.
+
+    Returns dict that maps both id and name of each resource definition to
+    (id, name) pair.
+    """
+    resdefs_cache = get_resource_definitions_cache()
+    resdefs = resdefs_cache.get(environment.id)
+    if resdefs is None:
+        generation = resdefs_cache.generation
+        resdefs = {}
+        for resdef in db.ResourceDefinition.get_names_for_environment(
+                environment):
+            resdefs[resdef.id] = resdefs[resdef.name] = tuple(resdef)
+        resdefs_cache.set(environment.id, resdefs, generation)
+    return resdefs
+
+
+def get_resource_definition_id(environment, resource_id_or_name):
+    try:
+        if get_resource_definitions_cache().enabled:
+            resdef_id, _ = get_resource_definitions(environment)[
+                resource_id_or_name]
+        else:
+            # fetch single id instead of building map for one lookup
+            query = db.ResourceDefinition.query_for_environment(environment)
+            resdef_id = query.get_id_by_id_or_name(resource_id_or_name)
+    except (KeyError, exceptions.NotFound):
+        raise exceptions.NotFound(
+            "Resource %r not found in environment." % (resource_id_or_name,))
+    return resdef_id
+
+
+def check_levels(env_levels, levels):
+    for env_level, (level_name, level_value) in zip(env_levels, levels):
+        if env_level.name != level_name:
+            raise exceptions.BadRequest(
+                "Unexpected level name '%s'. Expected '%s'." % (
+                    level_name, env_level.name))
+
+
+def iter_environment_level_values(environment, levels, create=True):
+    """Iterate over level values along levels path starting from the root.
+
+    Missing level values are created and all of them are locked for
+    writing unless create is False. In that case
+    only existing ones are returned and the path is cut at the first missing
+    one, so that it is safe to use on read-only connection.
+    """
     env_levels = db.EnvironmentHierarchyLevel.get_for_environment(environment)
-    level_pairs = itertools.chain(
-        [(None, (None, None))],  # root level
-        zip(env_levels, levels),
-    )
-    parent_level_value = None
-    for env_level, (level_name, level_value) in level_pairs:
-        if env_level:
-            if env_level.name != level_name:
-                raise exceptions.BadRequest(
-                    "Unexpected level name '%s'. Expected '%s'." % (
-                        level_name, env_level.name))
-        level_value_db = db.get_or_create(
-            db.EnvironmentHierarchyLevelValue,
-            level=env_level,
-            parent=parent_level_value,
-            value=level_value,
-        )
-        yield level_value_db
-        parent_level_value = level_value_db
+    check_levels(env_levels, levels)
+    levels = levels[:len(env_levels)]  # extra levels are ignored
+    values = [level_value for level_name, level_value in levels]
+    if create and WILDCARD in values:
+        raise exceptions.BadRequest(
+            "Wildcard value %r can't be written." % (WILDCARD,))
+    level_values = db.EnvironmentHierarchyLevelValue.get_chain(
+        env_levels, values, lock=create)
+    if create and len(level_values) <= len(levels):
+        db.EnvironmentHierarchyLevelValue.get_or_create_ids(
+            env_levels, [tuple(tuple(pair) for pair in levels)])
+        level_values = db.EnvironmentHierarchyLevelValue.get_chain(
+            env_levels, values, lock=True)
+    return iter(level_values)
 
 
 def get_environment_level_value(environment, levels):
@@ -144,65 +341,1048 @@ def get_environment_level_value(environment, levels):
     return level_value
 
 
+ResolvedValues = collections.namedtuple(
+    'ResolvedValues', ('values', 'etag', 'last_modified'))
+
+
+def merge_resource_values(level_values, values_by_level_value):
+    """Merge values along level path, lower levels override upper ones."""
+    result = {}
+    for level_value in level_values:
+        result.update(values_by_level_value.get(level_value.id, {}))
+    return result
+
+
+def query_resource_values(environment, resdef_ids, level_values, *columns):
+    """Get columns of values rows for resources on given level values.
+
+    Every returned row starts with resource definition id and level value id
+    followed by requested columns.
+    """
+    if not resdef_ids or not level_values:
+        return []
+    return db.db.session.query(
+        db.ResourceValues.resource_definition_id,
+        db.ResourceValues.level_value_id,
+        *columns
+    ).filter(
+        db.ResourceValues.environment_id == environment.id,
+        db.ResourceValues.resource_definition_id.in_(resdef_ids),
+        db.ResourceValues.level_value_id.in_(
+            [level_value.id for level_value in level_values]),
+    ).all()
+
+
+def use_sql_merge():
+    """Whether values should be merged by database instead of Python"""
+    config = flask.current_app.config
+    if not config['VALUES_SQL_MERGE'] or config['JSON_COMPRESS_THRESHOLD']:
+        return False  # database can't look into compressed documents
+    return db.supports_merge_in_database()
+
+
+def make_etag(versions):
+    """Build strong ETag from (id, version) pairs of contributing rows"""
+    digest = hashlib.sha1()
+    for row_id, version in sorted(versions):
+        digest.update(('%d:%d;' % (row_id, version)).encode('ascii'))
+    return digest.hexdigest()
+
+
+def version_columns():
+    return (
+        db.ResourceValues.id,
+        db.ResourceValues.version,
+        db.ResourceValues.updated_at,
+    )
+
+
+def resolve_values(level_values, rows, merge=True):
+    """Merge values from rows with version_columns() and values.
+
+    If merge is False, rows don't need to have values and only ETag and
+    last modification time are calculated.
+    """
+    if merge:
+        values = merge_resource_values(level_values, {
+            row.level_value_id: row.values for row in rows})
+    else:
+        values = None
+    return ResolvedValues(
+        values=values,
+        etag=make_etag((row.id, row.version) for row in rows),
+        last_modified=max([row.updated_at for row in rows
+                           if row.updated_at] or [None]),
+    )
+
+
+def query_deepest_resource_values(environment, resdef_id, level_values,
+                                  *columns):
+    """Get columns of the values row on the deepest of level values"""
+    if not level_values:
+        return None
+    return db.db.session.query(*columns).join(
+        db.EnvironmentHierarchyLevelValue,
+        db.EnvironmentHierarchyLevelValue.id ==
+        db.ResourceValues.level_value_id,
+    ).filter(
+        db.ResourceValues.environment_id == environment.id,
+        db.ResourceValues.resource_definition_id == resdef_id,
+        db.ResourceValues.level_value_id.in_(
+            [level_value.id for level_value in level_values]),
+    ).order_by(
+        db.db.func.length(db.EnvironmentHierarchyLevelValue.path).desc(),
+    ).first()
+
+
+def resolve_snapshot(environment, resdef_id, level_values, load_values=True):
+    """Resolve values from snapshot of the deepest values row.
+
+    Every change of effective values of a row bumps its version, so that
+    row alone is enough for ETag. Values are None if they are not loaded or
+    snapshot of the row is not built yet.
+    """
+    columns = version_columns()
+    if load_values:
+        columns += (db.ResourceValues.snapshot,)
+    row = query_deepest_resource_values(
+        environment, resdef_id, level_values, *columns)
+    if row is None:
+        return ResolvedValues({} if load_values else None, make_etag([]),
+                              None)
+    return ResolvedValues(
+        values=row.snapshot if load_values else None,
+        etag=make_etag([(row.id, row.version)]),
+        last_modified=row.updated_at,
+    )
+
+
+def resolve_deepest_snapshot(level_values, rows):
+    """Like resolve_snapshot, but from rows on all of level values.
+
+    Rows have version_columns(), values and snapshot. Values are merged from
+    all rows if snapshot of the deepest one is not built yet.
+    """
+    if not rows:
+        return ResolvedValues({}, make_etag([]), None)
+    depths = {level_value.id: depth
+              for depth, level_value in enumerate(level_values)}
+    row = max(rows, key=lambda row: depths[row.level_value_id])
+    values = row.snapshot
+    if values is None:
+        values = resolve_values(level_values, rows).values
+    return ResolvedValues(
+        values=values,
+        etag=make_etag([(row.id, row.version)]),
+        last_modified=row.updated_at,
+    )
+
+
+def resolve_resource_values(environment, resdef_id, level_values,
+                            if_none_match):
+    """Resolve values of resource on the last of level values.
+
+    If ETag matches if_none_match values may be not loaded and are None.
+    """
+    config = flask.current_app.config
+    if config['VALUES_SNAPSHOTS']:
+        if if_none_match:
+            resolved = resolve_snapshot(environment, resdef_id, level_values,
+                                        load_values=False)
+            if if_none_match.contains_weak(resolved.etag):
+                return resolved
+        resolved = resolve_snapshot(environment, resdef_id, level_values)
+        if resolved.values is None:
+            # written before snapshots were introduced and not rebuilt yet
+            rows = query_resource_values(
+                environment, [resdef_id], level_values,
+                db.ResourceValues.values, *version_columns())
+            resolved = resolved._replace(
+                values=resolve_values(level_values, rows).values)
+        return resolved
+    sql_merge = use_sql_merge()
+    if if_none_match or sql_merge:
+        # Versions are enough to answer 304 without loading values
+        rows = query_resource_values(
+            environment, [resdef_id], level_values, *version_columns())
+        resolved = resolve_values(level_values, rows, merge=False)
+        if if_none_match.contains_weak(resolved.etag):
+            return resolved
+        if sql_merge:
+            values = db.ResourceValues.merge_in_database(
+                environment.id, resdef_id,
+                [level_value.id for level_value in level_values])
+            if values is not None:
+                return resolved._replace(values=values)
+    rows = query_resource_values(
+        environment, [resdef_id], level_values,
+        db.ResourceValues.values, *version_columns())
+    return resolve_values(level_values, rows)
+
+
+def get_resolved_values(environment, resdef_id, levels, if_none_match):
+    """Like resolve_resource_values, but for levels and using the cache"""
+    values_cache = get_values_cache()
+    cache_key = (environment.id, resdef_id, tuple(levels))
+    resolved = values_cache.get(cache_key)
+    if resolved is None:
+        generation = values_cache.generation
+        level_values = list(iter_environment_level_values(
+            environment, levels, create=False))
+        resolved = resolve_resource_values(
+            environment, resdef_id, level_values, if_none_match)
+        if resolved.values is not None:
+            values_cache.set(cache_key, resolved, generation)
+    return resolved
+
+
+def parse_keys():
+    """Parse keys argument into sorted tuples of nested keys, or None"""
+    arg = flask.request.args.get('keys')
+    if arg is None:
+        return None
+    keys = sorted(set(tuple(key.split('.')) for key in arg.split(',')))
+    if not all(all(key) for key in keys):
+        raise exceptions.BadRequest(
+            "Argument 'keys' must be a comma-separated list of keys, "
+            "nested keys joined with dots.")
+    return keys
+
+
+def project_values(values, keys):
+    """Pick keys (tuples of nested keys) from values, skip missing ones"""
+    result = {}
+    picked = set()
+    for key in sorted(keys, key=len):
+        if any(key[:i] in picked for i in range(1, len(key))):
+            continue  # whole parent is picked already
+        value = values
+        for part in key:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = result
+            for part in key[:-1]:
+                target = target.setdefault(part, {})
+            target[key[-1]] = value
+            picked.add(key)
+    return result
+
+
+def make_projection_etag(etag, keys):
+    """Build ETag of keys picked from values with etag"""
+    digest = hashlib.sha1(etag.encode('ascii'))
+    for key in keys:
+        digest.update(('\n' + '.'.join(key)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def resolve_etag(environment, resdef_id, level_values):
+    """Resolve ETag and last modification time only, same as for values"""
+    if flask.current_app.config['VALUES_SNAPSHOTS']:
+        return resolve_snapshot(environment, resdef_id, level_values,
+                                load_values=False)
+    rows = query_resource_values(
+        environment, [resdef_id], level_values, *version_columns())
+    return resolve_values(level_values, rows, merge=False)
+
+
+def query_key_values(environment, resdef_id, level_values, keys):
+    """Merge values of top-level keys stored in ResourceValuesKey.
+
+    Returns None if some of them were written without VALUES_KEY_STORAGE
+    and have no values stored, or some values rows have no keys at all,
+    i.e. were written before keys were indexed and not rebuilt.
+    """
+    key_cls = db.ResourceValuesKey
+    if any(len(key) > key_cls.key.type.length for key in keys):
+        return None  # not indexed
+    if not level_values:
+        return {}
+    depths = dict((level_value.id, depth)
+                  for depth, level_value in enumerate(level_values))
+    values_rows = db.db.session.query(db.db.func.count()).filter(
+        db.ResourceValues.environment_id == environment.id,
+        db.ResourceValues.resource_definition_id == resdef_id,
+        db.ResourceValues.level_value_id.in_(depths),
+        db.ResourceValues.values != {},  # empty ones have no keys
+    )
+    indexed_rows = db.db.session.query(
+        db.db.func.count(db.db.distinct(key_cls.level_value_id)),
+    ).filter(
+        key_cls.environment_id == environment.id,
+        key_cls.resource_definition_id == resdef_id,
+        key_cls.level_value_id.in_(depths),
+    )
+    counts = db.db.session.query(values_rows.as_scalar(),
+                                 indexed_rows.as_scalar()).one()
+    if counts[0] != counts[1]:
+        return None
+    rows = db.db.session.query(
+        key_cls.level_value_id,
+        key_cls.key,
+        key_cls.value,
+        key_cls.value.isnot(None),
+    ).filter(
+        key_cls.environment_id == environment.id,
+        key_cls.resource_definition_id == resdef_id,
+        key_cls.key.in_(keys),
+        key_cls.level_value_id.in_(depths),
+    ).all()
+    result = {}
+    # deeper level values override upper ones, like in whole values
+    for level_value_id, key, value, stored in sorted(
+            rows, key=lambda row: depths[row[0]]):
+        if not stored:
+            return None
+        result[key] = value
+    return result
+
+
+def get_projected_values(environment, resdef_id, levels, keys,
+                         if_none_match):
+    """Like get_resolved_values, but only keys are picked from values.
+
+    If whole values are not cached and VALUES_KEY_STORAGE is set, only
+    values of needed top-level keys are fetched and decoded.
+    """
+    cached = get_values_cache().get(
+        (environment.id, resdef_id, tuple(levels)))
+    if cached is None and flask.current_app.config['VALUES_KEY_STORAGE']:
+        level_values = list(iter_environment_level_values(
+            environment, levels, create=False))
+        resolved = resolve_etag(environment, resdef_id, level_values)
+        etag = make_projection_etag(resolved.etag, keys)
+        if if_none_match.contains_weak(etag):
+            return resolved._replace(etag=etag)
+        values = query_key_values(environment, resdef_id, level_values,
+                                  set(key[0] for key in keys))
+        if values is not None:
+            return resolved._replace(values=project_values(values, keys),
+                                     etag=etag)
+    resolved = cached or get_resolved_values(environment, resdef_id, levels,
+                                             http.ETags())
+    return resolved._replace(
+        values=project_values(resolved.values, keys),
+        etag=make_projection_etag(resolved.etag, keys))
+
+
+def check_wildcard_levels(env_levels, levels):
+    check_levels(env_levels, levels)
+    if len(levels) > len(env_levels):
+        raise exceptions.BadRequest("Too many levels.")
+    values = [value for _, value in levels]
+    if any(value != WILDCARD for value in values[values.index(WILDCARD):]):
+        raise exceptions.BadRequest(
+            "Only trailing levels can have wildcard values.")
+
+
+def iter_fan_out(environment, env_levels, resdef_id, levels, chunk_size,
+                 keys=None):
+    """Generate NDJSON lines with values of resource on matching paths.
+
+    Trailing levels of levels have WILDCARD values that match any value.
+    Every existing level value that matches gets a line with its levels and
+    resolved values. Shared values are merged only once: the path before
+    wildcards is resolved as usual, values of level values between it and
+    the last level are merged in memory, and values of the matching level
+    values themselves are streamed chunk_size rows at a time. If keys are
+    given, only they are picked from values, like with project_values.
+    """
+    fixed_levels = levels[:[value for _, value in levels].index(WILDCARD)]
+    level_values = list(iter_environment_level_values(
+        environment, fixed_levels, create=False))
+    if len(level_values) <= len(fixed_levels):
+        return  # no such path, nothing matches
+    level_value_cls = db.EnvironmentHierarchyLevelValue
+    merged = {level_values[-1].path: get_resolved_values(
+        environment, resdef_id, fixed_levels, http.ETags()).values}
+
+    def query_values(env_level, outer):
+        query = db.db.session.query(
+            level_value_cls.path,
+            db.ResourceValues.values,
+        ).filter(
+            level_value_cls.level_id == env_level.id,
+        )
+        if level_values[-1].path:
+            query = query.filter(level_value_cls.path.startswith(
+                level_values[-1].path + '/', autoescape=True))
+        return query.join(db.ResourceValues, db.db.and_(
+            db.ResourceValues.level_value_id == level_value_cls.id,
+            db.ResourceValues.environment_id == environment.id,
+            db.ResourceValues.resource_definition_id == resdef_id,
+        ), isouter=outer)
+
+    def merge(path, values):
+        for parent in reversed(level_value_cls.parent_paths(path)):
+            if parent in merged:
+                result = dict(merged[parent])
+                result.update(values or {})
+                return result
+
+    # Intermediate level values with values are few compared to the last
+    # level, their merged values are kept in memory
+    for env_level in env_levels[len(fixed_levels):len(levels) - 1]:
+        for path, values in query_values(env_level, outer=False):
+            merged[path] = merge(path, values)
+    dumps = jsoncodec.JsonCodec(jsoncodec.get_codec().backend).dumps
+    query = query_values(env_levels[len(levels) - 1], outer=True).order_by(
+        level_value_cls.path,
+    ).execution_options(stream_results=True).yield_per(chunk_size)
+    for path, values in query:
+        values = merge(path, values)
+        if keys is not None:
+            values = project_values(values, keys)
+        yield dumps({
+            'levels': level_value_cls.split_path(path),
+            'values': values,
+        }) + '\n'
+
+
 @api.resource(
     '/environments/<int:environment_id>' +
     '/<levels:levels>resources/<id_or_name:resource_id_or_name>/values')
 class ResourceValues(flask_restful.Resource):
     def put(self, environment_id, levels, resource_id_or_name):
         environment = db.Environment.query.get_or_404(environment_id)
+        resdef_id = get_resource_definition_id(environment,
+                                               resource_id_or_name)
+        values = flask.request.json
+        if not isinstance(values, dict):
+            raise exceptions.BadRequest("Values should be an object.")
+        db.lock_resource_values(environment.id, [resdef_id])
         level_value = get_environment_level_value(environment, levels)
-        # TODO(yorik-sar): filter by environment
-        resdef = db.ResourceDefinition.query.get_by_id_or_name(
-            resource_id_or_name)
-        if resdef.id != resource_id_or_name:
-            return flask.redirect(api.url_for(
-                ResourceValues,
-                environment_id=environment_id,
-                levels=levels,
-                resource_id_or_name=resdef.id,
-            ), code=308)
-        esv = db.get_or_create(
-            db.ResourceValues,
-            environment=environment,
-            resource_definition=resdef,
-            level_value=level_value,
-        )
-        esv.values = flask.request.json
+        db.ResourceValues.set_values(environment.id, [
+            (resdef_id, level_value.id, values)])
+        db.ResourceValues.refresh_snapshots(environment.id, resdef_id,
+                                            [level_value.path])
         db.db.session.commit()
+        # levels beyond depth of environment are not written
+        get_values_cache().invalidate(
+            environment.id, resdef_id,
+            db.EnvironmentHierarchyLevelValue.split_path(level_value.path))
         return None, 204
 
+    def patch(self, environment_id, levels, resource_id_or_name):
+        """Change values with JSON Merge Patch or JSON Patch.
+
+        Patch type is selected by request Content-Type. The patch is applied
+        to the row locked for update, so that concurrent patches don't lose
+        each other's changes.
+        """
+        mimetype = flask.request.mimetype
+        if mimetype == patching.MERGE_PATCH_MIMETYPE:
+            apply_patch = patching.merge_patch
+        elif mimetype == patching.JSON_PATCH_MIMETYPE:
+            apply_patch = patching.apply_patch
+        else:
+            raise exceptions.UnsupportedMediaType(
+                "Expected Content-Type '%s' or '%s'." % (
+                    patching.MERGE_PATCH_MIMETYPE,
+                    patching.JSON_PATCH_MIMETYPE))
+        environment = db.Environment.query.get_or_404(environment_id)
+        resdef_id = get_resource_definition_id(environment,
+                                               resource_id_or_name)
+        db.lock_resource_values(environment.id, [resdef_id])
+        level_value = get_environment_level_value(environment, levels)
+        # Make sure there is a row to lock. A new one gets version 1 when
+        # it's updated below, and disappears if patch fails.
+        db.upsert(db.ResourceValues.__table__, [{
+            'environment_id': environment.id,
+            'resource_definition_id': resdef_id,
+            'level_value_id': level_value.id,
+            'values': {},
+            'version': 0,
+        }])
+        values = db.db.session.query(db.ResourceValues.values).filter(
+            db.ResourceValues.environment_id == environment.id,
+            db.ResourceValues.resource_definition_id == resdef_id,
+            db.ResourceValues.level_value_id == level_value.id,
+        ).with_for_update().scalar()
+        try:
+            values = apply_patch(values, flask.request.get_json(force=True))
+        except patching.InvalidPatch as e:
+            raise exceptions.BadRequest(str(e))
+        except patching.PatchConflict as e:
+            raise exceptions.Conflict(str(e))
+        if not isinstance(values, dict):
+            raise exceptions.Conflict(
+                "Patched values must be a JSON object.")
+        # bumps version even if values are unchanged
+        db.ResourceValues.set_values(environment.id, [
+            (resdef_id, level_value.id, values)])
+        db.ResourceValues.refresh_snapshots(environment.id, resdef_id,
+                                            [level_value.path])
+        db.db.session.commit()
+        # levels beyond depth of environment are not written
+        get_values_cache().invalidate(
+            environment.id, resdef_id,
+            db.EnvironmentHierarchyLevelValue.split_path(level_value.path))
+        return None, 204
+
+    def get(self, environment_id, resource_id_or_name, levels):
+        environment = db.Environment.query.get_or_404(environment_id)
+        resdef_id = get_resource_definition_id(environment,
+                                               resource_id_or_name)
+        keys = parse_keys()
+        if any(value == WILDCARD for _, value in levels):
+            env_levels = db.EnvironmentHierarchyLevel.get_for_environment(
+                environment)
+            check_wildcard_levels(env_levels, levels)
+            chunk_size = flask.current_app.config['EXPORT_CHUNK_SIZE']
+            return flask.Response(
+                flask.stream_with_context(iter_fan_out(
+                    environment, env_levels, resdef_id, levels, chunk_size,
+                    keys)),
+                mimetype=NDJSON_MIMETYPE,
+            )
+        if_none_match = flask.request.if_none_match
+        if keys is None:
+            resolved = get_resolved_values(environment, resdef_id, levels,
+                                           if_none_match)
+        else:
+            resolved = get_projected_values(environment, resdef_id, levels,
+                                            keys, if_none_match)
+        headers = {
+            'ETag': http.quote_etag(resolved.etag),
+            'Cache-Control': 'max-age=%d, must-revalidate' % (
+                flask.current_app.config['VALUES_MAX_AGE'],),
+        }
+        if resolved.last_modified:
+            headers['Last-Modified'] = http.http_date(resolved.last_modified)
+        if if_none_match.contains_weak(resolved.etag):
+            return flask.Response(status=304, headers=headers)
+        return resolved.values, 200, headers
+
+
+@api.resource(
+    '/environments/<int:environment_id>' +
+    '/<levels:levels>resources/<id_or_name:resource_id_or_name>/overrides')
+class ResourceValuesOverrides(flask_restful.Resource):
     def get(self, environment_id, resource_id_or_name, levels):
+        """List levels of level values that set key in resource values.
+
+        key argument is a key path with nested keys joined by dots, e.g.
+        "nova.cpu_allocation_ratio". Only levels in the subtree of levels
+        are listed, the root one first.
+        """
+        key = flask.request.args.get('key')
+        if not key:
+            raise exceptions.BadRequest("Argument 'key' is required.")
+        max_length = db.ResourceValuesKey.key.type.length
+        if len(key) > max_length:
+            # longer key paths are not stored
+            raise exceptions.BadRequest(
+                "Argument 'key' must be at most %d characters long." % (
+                    max_length,))
+        environment = db.Environment.query.get_or_404(environment_id)
+        resdef_id = get_resource_definition_id(environment,
+                                               resource_id_or_name)
+        env_levels = db.EnvironmentHierarchyLevel.get_for_environment(
+            environment)
+        check_levels(env_levels, levels)
+        if len(levels) > len(env_levels):
+            raise exceptions.BadRequest("Too many levels.")
+        level_value_cls = db.EnvironmentHierarchyLevelValue
+        query = db.db.session.query(level_value_cls.path).join(
+            db.ResourceValuesKey,
+            db.ResourceValuesKey.level_value_id == level_value_cls.id,
+        ).filter(
+            db.ResourceValuesKey.environment_id == environment.id,
+            db.ResourceValuesKey.resource_definition_id == resdef_id,
+            db.ResourceValuesKey.key == key,
+        )
+        path = level_value_cls.build_path(levels)
+        if path:
+            query = query.filter(db.db.or_(
+                level_value_cls.path == path,
+                level_value_cls.path.startswith(path + '/', autoescape=True),
+            ))
+        return [level_value_cls.split_path(path)
+                for path, in query.order_by(level_value_cls.path)]
+
+
+@api.resource('/environments/<int:environment_id>/<levels:levels>values')
+class EnvironmentValues(flask_restful.Resource):
+    def get(self, environment_id, levels):
         environment = db.Environment.query.get_or_404(environment_id)
-        level_values = list(iter_environment_level_values(environment, levels))
-        # TODO(yorik-sar): filter by environment
-        resdef = db.ResourceDefinition.query.get_by_id_or_name(
-            resource_id_or_name)
-        if resdef.id != resource_id_or_name:
-            return flask.redirect(api.url_for(
-                ResourceValues,
-                environment_id=environment_id,
-                levels=levels,
-                resource_id_or_name=resdef.id,
-            ), code=308)
-        resource_values = db.ResourceValues.query.filter_by(
-            resource_definition=resdef,
-            environment=environment,
-        ).all()
+        resdefs = set(get_resource_definitions(environment).values())
+        values_cache = get_values_cache()
+        generation = values_cache.generation
         result = {}
-        for level_value in level_values:
-            for resource_value in resource_values:
-                if resource_value.level_value == level_value:
-                    result.update(resource_value.values)
-                    break
+        missing_resdefs = {}
+        for resdef_id, resdef_name in resdefs:
+            resolved = values_cache.get(
+                (environment.id, resdef_id, tuple(levels)))
+            if resolved is None:
+                missing_resdefs[resdef_id] = resdef_name
+            else:
+                result[resdef_name] = resolved.values
+        if not missing_resdefs:
+            return result
+        level_values = list(iter_environment_level_values(
+            environment, levels, create=False))
+        # cached entries are shared with get_resolved_values, so they must
+        # get the same ETags as resolve_resource_values builds
+        snapshots = flask.current_app.config['VALUES_SNAPSHOTS']
+        columns = version_columns() + (db.ResourceValues.values,)
+        if snapshots:
+            columns += (db.ResourceValues.snapshot,)
+        rows_by_resdef = {resdef_id: [] for resdef_id in missing_resdefs}
+        for row in query_resource_values(
+                environment, list(missing_resdefs), level_values, *columns):
+            rows_by_resdef[row.resource_definition_id].append(row)
+        for resdef_id, resdef_name in missing_resdefs.items():
+            rows = rows_by_resdef[resdef_id]
+            if snapshots:
+                resolved = resolve_deepest_snapshot(level_values, rows)
+            else:
+                resolved = resolve_values(level_values, rows)
+            values_cache.set((environment.id, resdef_id, tuple(levels)),
+                             resolved, generation)
+            result[resdef_name] = resolved.values
         return result
 
 
+def parse_levels(levels, env_levels):
+    """Validate list of [name, value] pairs from request body.
+
+    Returns tuple of (level name, level value) pairs.
+    """
+    try:
+        levels = tuple((name, value) for name, value in levels)
+    except (TypeError, ValueError):
+        raise exceptions.BadRequest(
+            "Levels should be a list of [name, value] pairs.")
+    for level in levels:
+        for part in level:
+            if not isinstance(part, type(u'')) or not part or \
+                    '/' in part or part == WILDCARD:
+                raise exceptions.BadRequest(
+                    "Bad level name or value: %r." % (part,))
+    check_levels(env_levels, levels)
+    return levels[:len(env_levels)]
+
+
+def parse_batch_entry(entry, env_levels, environment):
+    """Validate one entry of batch request.
+
+    Returns (levels, resource definition id, values) tuple where levels is
+    a tuple of (level name, level value) pairs.
+    """
+    if not isinstance(entry, dict):
+        raise exceptions.BadRequest("Entry should be an object.")
+    levels = parse_levels(entry.get('levels', []), env_levels)
+    try:
+        resdef_id = get_resource_definition_id(environment, entry['resource'])
+    except (KeyError, TypeError):
+        raise exceptions.NotFound(
+            "Resource %r not found in environment." % (entry.get('resource'),))
+    values = entry.get('values')
+    if not isinstance(values, dict):
+        raise exceptions.BadRequest("Values should be an object.")
+    return levels, resdef_id, values
+
+
+@api.resource('/environments/<int:environment_id>/values/batch')
+class ResourceValuesBatch(flask_restful.Resource):
+    def put(self, environment_id):
+        """Set values for many level paths and resources in one transaction.
+
+        Request body is a list of entries like:
+
+            {"levels": [["lvl1", "val1"]], "resource": 5, "values": {...}}
+
+        Response has a status for each entry: 201 if values were created, 204
+        if they were replaced. If any entry is invalid nothing is applied and
+        other entries get 424 status.
+        """
+        environment = db.Environment.query.get_or_404(environment_id)
+        entries = flask.request.json
+        if not isinstance(entries, list):
+            raise exceptions.BadRequest("Expected a list of entries.")
+        env_levels = db.EnvironmentHierarchyLevel.get_for_environment(
+            environment)
+        parsed_entries = []
+        results = []
+        failed = False
+        for entry in entries:
+            try:
+                parsed_entries.append(
+                    parse_batch_entry(entry, env_levels, environment))
+            except exceptions.HTTPException as e:
+                failed = True
+                results.append({'status': e.code, 'message': e.description})
+            else:
+                results.append({'status': 424})
+        if failed:
+            return results, 400
+
+        db.lock_resource_values(
+            environment.id, [resdef_id for _, resdef_id, _ in parsed_entries])
+        level_value_ids = db.EnvironmentHierarchyLevelValue.get_or_create_ids(
+            env_levels, [levels for levels, _, _ in parsed_entries])
+        new_values = {}
+        for levels, resdef_id, values in parsed_entries:
+            new_values[level_value_ids[levels], resdef_id] = values
+        existing_ids = {}
+        for chunk in db.iter_chunks(set(level_value_ids.values())):
+            query = db.db.session.query(
+                db.ResourceValues.id,
+                db.ResourceValues.level_value_id,
+                db.ResourceValues.resource_definition_id,
+            ).filter(
+                db.ResourceValues.environment_id == environment.id,
+                db.ResourceValues.level_value_id.in_(chunk),
+            )
+            for esv_id, level_value_id, resdef_id in query:
+                existing_ids[level_value_id, resdef_id] = esv_id
+        db.ResourceValues.set_values(environment.id, [
+            (resdef_id, level_value_id, values)
+            for (level_value_id, resdef_id), values in new_values.items()])
+        paths_by_resdef = collections.defaultdict(set)
+        for levels, resdef_id, _ in parsed_entries:
+            paths_by_resdef[resdef_id].add(
+                db.EnvironmentHierarchyLevelValue.build_path(levels))
+        for resdef_id, paths in paths_by_resdef.items():
+            db.ResourceValues.refresh_snapshots(environment.id, resdef_id,
+                                                paths)
+        db.db.session.commit()
+        get_values_cache().invalidate(environment_id=environment.id)
+        return [{'status': 204 if (level_value_ids[levels], resdef_id)
+                 in existing_ids else 201}
+                for levels, resdef_id, _ in parsed_entries]
+
+
+def iter_export(environment, chunk_size):
+    """Generate NDJSON lines describing environment and all its values.
+
+    Components with their resource definitions go first, then the
+    environment itself, then values of every level path ordered by path,
+    so that parents always precede their children. Values rows are fetched
+    chunk_size at a time with server-side cursor where database supports
+    it.
+    """
+    # Compressing lines that go right to the client makes no sense
+    dumps = jsoncodec.JsonCodec(jsoncodec.get_codec().backend).dumps
+    components = db.Component.query.filter(
+        db.Component.id.in_([c.id for c in environment.components]),
+    ).options(
+        db.db.selectinload('resource_definitions')
+        .undefer('content'),
+    ).order_by(db.Component.id)
+    for component in components:
+        yield dumps({
+            'type': 'component',
+            'name': component.name,
+            'resource_definitions': [
+                {'name': resdef.name, 'content': resdef.content}
+                for resdef in component.resource_definitions],
+        }) + '\n'
+    yield dumps({
+        'type': 'environment',
+        'id': environment.id,
+        'components': [c.name for c in environment.components],
+        'hierarchy_levels': [
+            level.name for level in
+            db.EnvironmentHierarchyLevel.get_for_environment(environment)],
+    }) + '\n'
+    query = db.db.session.query(
+        db.EnvironmentHierarchyLevelValue.path,
+        db.ResourceDefinition.name,
+        db.ResourceValues.values,
+    ).join(
+        db.ResourceValues.level_value,
+    ).join(
+        db.ResourceValues.resource_definition,
+    ).filter(
+        db.ResourceValues.environment_id == environment.id,
+    ).order_by(
+        db.EnvironmentHierarchyLevelValue.path,
+        db.ResourceDefinition.name,
+    ).execution_options(stream_results=True).yield_per(chunk_size)
+    for path, resdef_name, values in query:
+        yield dumps({
+            'type': 'values',
+            'levels': db.EnvironmentHierarchyLevelValue.split_path(path),
+            'resource': resdef_name,
+            'values': values,
+        }) + '\n'
+
+
+@api.resource('/environments/<int:environment_id>/export')
+class EnvironmentExport(flask_restful.Resource):
+    def get(self, environment_id):
+        """Stream environment with all its values as NDJSON"""
+        environment = db.Environment.query.get_or_404(environment_id)
+        chunk_size = flask.current_app.config['EXPORT_CHUNK_SIZE']
+        return flask.Response(
+            flask.stream_with_context(iter_export(environment, chunk_size)),
+            mimetype=NDJSON_MIMETYPE,
+        )
+
+
+def iter_import_records(stream):
+    """Iterate over (position, record) pairs read from stream of bytes.
+
+    Stream is either NDJSON or a single JSON array of records. Position is
+    a human readable location of the record for error messages.
+    """
+    loads = jsoncodec.JsonCodec(jsoncodec.get_codec().backend).loads
+    lines = iter(stream)
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(b'['):
+            data = line + b''.join(lines)
+            try:
+                records = loads(data.decode('utf-8'))
+            except ValueError as e:
+                raise exceptions.BadRequest("Invalid JSON: %s." % (e,))
+            if not isinstance(records, list):
+                raise exceptions.BadRequest("Expected a list of records.")
+            for index, record in enumerate(records, 1):
+                yield 'record %d' % (index,), record
+            return
+        try:
+            record = loads(line.decode('utf-8'))
+        except ValueError as e:
+            raise exceptions.BadRequest(
+                "Invalid JSON on line %d: %s." % (number, e))
+        yield 'line %d' % (number,), record
+
+
+class EnvironmentImporter(object):
+    """Create environment from records like the ones iter_export produces.
+
+    Components are looked up by name and created if missing. Values are
+    written with bulk inserts and committed every chunk_size records.
+    Snapshots are computed for all of them in the end, until then readers
+    merge values of all levels. If import fails, the new environment is
+    deleted with values committed so far.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.environment = None
+        self.env_levels = None
+        self.resource_definitions = None
+        self.resource_definition_ids = set()
+        self.chunk = []
+
+    def add_component(self, record):
+        if self.environment is not None:
+            raise exceptions.BadRequest(
+                "Components should precede the environment.")
+        component = db.Component.query.filter_by(name=record['name']).first()
+        if component is None:
+            component = db.Component(name=record['name'])
+            db.db.session.add(component)
+        names = set(resdef.name for resdef in component.resource_definitions)
+        for resdef in record.get('resource_definitions', []):
+            if resdef['name'] not in names:
+                component.resource_definitions.append(db.ResourceDefinition(
+                    name=resdef['name'], content=resdef.get('content')))
+                names.add(resdef['name'])
+        db.db.session.flush()
+
+    def add_environment(self, record):
+        if self.environment is not None:
+            raise exceptions.BadRequest(
+                "Only one environment can be imported at once.")
+        names = record.get('components', [])
+        components = db.Component.query.filter(
+            db.Component.name.in_(names)).all() if names else []
+        missing = set(names) - set(c.name for c in components)
+        if missing:
+            raise exceptions.BadRequest("Unknown components: %s." % (
+                ', '.join(sorted(missing)),))
+        hierarchy_levels = []
+        level = None
+        for name in record.get('hierarchy_levels', []):
+            level = db.EnvironmentHierarchyLevel(name=name, parent=level)
+            hierarchy_levels.append(level)
+        environment = db.Environment(components=components,
+                                     hierarchy_levels=hierarchy_levels)
+        db.db.session.add(environment)
+        db.db.session.commit()
+        self.environment = environment
+        self.env_levels = hierarchy_levels
+        self.resource_definitions = dict(
+            (name, resdef_id) for resdef_id, name in
+            db.ResourceDefinition.get_names_for_environment(environment))
+
+    def add_values(self, record):
+        if self.environment is None:
+            raise exceptions.BadRequest(
+                "Values should follow the environment.")
+        levels = parse_levels(record.get('levels', []), self.env_levels)
+        try:
+            resdef_id = self.resource_definitions[record['resource']]
+        except (KeyError, TypeError):
+            raise exceptions.NotFound("Resource %r not found in environment." %
+                                      (record.get('resource'),))
+        values = record.get('values')
+        if not isinstance(values, dict):
+            raise exceptions.BadRequest("Values should be an object.")
+        self.chunk.append((levels, resdef_id, values))
+        self.resource_definition_ids.add(resdef_id)
+        if len(self.chunk) >= self.chunk_size:
+            self.write_chunk()
+
+    def write_chunk(self):
+        level_value_ids = db.EnvironmentHierarchyLevelValue.get_or_create_ids(
+            self.env_levels, [levels for levels, _, _ in self.chunk])
+        # Version is bumped when snapshots are computed
+        db.ResourceValues.set_values(self.environment.id, [
+            (resdef_id, level_value_ids[levels], values)
+            for levels, resdef_id, values in self.chunk], version=0)
+        db.db.session.commit()
+        self.chunk = []
+
+    def add_record(self, record):
+        if not isinstance(record, dict):
+            raise exceptions.BadRequest("Record should be an object.")
+        record_type = record.get('type')
+        handlers = {
+            'component': self.add_component,
+            'environment': self.add_environment,
+            'values': self.add_values,
+        }
+        if record_type not in handlers:
+            raise exceptions.BadRequest(
+                "Unknown record type %r." % (record_type,))
+        try:
+            handlers[record_type](record)
+        except (KeyError, TypeError, AttributeError):
+            raise exceptions.BadRequest(
+                "Malformed %s record." % (record_type,))
+
+    def finish(self):
+        if self.environment is None:
+            raise exceptions.BadRequest("No environment to import.")
+        self.write_chunk()
+        for resdef_id in sorted(self.resource_definition_ids):
+            db.ResourceValues.refresh_snapshots(
+                self.environment.id, resdef_id, [''], written=False)
+            db.db.session.commit()
+
+    def run(self, records):
+        """Import all records, return the new environment"""
+        try:
+            for position, record in records:
+                try:
+                    self.add_record(record)
+                except exceptions.HTTPException as e:
+                    e.description = "%s: %s" % (position.capitalize(),
+                                                e.description)
+                    raise
+            self.finish()
+        except Exception:
+            db.db.session.rollback()
+            if self.environment is not None:
+                # clients can't tell a partial environment from a complete one
+                db.delete_environment(self.environment.id)
+                db.db.session.commit()
+                self.environment = None
+            raise
+        return self.environment
+
+
+@api.resource('/environments/import')
+class EnvironmentImport(flask_restful.Resource):
+    @flask_restful.marshal_with(environment_fields)
+    def post(self):
+        """Create environment from NDJSON or JSON array of records"""
+        chunk_size = flask.current_app.config['IMPORT_CHUNK_SIZE']
+        importer = EnvironmentImporter(chunk_size)
+        try:
+            environment = importer.run(
+                iter_import_records(flask.request.stream))
+        finally:
+            # resource definitions may be added to existing components,
+            # even if import fails after that
+            get_resource_definitions_cache().invalidate()
+        return environment, 201
+
+
+def collect_level_values(app):
+    """Run one round of garbage collection of level values"""
+    with app.app_context():
+        try:
+            deleted = db.collect_level_values(
+                app.config['LEVEL_VALUES_GC_BATCH_SIZE'])
+        except Exception:
+            app.logger.exception("Failed to collect orphaned level values")
+            db.db.session.rollback()
+        else:
+            if deleted:
+                app.logger.info("Deleted %d orphaned level values", deleted)
+        finally:
+            db.db.session.remove()
+
+
+def start_level_values_gc(app, interval):
+    """Collect orphaned level values every interval seconds in background"""
+    def run():
+        while True:
+            time.sleep(interval)
+            collect_level_values(app)
+
+    thread = threading.Thread(target=run, name='tuning_box-level-values-gc')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
 def build_app():
     app = flask.Flask(__name__)
     app.url_map.converters.update(converters.ALL)
     api.init_app(app)  # init_app spoils Api object if app is a blueprint
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  # silence warning
+    # Number of resolved resource values to keep in memory, 0 to disable.
+    # Both caches live in the process and are invalidated only by its own
+    # writes, so they must stay disabled if several processes serve the
+    # same database or it is changed by tuning_box-manage meanwhile
+    app.config.setdefault("VALUES_CACHE_SIZE", 0)
+    # Whether to keep resource definitions of environments in memory
+    app.config.setdefault("RESOURCE_DEFINITIONS_CACHE", False)
+    # How long reverse proxies may serve resource values without revalidation
+    app.config.setdefault("VALUES_MAX_AGE", 0)
+    # JSON library for stored documents, 'auto' picks the fastest installed
+    app.config.setdefault("JSON_CODEC", 'auto')
+    # Compress stored documents at least this long, 0 disables compression
+    app.config.setdefault("JSON_COMPRESS_THRESHOLD", 0)
+    # Merge resource values in database if it supports JSON (SQLite with
+    # JSON1 or PostgreSQL). Requires all stored documents to be uncompressed
+    app.config.setdefault("VALUES_SQL_MERGE", False)
+    # Read resource values from snapshots stored along with them instead of
+    # merging all levels. Snapshots are maintained on writes in any case
+    app.config.setdefault("VALUES_SNAPSHOTS", True)
+    # Store values of top-level keys separately too and read only needed
+    # ones for ?keys= projections. Values written before it was enabled are
+    # filled with "tuning_box-manage keys rebuild --values"
+    app.config.setdefault("VALUES_KEY_STORAGE", False)
+    # Number of values rows fetched at once when exporting an environment
+    app.config.setdefault("EXPORT_CHUNK_SIZE", 1000)
+    # Number of values records written and committed at once on import
+    app.config.setdefault("IMPORT_CHUNK_SIZE", 1000)
+    # Seconds between background collections of orphaned level values,
+    # 0 disables them. Collection can be run with "tuning_box-manage gc" too
+    app.config.setdefault("LEVEL_VALUES_GC_INTERVAL", 0)
+    # Number of level values checked and deleted in one transaction
+    app.config.setdefault("LEVEL_VALUES_GC_BATCH_SIZE", 1000)
     db.db.init_app(app)
+
+    @app.before_first_request
+    def start_background_jobs():
+        # config isn't final until the app is running
+        if app.config['LEVEL_VALUES_GC_INTERVAL']:
+            start_level_values_gc(app, app.config['LEVEL_VALUES_GC_INTERVAL'])
+
     return app
 
 
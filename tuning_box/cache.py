@@ -0,0 +1,116 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import threading
+
+
+class ValuesCache(object):
+    """Bounded LRU cache of resolved resource values.
+
+    Keys are (environment_id, resource_definition_id, levels) tuples where
+    levels is a tuple of (level name, level value) pairs. A cache with
+    maxsize of 0 is disabled and never stores anything.
+
+    Every invalidation bumps generation. Readers should remember generation
+    before hitting the database and pass it to set() so that a result
+    computed from data that was changed meanwhile is not stored.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.generation = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value  # mark as most recently used
+            return value
+
+    def set(self, key, value, generation):
+        if not self.maxsize:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, environment_id=None, resource_definition_id=None,
+                   levels=()):
+        """Drop all entries affected by a change of matching values.
+
+        None for environment_id or resource_definition_id matches any value.
+        Entries are dropped if levels is a prefix of their level path, so
+        a change on some level invalidates all levels below it.
+        """
+        levels = tuple(levels)
+        with self._lock:
+            self.generation += 1
+            for key in list(self._data):
+                env_id, resdef_id, key_levels = key
+                if environment_id is not None and env_id != environment_id:
+                    continue
+                if (resource_definition_id is not None and
+                        resdef_id != resource_definition_id):
+                    continue
+                if key_levels[:len(levels)] != levels:
+                    continue
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+
+class ResourceDefinitionsCache(object):
+    """Resource definitions of each environment by their ids and names.
+
+    Values are dicts mapping both id and name of every resource definition
+    of environment to (id, name) pair. Components are rarely created or
+    deleted, so such changes simply drop all cached data.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.generation = 0
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, environment_id):
+        return self._data.get(environment_id)
+
+    def set(self, environment_id, value, generation):
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation == self.generation:
+                self._data[environment_id] = value
+
+    def invalidate(self, environment_id=None):
+        with self._lock:
+            self.generation += 1
+            if environment_id is None:
+                self._data.clear()
+            else:
+                self._data.pop(environment_id, None)
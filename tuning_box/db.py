@@ -10,16 +10,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import datetime
 import functools
-import json
+import itertools
 import re
 
 import flask
 import flask_sqlalchemy
 import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative as sa_decl
 from sqlalchemy import types
 
+from tuning_box import jsoncodec
+
 try:
     from importlib import reload
 except ImportError:
@@ -43,6 +48,19 @@ class BaseQuery(flask_sqlalchemy.BaseQuery):
             flask.abort(404)
         return result
 
+    def get_id_by_id_or_name(self, id_or_name):
+        """Like get_by_id_or_name, but fetch only id of the object"""
+        model = self.column_descriptions[0]['entity']
+        query = self.with_entities(model.id)
+        result = None
+        if isinstance(id_or_name, int):
+            result = query.filter(model.id == id_or_name).scalar()
+        if result is None:
+            result = query.filter(model.name == id_or_name).scalar()
+        if result is None:
+            flask.abort(404)
+        return result
+
     if not hasattr(flask_sqlalchemy.BaseQuery, 'one_or_none'):
         # for sqlalchemy < 1.0.9
         from sqlalchemy.orm import exc as orm_exc  # noqa
@@ -96,10 +114,12 @@ class Json(types.TypeDecorator):
     impl = db.Text
 
     def process_bind_param(self, value, dialect):
-        return json.dumps(value)
+        return jsoncodec.get_codec().dumps(value)
 
     def process_result_value(self, value, dialect):
-        return json.loads(value)
+        if value is None:
+            return None
+        return jsoncodec.get_codec().loads(value)
 
 
 # Component registry
@@ -115,10 +135,28 @@ class ResourceDefinition(ModelMixin, db.Model):
     name = db.Column(db.String(128))
     component_id = fk(Component)
     component = db.relationship(Component, backref='resource_definitions')
-    content = db.Column(Json)
+    # Schemas can be big and most users need only ids, so load it on demand
+    content = db.deferred(db.Column(Json))
 
     __repr_attrs__ = ('id', 'name', 'component', 'content')
 
+    @classmethod
+    def query_for_environment(cls, environment):
+        """Query resource definitions of components of environment"""
+        components_table = Environment.environment_components_table
+        return cls.query.join(
+            components_table,
+            components_table.c.component_id == cls.component_id,
+        ).filter(
+            components_table.c.environment_id == environment.id,
+        )
+
+    @classmethod
+    def get_names_for_environment(cls, environment):
+        """Get (id, name) pairs of resource definitions of environment"""
+        return cls.query_for_environment(environment).with_entities(
+            cls.id, cls.name).all()
+
 # Environment data storage
 
 
@@ -162,13 +200,13 @@ class EnvironmentHierarchyLevel(ModelMixin, db.Model):
 
     @classmethod
     def get_for_environment(cls, environment):
-        query = cls.query.filter_by(environment=environment, parent=None)
-        root_level = query.one_or_none()
-        if not root_level:
-            return []
-        env_levels = [root_level]
-        while env_levels[-1].child:
-            env_levels.append(env_levels[-1].child)
+        levels = cls.query.filter_by(environment=environment).all()
+        levels_by_parent = {level.parent_id: level for level in levels}
+        env_levels = []
+        level = levels_by_parent.get(None)
+        while level:
+            env_levels.append(level)
+            level = levels_by_parent.get(level.id)
         return env_levels
 
 
@@ -176,6 +214,8 @@ class EnvironmentHierarchyLevelValue(ModelMixin, db.Model):
     level_id = fk(EnvironmentHierarchyLevel)
     level = db.relationship(EnvironmentHierarchyLevel)
     value = db.Column(db.String(128))
+    # Materialized path from the root, like "rack/3/node/17", "" for root
+    path = db.Column(db.String(1024))
 
     @sa_decl.declared_attr
     def parent_id(cls):
@@ -185,8 +225,120 @@ class EnvironmentHierarchyLevelValue(ModelMixin, db.Model):
     def parent(cls):
         return db.relationship(cls, remote_side=cls.id)
 
+    @sa_decl.declared_attr
+    def __table_args__(cls):
+        return (
+            db.Index(cls.__tablename__ + '_parent_idx',
+                     'level_id', 'parent_id', 'value', unique=True),
+            db.Index(cls.__tablename__ + '_path_idx',
+                     'path', 'level_id', unique=True),
+            # NULLs are distinct in unique indexes, so the index above
+            # doesn't stop concurrent writers from creating several roots
+            db.Index(cls.__tablename__ + '_root_idx', 'path', unique=True,
+                     postgresql_where=sqlalchemy.text('level_id IS NULL'),
+                     sqlite_where=sqlalchemy.text('level_id IS NULL')),
+            # for lookups of children, e.g. in collect_level_values
+            db.Index(cls.__tablename__ + '_children_idx', 'parent_id'),
+        )
+
     __repr_attrs__ = ('id', 'level', 'parent', 'value')
 
+    @staticmethod
+    def build_path(levels):
+        """Build materialized path from (level name, level value) pairs"""
+        return '/'.join(itertools.chain.from_iterable(levels))
+
+    @staticmethod
+    def split_path(path):
+        """Split materialized path into (level name, level value) pairs"""
+        parts = path.split('/') if path else []
+        return list(zip(parts[::2], parts[1::2]))
+
+    @staticmethod
+    def parent_paths(path):
+        """Materialized paths of all ancestors of path, root first"""
+        parts = path.split('/') if path else []
+        return ['/'.join(parts[:i]) for i in range(0, len(parts), 2)]
+
+    @classmethod
+    def filter_paths(cls, env_levels, paths):
+        """Build filter matching level values with given materialized paths"""
+        conditions = []
+        if '' in paths:
+            conditions.append(db.and_(cls.level_id.is_(None), cls.path == ''))
+        paths = [path for path in paths if path]
+        if paths:
+            conditions.append(db.and_(
+                cls.level_id.in_([env_level.id for env_level in env_levels]),
+                cls.path.in_(paths),
+            ))
+        return db.or_(*conditions)
+
+    @classmethod
+    def get_chain(cls, env_levels, values, lock=False):
+        """Find existing level values along the path in one query.
+
+        Returns list of level values starting from the root one. It stops at
+        the first level value that doesn't exist yet, so it can be shorter
+        than values. Writers should lock them, see collect_level_values.
+        """
+        levels = [(env_level.name, value)
+                  for env_level, value in zip(env_levels, values)]
+        paths = [cls.build_path(levels[:i]) for i in range(len(levels) + 1)]
+        query = cls.query.filter(cls.filter_paths(env_levels, paths))
+        if lock:
+            query = query.with_for_update(read=True)
+        by_path = {}
+        for level_value in query:
+            by_path.setdefault(level_value.path, level_value)
+        chain = []
+        for path in paths:
+            try:
+                chain.append(by_path[path])
+            except KeyError:
+                break
+        return chain
+
+    @classmethod
+    def get_or_create_ids(cls, env_levels, level_paths):
+        """Find or create level values for many level paths in bulk.
+
+        level_paths are tuples of (level name, level value) pairs already
+        checked against env_levels. Returns dict that maps each of them and
+        all their prefixes to level value id. Missing level values are
+        inserted with one executemany per depth. Existing ones are locked
+        for writing values to them, see collect_level_values.
+        """
+        prefixes = set()
+        for levels in level_paths:
+            prefixes.update(levels[:i] for i in range(len(levels) + 1))
+        levels_by_path = {cls.build_path(levels): levels
+                          for levels in prefixes}
+        ids = {}
+
+        def load_ids(paths):
+            for chunk in iter_chunks(paths):
+                query = db.session.query(cls.id, cls.path).filter(
+                    cls.filter_paths(env_levels, chunk),
+                ).with_for_update(read=True)
+                for level_value_id, path in query:
+                    ids.setdefault(levels_by_path[path], level_value_id)
+
+        load_ids(list(levels_by_path))
+        missing = sorted((levels for levels in prefixes if levels not in ids),
+                         key=len)
+        for depth, group in itertools.groupby(missing, key=len):
+            group = list(group)
+            # some of them could be created by concurrent writers meanwhile
+            upsert(cls.__table__, [{
+                'level_id': env_levels[depth - 1].id if depth else None,
+                'parent_id': ids[levels[:-1]] if depth else None,
+                'value': levels[-1][1] if depth else None,
+                'path': cls.build_path(levels),
+            } for levels in group])
+            load_ids([cls.build_path(levels) for levels in group])
+        return ids
+
 
 class ResourceValues(ModelMixin, db.Model):
     environment_id = fk(Environment)
@@ -196,25 +348,652 @@ class ResourceValues(ModelMixin, db.Model):
     level_value_id = fk(EnvironmentHierarchyLevelValue)
     level_value = db.relationship('EnvironmentHierarchyLevelValue')
     values = db.Column(Json)
+    # Values merged along the level path from the root down to this row
+    snapshot = db.Column(Json)
+    # Both are updated on every UPDATE, including bulk ones
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1',
+                        onupdate=sqlalchemy.literal_column('version') + 1)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+
+    @sa_decl.declared_attr
+    def __table_args__(cls):
+        return (
+            db.UniqueConstraint('environment_id', 'resource_definition_id',
+                                'level_value_id'),
+            db.Index(cls.__tablename__ + '_level_value_idx',
+                     'level_value_id', 'resource_definition_id'),
+        )
 
-    __table_args__ = (
-        db.UniqueConstraint(environment_id, resource_definition_id,
-                            level_value_id),
-    )
     __repr_attrs__ = ('id', 'environment', 'resource_definition',
                       'level_value', 'values')
 
+    @classmethod
+    def set_values(cls, environment_id, items, version=1):
+        """Set values of many (resource definition id, level value id).
+
+        items are (resource definition id, level value id, values) tuples.
+        Existing rows are updated and get their version bumped, missing ones
+        are inserted with given version. Keys are refreshed along with them,
+        snapshots are not.
+        """
+        items = list(items)
+        lock_resource_values(environment_id,
+                             [resdef_id for resdef_id, _, _ in items])
+        now = datetime.datetime.utcnow()
+        upsert(cls.__table__, [{
+            'environment_id': environment_id,
+            'resource_definition_id': resdef_id,
+            'level_value_id': level_value_id,
+            'values': values,
+            'version': version,
+            'updated_at': now,
+        } for resdef_id, level_value_id, values in items],
+            conflict_columns=('environment_id', 'resource_definition_id',
+                              'level_value_id'),
+            update_columns=('values', 'updated_at'),
+            increment_columns=('version',))
+        ResourceValuesKey.refresh(environment_id, items)
+
+    @classmethod
+    def refresh_snapshots(cls, environment_id, resource_definition_id,
+                          paths, written=True, dry_run=False):
+        """Recompute snapshots of rows on level value paths and below them.
+
+        Snapshots are computed from values of rows only, stored snapshots of
+        ancestors are not trusted. If written is True, rows on paths are
+        supposed to be just written and keep their version. Version of other
+        changed rows is bumped since their effective values changed.
+
+        Returns ids of rows whose snapshots were changed, or would be if
+        dry_run is True.
+        """
+        if not dry_run:
+            lock_resource_values(environment_id, [resource_definition_id])
+        level_value_cls = EnvironmentHierarchyLevelValue
+        paths = set(paths)
+        roots = set(path for path in paths if not any(
+            parent in paths for parent in level_value_cls.parent_paths(path)))
+
+        def in_subtree(path):
+            return path in roots or any(
+                parent in roots
+                for parent in level_value_cls.parent_paths(path))
+
+        query = db.session.query(
+            cls.id, cls.version, cls.values, cls.snapshot,
+            level_value_cls.path,
+        ).join(
+            level_value_cls, level_value_cls.id == cls.level_value_id,
+        ).filter(
+            cls.environment_id == environment_id,
+            cls.resource_definition_id == resource_definition_id,
+        )
+        if '' not in roots and len(roots) <= MAX_SUBTREE_FILTERS:
+            ancestors = set(roots)
+            for root in roots:
+                ancestors.update(level_value_cls.parent_paths(root))
+            query = query.filter(db.or_(
+                level_value_cls.path.in_(ancestors),
+                *[level_value_cls.path.startswith(root + '/', autoescape=True)
+                  for root in roots]
+            ))
+        # ancestor paths are shorter, so they are merged before descendants
+        rows = sorted(query, key=lambda row: len(row.path))
+        snapshots = {}
+        changes = []
+        for row in rows:
+            snapshot = {}
+            for parent in reversed(level_value_cls.parent_paths(row.path)):
+                if parent in snapshots:
+                    snapshot.update(snapshots[parent])
+                    break
+            snapshot.update(row.values or {})
+            snapshots[row.path] = snapshot
+            if in_subtree(row.path) and snapshot != row.snapshot:
+                version = row.version
+                if not (written and row.path in paths):
+                    version += 1
+                changes.append({
+                    'id': row.id,
+                    'snapshot': snapshot,
+                    'version': version,
+                })
+        if not dry_run:
+            db.session.bulk_update_mappings(cls, changes)
+        return [change['id'] for change in changes]
+
+    @classmethod
+    def merge_in_database(cls, environment_id, resource_definition_id,
+                          level_value_ids):
+        """Merge values along level values in database.
+
+        Returns the same document as merging them in Python, but only
+        winning keys are sent from database. Values must be stored as plain
+        JSON objects and supports_merge_in_database() must be True. Returns
+        None if database can't merge them exactly, see MERGE_VALUES_SQL.
+        """
+        if not level_value_ids:
+            return {}
+        sql = MERGE_VALUES_SQL[db.session.get_bind().dialect.name].format(
+            values=cls.__tablename__,
+            level_value=EnvironmentHierarchyLevelValue.__tablename__,
+        )
+        statement = sqlalchemy.text(sql).bindparams(
+            sqlalchemy.bindparam('level_value_ids', expanding=True))
+        document = db.session.execute(statement, {
+            'environment_id': environment_id,
+            'resource_definition_id': resource_definition_id,
+            'level_value_ids': list(level_value_ids),
+        }).scalar()
+        if document is None:
+            return None
+        return jsoncodec.get_codec().loads(document)
+
+
+def store_key_values():
+    """Whether values of top-level keys are stored in ResourceValuesKey"""
+    return (flask.has_app_context() and
+            flask.current_app.config.get('VALUES_KEY_STORAGE', False))
+
+
+class ResourceValuesKey(ModelMixin, db.Model):
+    """Key path present in values of resource on level value.
+
+    Key paths are keys of nested objects joined with dots, e.g. values
+    {"nova": {"cpu_allocation_ratio": 16}} have "nova" and
+    "nova.cpu_allocation_ratio". They let find level values that override
+    a key without decoding all values.
+
+    If VALUES_KEY_STORAGE is set, rows of top-level keys also store their
+    values, so that a few keys can be resolved without decoding whole
+    values. value is NULL if it's not stored.
+    """
+    environment_id = fk(Environment)
+    resource_definition_id = fk(ResourceDefinition)
+    level_value_id = fk(EnvironmentHierarchyLevelValue)
+    key = db.Column(db.String(255))
+    value = db.Column(Json)
+
+    @sa_decl.declared_attr
+    def __table_args__(cls):
+        return (
+            db.UniqueConstraint('environment_id', 'resource_definition_id',
+                                'key', 'level_value_id'),
+            db.Index(cls.__tablename__ + '_level_value_idx',
+                     'level_value_id', 'resource_definition_id'),
+        )
+
+    __repr_attrs__ = ('id', 'environment_id', 'resource_definition_id',
+                      'level_value_id', 'key')
+
+    @classmethod
+    def key_paths(cls, values, prefix=''):
+        """Iterate over key paths in values, longer ones are skipped"""
+        if not isinstance(values, dict):
+            return
+        for key, value in values.items():
+            path = prefix + key
+            if len(path) > cls.key.type.length:
+                continue
+            yield path
+            for sub_path in cls.key_paths(value, path + '.'):
+                yield sub_path
+
+    @classmethod
+    def refresh(cls, environment_id, items):
+        """Replace keys of values rows.
+
+        items are (resource definition id, level value id, values) tuples
+        like in ResourceValues.set_values, the last one wins for duplicates.
+        """
+        values_by_row = dict(((resdef_id, level_value_id), values)
+                             for resdef_id, level_value_id, values in items)
+        level_value_ids = collections.defaultdict(list)
+        for resdef_id, level_value_id in values_by_row:
+            level_value_ids[resdef_id].append(level_value_id)
+        table = cls.__table__
+        for resdef_id, ids in level_value_ids.items():
+            for chunk in iter_chunks(ids):
+                db.session.execute(table.delete().where(db.and_(
+                    table.c.environment_id == environment_id,
+                    table.c.resource_definition_id == resdef_id,
+                    table.c.level_value_id.in_(chunk),
+                )))
+        store_values = store_key_values()
+        rows = []
+        value_rows = []
+        for (resdef_id, level_value_id), values in values_by_row.items():
+            for key in set(cls.key_paths(values)):
+                row = {
+                    'environment_id': environment_id,
+                    'resource_definition_id': resdef_id,
+                    'level_value_id': level_value_id,
+                    'key': key,
+                }
+                if store_values and '.' not in key:  # top-level key
+                    row['value'] = values[key]
+                    value_rows.append(row)
+                else:
+                    rows.append(row)
+        # rows without value key leave it NULL, not JSON null
+        for batch in (rows, value_rows):
+            if batch:
+                db.session.execute(table.insert(), batch)
+
+
+# Above that many subtrees refresh_snapshots loads all rows of a resource
+# instead of building huge filter
+MAX_SUBTREE_FILTERS = 50
+
+# Merge JSON objects of resource values rows along a level values chain, keys
+# of deeper level values (with longer paths) override keys of upper ones.
+# Returns merged JSON object as text, or NULL if database can't merge these
+# documents exactly. Stdlib json writes NaN and Infinity, which are not JSON
+# for databases, so such rows are checked before the merge is evaluated.
+MERGE_VALUES_SQL = {
+    # Bare columns of aggregate query with max() come from the row with the
+    # largest value, so that picks each key from the deepest level value.
+    # Values of json_each() are SQL values that lose precision of numbers,
+    # -> returns original JSON text of the member instead. JSON paths can't
+    # address keys with double quotes, -> returns NULL for them.
+    'sqlite': """
+        SELECT CASE WHEN EXISTS (
+            SELECT 1
+            FROM {values} AS rv
+            WHERE rv.environment_id = :environment_id
+              AND rv.resource_definition_id = :resource_definition_id
+              AND rv.level_value_id IN :level_value_ids
+              AND NOT json_valid(rv."values")
+        ) THEN NULL ELSE (
+            SELECT CASE WHEN count(*) = count(value) THEN
+                '{{' || coalesce(group_concat(
+                    json_quote(key) || ':' || value, ','), '') || '}}'
+            END
+            FROM (
+                SELECT j.key AS key,
+                       rv."values" -> j.fullkey AS value,
+                       max(length(lv.path)) AS depth
+                FROM {values} AS rv
+                JOIN {level_value} AS lv ON lv.id = rv.level_value_id
+                JOIN json_each(rv."values") AS j
+                WHERE rv.environment_id = :environment_id
+                  AND rv.resource_definition_id = :resource_definition_id
+                  AND rv.level_value_id IN :level_value_ids
+                GROUP BY j.key
+            ) AS merged
+        ) END
+    """,
+    # jsonb also rejects \u0000 escapes, the check is textual and may
+    # reject some valid documents too, they are merged in Python then.
+    'postgresql': """
+        SELECT CASE WHEN EXISTS (
+            SELECT 1
+            FROM {values} AS rv
+            WHERE rv.environment_id = :environment_id
+              AND rv.resource_definition_id = :resource_definition_id
+              AND rv.level_value_id IN :level_value_ids
+              AND rv."values" ~ '(NaN|Infinity|\\\\u0000)'
+        ) THEN NULL ELSE (
+            SELECT coalesce(jsonb_object_agg(key, value), '{{}}'::jsonb)::text
+            FROM (
+                SELECT DISTINCT ON (j.key) j.key AS key, j.value AS value
+                FROM {values} AS rv
+                JOIN {level_value} AS lv ON lv.id = rv.level_value_id
+                CROSS JOIN LATERAL jsonb_each(rv."values"::jsonb) AS j
+                WHERE rv.environment_id = :environment_id
+                  AND rv.resource_definition_id = :resource_definition_id
+                  AND rv.level_value_id IN :level_value_ids
+                ORDER BY j.key, length(lv.path) DESC
+            ) AS merged
+        ) END
+    """,
+}
+
+
+def clone_environment(environment):
+    """Copy environment with its levels and values, return the copy.
+
+    Only the hierarchy levels chain is copied with ORM. Level values,
+    resource values and their keys are copied with one INSERT ... SELECT
+    per level, that maps old level values to new ones by their level and
+    path. The root level value is shared by all environments and is not
+    copied.
+    """
+    clone = Environment()
+    db.session.add(clone)
+    env_levels = EnvironmentHierarchyLevel.get_for_environment(environment)
+    clone_levels = []
+    level = None
+    for env_level in env_levels:
+        level = EnvironmentHierarchyLevel(environment=clone,
+                                          name=env_level.name, parent=level)
+        clone_levels.append(level)
+    db.session.flush()
+
+    components_table = Environment.environment_components_table
+    db.session.execute(components_table.insert().from_select(
+        ['environment_id', 'component_id'],
+        sqlalchemy.select([
+            sqlalchemy.literal(clone.id, pk_type),
+            components_table.c.component_id,
+        ]).where(components_table.c.environment_id == environment.id),
+    ))
+
+    level_values = EnvironmentHierarchyLevelValue.__table__
+    old = level_values.alias('old_level_value')
+    new = level_values.alias('new_level_value')
+    old_parent = level_values.alias('old_parent')
+    new_parent = level_values.alias('new_parent')
+    for depth, env_level in enumerate(env_levels):
+        if depth:
+            parent_id = new_parent.c.id
+            from_obj = old.join(
+                old_parent, old_parent.c.id == old.c.parent_id,
+            ).join(new_parent, db.and_(
+                new_parent.c.level_id == clone_levels[depth - 1].id,
+                new_parent.c.path == old_parent.c.path,
+            ))
+        else:
+            parent_id = old.c.parent_id  # the root
+            from_obj = old
+        db.session.execute(level_values.insert().from_select(
+            ['level_id', 'parent_id', 'value', 'path'],
+            sqlalchemy.select([
+                sqlalchemy.literal(clone_levels[depth].id, pk_type),
+                parent_id,
+                old.c.value,
+                old.c.path,
+            ]).select_from(from_obj).where(old.c.level_id == env_level.id),
+        ))
+
+    for table in [ResourceValues.__table__, ResourceValuesKey.__table__]:
+        copied_columns = [column.name for column in table.columns
+                          if column.name not in ('id', 'environment_id',
+                                                 'level_value_id')]
+        for depth in range(len(env_levels) + 1):
+            from_obj = table.join(old, old.c.id == table.c.level_value_id)
+            if depth:
+                level_value_id = new.c.id
+                from_obj = from_obj.join(new, db.and_(
+                    new.c.level_id == clone_levels[depth - 1].id,
+                    new.c.path == old.c.path,
+                ))
+                level_filter = old.c.level_id == env_levels[depth - 1].id
+            else:
+                level_value_id = table.c.level_value_id
+                level_filter = old.c.level_id.is_(None)
+            db.session.execute(table.insert().from_select(
+                ['environment_id', 'level_value_id'] + copied_columns,
+                sqlalchemy.select([
+                    sqlalchemy.literal(clone.id, pk_type),
+                    level_value_id,
+                ] + [table.c[name] for name in copied_columns],
+                ).select_from(from_obj).where(db.and_(
+                    table.c.environment_id == environment.id,
+                    level_filter,
+                )),
+            ))
+    return clone
+
+
+def delete_environment(environment_id):
+    """Delete environment with everything that belongs to it.
+
+    Rows are deleted with one statement per table, children first, without
+    loading them into the session. The shared root level value stays.
+    """
+    levels = EnvironmentHierarchyLevel.__table__
+    level_ids = sqlalchemy.select([levels.c.id]).where(
+        levels.c.environment_id == environment_id)
+    resource_values = ResourceValues.__table__
+    keys = ResourceValuesKey.__table__
+    level_values = EnvironmentHierarchyLevelValue.__table__
+    components_table = Environment.environment_components_table
+    for statement in [
+        keys.delete().where(keys.c.environment_id == environment_id),
+        resource_values.delete().where(
+            resource_values.c.environment_id == environment_id),
+        level_values.delete().where(level_values.c.level_id.in_(level_ids)),
+        levels.delete().where(levels.c.environment_id == environment_id),
+        components_table.delete().where(
+            components_table.c.environment_id == environment_id),
+        Environment.__table__.delete().where(
+            Environment.__table__.c.id == environment_id),
+    ]:
+        db.session.execute(statement)
+
+
+def delete_component(component_id):
+    """Delete component with its resource definitions and their values.
+
+    Like delete_environment it runs one statement per table. Returns ids of
+    deleted resource definitions.
+    """
+    resource_definitions = ResourceDefinition.__table__
+    resdef_ids = [row.id for row in db.session.execute(
+        sqlalchemy.select([resource_definitions.c.id]).where(
+            resource_definitions.c.component_id == component_id))]
+    resource_values = ResourceValues.__table__
+    keys = ResourceValuesKey.__table__
+    components_table = Environment.environment_components_table
+    for chunk in iter_chunks(resdef_ids):
+        db.session.execute(keys.delete().where(
+            keys.c.resource_definition_id.in_(chunk)))
+        db.session.execute(resource_values.delete().where(
+            resource_values.c.resource_definition_id.in_(chunk)))
+    for statement in [
+        components_table.delete().where(
+            components_table.c.component_id == component_id),
+        resource_definitions.delete().where(
+            resource_definitions.c.component_id == component_id),
+        Component.__table__.delete().where(
+            Component.__table__.c.id == component_id),
+    ]:
+        db.session.execute(statement)
+    return resdef_ids
+
+
+def collect_level_values(batch_size=1000):
+    """Delete level values with no resource values in their subtrees.
+
+    Level values are created for every written level path and are never
+    deleted along with values, so they pile up. Candidates are checked
+    batch_size at a time in descending order of id, so that children are
+    checked before their parents, and every batch is committed separately
+    to keep locks short. Conditions are checked in the DELETE itself, so
+    level values that get new resource values meanwhile are left alone.
+    The root level value is never deleted.
+
+    Writers must not get a level value deleted between resolving it and
+    committing values to it. On PostgreSQL they lock level values they
+    resolve with FOR SHARE, so the DELETE waits for them and then fails on
+    the foreign key of new values, such batch is rolled back and checked
+    again on the next pass. On SQLite writers take the database write lock
+    with lock_resource_values before resolving level values.
+
+    Returns number of deleted level values.
+    """
+    level_values = EnvironmentHierarchyLevelValue.__table__
+    children = level_values.alias('children')
+    resource_values = ResourceValues.__table__
+    is_orphan = db.and_(
+        ~sqlalchemy.exists().where(
+            resource_values.c.level_value_id == level_values.c.id),
+        ~sqlalchemy.exists().where(
+            children.c.parent_id == level_values.c.id),
+    )
+    deleted = 0
+    while True:
+        # Parents left after their children were deleted in the same
+        # batch are caught on the next pass
+        pass_deleted = 0
+        conflicts = False
+        last_id = None
+        while True:
+            query = sqlalchemy.select([level_values.c.id]).where(
+                level_values.c.level_id.isnot(None),
+            ).order_by(level_values.c.id.desc()).limit(batch_size)
+            if last_id is not None:
+                query = query.where(level_values.c.id < last_id)
+            ids = [row.id for row in db.session.execute(query)]
+            if not ids:
+                break
+            last_id = ids[-1]
+            try:
+                result = db.session.execute(level_values.delete().where(
+                    db.and_(level_values.c.id.in_(ids), is_orphan)))
+                db.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # a writer has just committed values to one of them
+                db.session.rollback()
+                conflicts = True
+                continue
+            pass_deleted += result.rowcount
+        deleted += pass_deleted
+        if not pass_deleted and not conflicts:
+            return deleted
+
+
+def iter_chunks(items, size=500):
+    """Split items into lists small enough for IN clause or executemany"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def supports_upsert():
+    """Whether database supports INSERT ... ON CONFLICT"""
+    dialect = db.session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        return dialect.server_version_info >= (9, 5)
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def lock_resource_values(environment_id, resource_definition_ids):
+    """Lock values of resources in environment until end of transaction.
+
+    Writers take it before they resolve level values. Snapshots and
+    versions are computed from all rows of a resource, so writers of
+    different rows of it must not interleave. PostgreSQL gets a transaction
+    level advisory lock per resource, taken in order of ids to avoid
+    deadlocks. SQLite lets only one writer in at a time, a write that
+    changes nothing takes that lock right away, so that level values read
+    after it can't be deleted by collect_level_values meanwhile. Taking a
+    lock again is a no-op.
+    """
+    dialect_name = db.session.get_bind().dialect.name
+    if dialect_name == 'sqlite':
+        table = ResourceValues.__table__
+        db.session.execute(table.update().where(sqlalchemy.false()).values(
+            version=table.c.version))
+        return
+    if dialect_name != 'postgresql':
+        return
+    table_name = ResourceValues.__tablename__
+    for resdef_id in sorted(set(resource_definition_ids)):
+        db.session.execute(
+            sqlalchemy.text('SELECT pg_advisory_xact_lock(hashtext(:key))'),
+            {'key': '%s:%d:%d' % (table_name, environment_id, resdef_id)})
+
+
+def supports_merge_in_database():
+    """Whether ResourceValues.merge_in_database works with database"""
+    dialect = db.session.get_bind().dialect
+    if dialect.name == 'sqlite':
+        # -> operator keeps JSON text of members
+        return dialect.dbapi.sqlite_version_info >= (3, 38, 0)
+    return dialect.name in MERGE_VALUES_SQL
+
+
+def upsert(table, rows, conflict_columns=None, update_columns=(),
+           increment_columns=()):
+    """Insert rows into table letting database resolve conflicts.
+
+    Existing rows that conflict with new ones on unique index over
+    conflict_columns get update_columns set from new rows and
+    increment_columns incremented. Without columns to update conflicting
+    rows are skipped, then conflict_columns may be None to skip rows that
+    violate any unique constraint.
+
+    All rows are sent in one executemany of INSERT ... ON CONFLICT, so
+    concurrent writers can't make it fail with IntegrityError. Databases
+    that don't support it get one INSERT in a savepoint per row instead.
+    """
+    if not rows:
+        return
+    columns = list(rows[0])
+    if not supports_upsert():
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert(), row)
+            except sqlalchemy.exc.IntegrityError:
+                if not (update_columns or increment_columns):
+                    continue
+                values = {name: row[name] for name in update_columns}
+                for name in increment_columns:
+                    values[name] = table.c[name] + 1
+                db.session.execute(table.update().where(db.and_(*[
+                    table.c[name] == row[name] for name in conflict_columns
+                ])).values(values))
+        return
+    quote = db.session.get_bind().dialect.identifier_preparer.quote
+    sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT' % (
+        quote(table.name),
+        ', '.join(quote(name) for name in columns),
+        ', '.join(':' + name for name in columns),
+    )
+    if conflict_columns:
+        sql += ' (%s)' % (', '.join(quote(name) for name in conflict_columns),)
+    if update_columns or increment_columns:
+        sql += ' DO UPDATE SET ' + ', '.join(
+            ['%s = excluded.%s' % (quote(name), quote(name))
+             for name in update_columns] +
+            ['%s = %s.%s + 1' % (quote(name), quote(table.name), quote(name))
+             for name in increment_columns])
+    else:
+        sql += ' DO NOTHING'
+    statement = sqlalchemy.text(sql).bindparams(*[
+        sqlalchemy.bindparam(name, type_=table.c[name].type)
+        for name in columns])
+    db.session.execute(statement, rows)
+
 
 def get_or_create(cls, **attrs):
-    with db.session.begin(nested=True):
-        item = cls.query.filter_by(**attrs).one_or_none()
-        if not item:
-            item = cls(**attrs)
-            db.session.add(item)
+    """Get item with attrs or create it, concurrent creators don't fail.
+
+    attrs may contain many-to-one relationships, related items are flushed
+    by the first query and stored by their foreign keys.
+    """
+    item = cls.query.filter_by(**attrs).first()
+    if item is None:
+        mapper = sqlalchemy.inspect(cls)
+        row = {}
+        for name, value in attrs.items():
+            if name not in mapper.relationships:
+                row[mapper.columns[name].name] = value
+                continue
+            relationship = mapper.relationships[name]
+            for local, remote in relationship.local_remote_pairs:
+                row[local.name] = None if value is None else getattr(
+                    value,
+                    relationship.mapper.get_property_by_column(remote).key)
+        upsert(cls.__table__, [row])
+        item = cls.query.filter_by(**attrs).first()
     return item
 
 
-def fix_sqlite():
+def fix_sqlite(immediate=False):
+    """Make pysqlite run transactions the way SQLAlchemy expects.
+
+    With immediate transactions take the write lock right away, so that
+    concurrent writers wait for each other instead of deadlocking when
+    upgrading their read locks.
+    """
     engine = db.engine
 
     @sqlalchemy.event.listens_for(engine, "connect")
@@ -223,7 +1002,7 @@ def fix_sqlite():
 
     @sqlalchemy.event.listens_for(engine, "begin")
     def _begin(conn):
-        conn.execute("BEGIN")
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
 
 
 def prefix_tables(module, prefix):
@@ -0,0 +1,139 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import
+
+import base64
+import json
+import re
+import zlib
+
+import flask
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+ZLIB_PREFIX = 'zlib:'
+
+
+# Tokens that fast backends read differently from stdlib json: integers
+# that may not fit in 64 bits (read as floats or rejected) and NaN and
+# Infinity (rejected). Matches inside strings only cost a slower decode.
+_STDLIB_ONLY_RE = re.compile(r'\d{19}|NaN|Infinity')
+
+
+def _orjson_dumps(value):
+    try:
+        data = orjson.dumps(value)
+    except TypeError:
+        # e.g. integers that do not fit in 64 bits
+        return json.dumps(value)
+    if b'null' in data:
+        # orjson writes NaN and Infinity as null, stdlib keeps them
+        return json.dumps(value)
+    return data.decode('utf-8')
+
+
+def _ujson_dumps(value):
+    try:
+        return ujson.dumps(value)
+    except (OverflowError, TypeError, ValueError):
+        # integers that do not fit in 64 bits, NaN or Infinity
+        return json.dumps(value)
+
+
+def _fallback_loads(loads):
+    def _loads(data):
+        if _STDLIB_ONLY_RE.search(data):
+            return json.loads(data)
+        return loads(data)
+    return _loads
+
+
+BACKENDS = {
+    'json': (json.dumps, json.loads),
+}
+if orjson is not None:
+    BACKENDS['orjson'] = (_orjson_dumps, _fallback_loads(orjson.loads))
+if ujson is not None:
+    BACKENDS['ujson'] = (_ujson_dumps, _fallback_loads(ujson.loads))
+
+# Preferred backends for 'auto', the fastest first
+AUTO_ORDER = ('orjson', 'ujson', 'json')
+
+
+class JsonCodec(object):
+    """Encode values to JSON text and back.
+
+    backend is one of BACKENDS or 'auto' to pick the fastest installed one.
+    Every backend reads and writes the same values as stdlib json, falling
+    back to it for big integers and non-finite floats.
+    If compress_threshold is positive, encoded documents of at least that
+    many characters are compressed with zlib and stored base64-encoded
+    after ZLIB_PREFIX. No JSON document can start with it, so plain rows
+    written before compression was enabled are still read as is.
+    """
+
+    def __init__(self, backend='auto', compress_threshold=0,
+                 compress_level=6):
+        if backend == 'auto':
+            backend = next(name for name in AUTO_ORDER if name in BACKENDS)
+        try:
+            self._dumps, self._loads = BACKENDS[backend]
+        except KeyError:
+            raise ValueError("JSON backend %r is not available. Expected "
+                             "one of: %s." % (backend,
+                                              ', '.join(sorted(BACKENDS))))
+        self.backend = backend
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        data = self._dumps(value)
+        if self.compress_threshold and len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data.encode('utf-8'),
+                                       self.compress_level)
+            data = ZLIB_PREFIX + base64.b64encode(compressed).decode('ascii')
+        return data
+
+    def loads(self, data):
+        if data.startswith(ZLIB_PREFIX):
+            compressed = base64.b64decode(data[len(ZLIB_PREFIX):])
+            data = zlib.decompress(compressed).decode('utf-8')
+        return self._loads(data)
+
+
+_default_codec = JsonCodec('json')
+
+
+def get_codec():
+    """Get codec configured for current app.
+
+    Outside of app context (e.g. in migrations) stdlib json without
+    compression is used, it can read anything other codecs write.
+    """
+    if not flask.has_app_context():
+        return _default_codec
+    app = flask.current_app
+    try:
+        return app.extensions['tuning_box_json_codec']
+    except KeyError:
+        codec = JsonCodec(app.config.get('JSON_CODEC', 'auto'),
+                          app.config.get('JSON_COMPRESS_THRESHOLD', 0))
+        return app.extensions.setdefault('tuning_box_json_codec', codec)
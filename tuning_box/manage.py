@@ -0,0 +1,221 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Maintenance commands for tuning_box database"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import sys
+
+import flask
+from werkzeug import exceptions
+
+from tuning_box import app as tb_app
+from tuning_box import db
+
+
+def iter_resources(environment_id=None):
+    """Iterate over (environment id, resource definition id) having values"""
+    query = db.db.session.query(
+        db.ResourceValues.environment_id,
+        db.ResourceValues.resource_definition_id,
+    ).distinct().order_by(
+        db.ResourceValues.environment_id,
+        db.ResourceValues.resource_definition_id,
+    )
+    if environment_id is not None:
+        query = query.filter(
+            db.ResourceValues.environment_id == environment_id)
+    return query.all()
+
+
+def refresh_snapshots(environment_id=None, dry_run=False):
+    """Rebuild snapshots of resource values from their raw values.
+
+    Returns list of (environment id, resource definition id, row ids) for
+    every resource whose snapshots were out of date.
+    """
+    drift = []
+    for env_id, resdef_id in iter_resources(environment_id):
+        row_ids = db.ResourceValues.refresh_snapshots(
+            env_id, resdef_id, [''], written=False, dry_run=dry_run)
+        if row_ids:
+            drift.append((env_id, resdef_id, row_ids))
+    if not dry_run:
+        db.db.session.commit()
+    return drift
+
+
+def cmd_snapshots(args):
+    drift = refresh_snapshots(args.environment,
+                              dry_run=args.action == 'check')
+    for env_id, resdef_id, row_ids in drift:
+        print('environment %d resource %d: %d rows out of date' % (
+            env_id, resdef_id, len(row_ids)))
+    if args.action == 'check':
+        return 1 if drift else 0
+    print('rebuilt snapshots of %d rows' % (
+        sum(len(row_ids) for _, _, row_ids in drift),))
+    return 0
+
+
+def refresh_keys(environment_id=None, chunk_size=1000):
+    """Rebuild key paths of resource values, return number of rows"""
+    count = 0
+    for env_id, resdef_id in iter_resources(environment_id):
+        query = db.db.session.query(
+            db.ResourceValues.level_value_id,
+            db.ResourceValues.values,
+        ).filter(
+            db.ResourceValues.environment_id == env_id,
+            db.ResourceValues.resource_definition_id == resdef_id,
+        ).order_by(db.ResourceValues.level_value_id)
+        last_id = None
+        while True:
+            chunk_query = query
+            if last_id is not None:
+                chunk_query = query.filter(
+                    db.ResourceValues.level_value_id > last_id)
+            rows = chunk_query.limit(chunk_size).all()
+            if not rows:
+                break
+            db.ResourceValuesKey.refresh(env_id, [
+                (resdef_id, level_value_id, values)
+                for level_value_id, values in rows])
+            db.db.session.commit()
+            count += len(rows)
+            last_id = rows[-1].level_value_id
+    return count
+
+
+def cmd_keys(args):
+    if args.values:
+        flask.current_app.config['VALUES_KEY_STORAGE'] = True
+    count = refresh_keys(
+        args.environment,
+        args.chunk_size or flask.current_app.config['EXPORT_CHUNK_SIZE'])
+    print('rebuilt keys of %d rows' % (count,))
+    return 0
+
+
+@contextlib.contextmanager
+def open_file(name, mode):
+    """Open file or use stdin/stdout for '-'"""
+    if name == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        if 'b' in mode:
+            stream = getattr(stream, 'buffer', stream)
+        yield stream
+    else:
+        with open(name, mode) as f:
+            yield f
+
+
+def cmd_export(args):
+    environment = db.Environment.query.get(args.environment)
+    if environment is None:
+        print('environment %d not found' % (args.environment,),
+              file=sys.stderr)
+        return 1
+    chunk_size = (args.chunk_size or
+                  flask.current_app.config['EXPORT_CHUNK_SIZE'])
+    with open_file(args.output, 'w') as f:
+        for line in tb_app.iter_export(environment, chunk_size):
+            f.write(line)
+    return 0
+
+
+def cmd_import(args):
+    importer = tb_app.EnvironmentImporter(
+        args.chunk_size or flask.current_app.config['IMPORT_CHUNK_SIZE'])
+    with open_file(args.input, 'rb') as f:
+        try:
+            environment = importer.run(tb_app.iter_import_records(f))
+        except exceptions.HTTPException as e:
+            print(e.description, file=sys.stderr)
+            return 1
+    print('imported environment %d' % (environment.id,))
+    return 0
+
+
+def cmd_gc(args):
+    deleted = db.collect_level_values(
+        args.batch_size or
+        flask.current_app.config['LEVEL_VALUES_GC_BATCH_SIZE'])
+    print('deleted %d orphaned level values' % (deleted,))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--table-prefix', default='',
+                        help='prefix of table names, e.g. in Nailgun')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_snapshots = subparsers.add_parser(
+        'snapshots', help='check or rebuild snapshots of resource values')
+    parser_snapshots.add_argument('action', choices=('check', 'rebuild'))
+    parser_snapshots.add_argument('--environment', type=int,
+                                  help='only process this environment')
+    parser_snapshots.set_defaults(func=cmd_snapshots)
+
+    parser_keys = subparsers.add_parser(
+        'keys', help='rebuild key paths of resource values')
+    parser_keys.add_argument('action', choices=('rebuild',))
+    parser_keys.add_argument('--environment', type=int,
+                             help='only process this environment')
+    parser_keys.add_argument('--chunk-size', type=int,
+                             help='values rows to process at once')
+    parser_keys.add_argument('--values', action='store_true',
+                             help='store values of top-level keys too, '
+                                  'for VALUES_KEY_STORAGE')
+    parser_keys.set_defaults(func=cmd_keys)
+
+    parser_export = subparsers.add_parser(
+        'export', help='export environment with all its values as NDJSON')
+    parser_export.add_argument('environment', type=int)
+    parser_export.add_argument('--output', default='-',
+                               help="file to write, '-' for stdout")
+    parser_export.add_argument('--chunk-size', type=int,
+                               help='values rows to fetch at once')
+    parser_export.set_defaults(func=cmd_export)
+
+    parser_import = subparsers.add_parser(
+        'import', help='create environment from NDJSON or JSON export; '
+                       'servers with RESOURCE_DEFINITIONS_CACHE see '
+                       'resource definitions added to existing components '
+                       'only after restart')
+    parser_import.add_argument('input', help="file to read, '-' for stdin")
+    parser_import.add_argument('--chunk-size', type=int,
+                               help='values records to commit at once')
+    parser_import.set_defaults(func=cmd_import)
+
+    parser_gc = subparsers.add_parser(
+        'gc', help='delete level values with no resource values under them')
+    parser_gc.add_argument('--batch-size', type=int,
+                           help='level values to check in one transaction')
+    parser_gc.set_defaults(func=cmd_gc)
+
+    args = parser.parse_args(argv)
+    if args.table_prefix:
+        db.prefix_tables(db, args.table_prefix)
+    app = tb_app.build_app()
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_url
+    with app.app_context():
+        return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
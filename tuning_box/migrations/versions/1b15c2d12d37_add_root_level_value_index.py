@@ -0,0 +1,52 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add unique index on root level values
+
+The environment_hierarchy_level_value_path_idx index doesn't cover the
+root level value since its level_id is NULL. Remove duplicate roots
+before upgrading if this fails.
+
+Revision ID: 1b15c2d12d37
+Revises: 961a136a1839
+Create Date: 2026-10-17 15:21:40.118093
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1b15c2d12d37'
+down_revision = '961a136a1839'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'environment_hierarchy_level_value'
+    op.create_index(
+        table_name + '_root_idx',
+        table_name,
+        ['path'],
+        unique=True,
+        postgresql_where=sa.text('level_id IS NULL'),
+        sqlite_where=sa.text('level_id IS NULL'),
+    )
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'environment_hierarchy_level_value'
+    op.drop_index(table_name + '_root_idx', table_name=table_name)
@@ -0,0 +1,158 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add materialized path to level values
+
+Level values created twice by concurrent writers are merged before unique
+indexes are created, see _merge_duplicates.
+
+Revision ID: 7552feaaf6a1
+Revises: 3b2a0f134e45
+Create Date: 2026-10-17 10:12:41.211403
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7552feaaf6a1'
+down_revision = '3b2a0f134e45'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+def _fill_paths(level_table_name, table_name):
+    level_table = sa.table(
+        level_table_name,
+        sa.column('id'),
+        sa.column('name'),
+    )
+    table = sa.table(
+        table_name,
+        sa.column('id'),
+        sa.column('level_id'),
+        sa.column('parent_id'),
+        sa.column('value'),
+        sa.column('path'),
+    )
+    connection = op.get_bind()
+    level_names = {row.id: row.name for row in connection.execute(
+        sa.select([level_table.c.id, level_table.c.name]))}
+    rows = {row.id: row for row in connection.execute(sa.select([
+        table.c.id, table.c.level_id, table.c.parent_id, table.c.value]))}
+    paths = {}
+    for row_id in rows:
+        parts = []
+        level_value_id = row_id
+        while level_value_id is not None and level_value_id not in paths:
+            row = rows[level_value_id]
+            if row.level_id is not None:
+                parts.append(level_names[row.level_id] + '/' + row.value)
+            level_value_id = row.parent_id
+        if level_value_id is not None:
+            parts.append(paths[level_value_id])
+        paths[row_id] = '/'.join(part for part in reversed(parts) if part)
+        connection.execute(table.update().where(
+            table.c.id == row_id).values(path=paths[row_id]))
+    return rows, paths
+
+
+def _merge_duplicates(table_name, values_table_name, rows, paths):
+    """Merge level values with the same level and path into the oldest one.
+
+    Children and resource values of duplicates are moved to it. If both
+    have values of the same resource in the same environment, the row with
+    the larger id wins. Roots are left to 1b15c2d12d37.
+    """
+    table = sa.table(
+        table_name,
+        sa.column('id'),
+        sa.column('parent_id'),
+    )
+    values_table = sa.table(
+        values_table_name,
+        sa.column('id'),
+        sa.column('environment_id'),
+        sa.column('resource_definition_id'),
+        sa.column('level_value_id'),
+    )
+    connection = op.get_bind()
+
+    def select_values(level_value_id):
+        return connection.execute(sa.select([
+            values_table.c.id,
+            values_table.c.environment_id,
+            values_table.c.resource_definition_id,
+        ]).where(values_table.c.level_value_id == level_value_id)).fetchall()
+
+    kept = {}
+    for row_id in sorted(rows):
+        level_id = rows[row_id].level_id
+        if level_id is None:
+            continue
+        keep_id = kept.setdefault((level_id, paths[row_id]), row_id)
+        if keep_id == row_id:
+            continue
+        connection.execute(table.update().where(
+            table.c.parent_id == row_id).values(parent_id=keep_id))
+        kept_values = dict(
+            ((row.environment_id, row.resource_definition_id), row.id)
+            for row in select_values(keep_id))
+        for row in select_values(row_id):
+            other_id = kept_values.get(
+                (row.environment_id, row.resource_definition_id))
+            if other_id is not None:
+                loser_id = min(row.id, other_id)
+                connection.execute(values_table.delete().where(
+                    values_table.c.id == loser_id))
+                if loser_id == row.id:
+                    continue
+            connection.execute(values_table.update().where(
+                values_table.c.id == row.id).values(level_value_id=keep_id))
+        connection.execute(table.delete().where(table.c.id == row_id))
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'environment_hierarchy_level_value'
+    op.add_column(
+        table_name,
+        sa.Column('path', sa.String(length=1024), nullable=True),
+    )
+    if not context.is_offline_mode():
+        rows, paths = _fill_paths(
+            table_prefix + 'environment_hierarchy_level', table_name)
+        _merge_duplicates(table_name, table_prefix + 'resource_values',
+                          rows, paths)
+    op.create_index(
+        table_name + '_parent_idx',
+        table_name,
+        ['level_id', 'parent_id', 'value'],
+        unique=True,
+    )
+    op.create_index(
+        table_name + '_path_idx',
+        table_name,
+        ['path', 'level_id'],
+        unique=True,
+    )
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'environment_hierarchy_level_value'
+    op.drop_index(table_name + '_path_idx', table_name=table_name)
+    op.drop_index(table_name + '_parent_idx', table_name=table_name)
+    with op.batch_alter_table(table_name) as batch:
+        batch.drop_column('path')
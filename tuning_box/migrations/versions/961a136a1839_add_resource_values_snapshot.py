@@ -0,0 +1,46 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add snapshot of merged values to resource values
+
+Snapshots of existing rows are left empty, run
+"tuning_box-manage snapshots rebuild" to fill them.
+
+Revision ID: 961a136a1839
+Revises: a699d30a64eb
+Create Date: 2026-10-17 14:05:12.402817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '961a136a1839'
+down_revision = 'a699d30a64eb'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    op.add_column(
+        table_prefix + 'resource_values',
+        sa.Column('snapshot', sa.Text(), nullable=True),
+    )
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    with op.batch_alter_table(table_prefix + 'resource_values') as batch:
+        batch.drop_column('snapshot')
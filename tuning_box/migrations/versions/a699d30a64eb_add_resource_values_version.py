@@ -0,0 +1,51 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add version and update time to resource values
+
+Revision ID: a699d30a64eb
+Revises: b86c5098027d
+Create Date: 2026-10-17 12:20:43.683190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a699d30a64eb'
+down_revision = 'b86c5098027d'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'resource_values'
+    op.add_column(
+        table_name,
+        sa.Column('version', sa.Integer(), nullable=False,
+                  server_default='1'),
+    )
+    op.add_column(
+        table_name,
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'resource_values'
+    with op.batch_alter_table(table_name) as batch:
+        batch.drop_column('updated_at')
+        batch.drop_column('version')
@@ -0,0 +1,44 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add level value index to resource values
+
+Revision ID: b86c5098027d
+Revises: 7552feaaf6a1
+Create Date: 2026-10-17 11:02:17.530921
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b86c5098027d'
+down_revision = '7552feaaf6a1'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'resource_values'
+    op.create_index(
+        table_name + '_level_value_idx',
+        table_name,
+        ['level_value_id', 'resource_definition_id'],
+    )
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'resource_values'
+    op.drop_index(table_name + '_level_value_idx', table_name=table_name)
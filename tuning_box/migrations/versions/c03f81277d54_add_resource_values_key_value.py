@@ -0,0 +1,46 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add values of top-level keys to key paths of resource values
+
+Values are stored only if VALUES_KEY_STORAGE is set, run
+"tuning_box-manage keys rebuild --values" to fill them for existing rows.
+
+Revision ID: c03f81277d54
+Revises: fb68760ea65f
+Create Date: 2026-10-17 20:31:57.649120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c03f81277d54'
+down_revision = 'fb68760ea65f'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    op.add_column(
+        table_prefix + 'resource_values_key',
+        sa.Column('value', sa.Text(), nullable=True),
+    )
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    with op.batch_alter_table(table_prefix + 'resource_values_key') as batch:
+        batch.drop_column('value')
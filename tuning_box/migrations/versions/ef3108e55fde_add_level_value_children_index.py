@@ -0,0 +1,40 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add index on parent of level values
+
+Revision ID: ef3108e55fde
+Revises: 1b15c2d12d37
+Create Date: 2026-10-17 17:48:09.551370
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'ef3108e55fde'
+down_revision = '1b15c2d12d37'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'environment_hierarchy_level_value'
+    op.create_index(table_name + '_children_idx', table_name, ['parent_id'])
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'environment_hierarchy_level_value'
+    op.drop_index(table_name + '_children_idx', table_name=table_name)
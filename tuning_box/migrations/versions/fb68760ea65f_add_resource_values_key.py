@@ -0,0 +1,71 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Add key paths of resource values
+
+Keys of existing rows are not filled, run "tuning_box-manage keys rebuild"
+to fill them.
+
+Revision ID: fb68760ea65f
+Revises: ef3108e55fde
+Create Date: 2026-10-17 19:12:40.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'fb68760ea65f'
+down_revision = 'ef3108e55fde'
+branch_labels = None
+depends_on = None
+
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    table_name = table_prefix + 'resource_values_key'
+    op.create_table(
+        table_name,
+        sa.Column('id', sa.Integer(), nullable=False, primary_key=True),
+        sa.Column('environment_id', sa.Integer(), nullable=True),
+        sa.Column('resource_definition_id', sa.Integer(), nullable=True),
+        sa.Column('level_value_id', sa.Integer(), nullable=True),
+        sa.Column('key', sa.String(length=255), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['environment_id'], [table_prefix + 'environment.id'],
+            name=table_name + '_environment_id_fkey',
+        ),
+        sa.ForeignKeyConstraint(
+            ['resource_definition_id'],
+            [table_prefix + 'resource_definition.id'],
+            name=table_name + '_resource_definition_id_fkey',
+        ),
+        sa.ForeignKeyConstraint(
+            ['level_value_id'],
+            [table_prefix + 'environment_hierarchy_level_value.id'],
+            name=table_name + '_level_value_id_fkey',
+        ),
+        sa.UniqueConstraint(
+            'environment_id', 'resource_definition_id', 'key',
+            'level_value_id',
+            name=table_name + '_environment_id_key',
+        ),
+    )
+    op.create_index(table_name + '_level_value_idx', table_name,
+                    ['level_value_id', 'resource_definition_id'])
+
+
+def downgrade():
+    table_prefix = context.config.get_main_option('table_prefix')
+    op.drop_table(table_prefix + 'resource_values_key')
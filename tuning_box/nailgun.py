@@ -71,6 +71,10 @@ class TB2WebPy(App2WebPy):
         tb_db.prefix_tables(tb_db, Extension.table_prefix())
         tb_db.db.session = nailgun_db.db
         app.config["PROPAGATE_EXCEPTIONS"] = True
+        # Nailgun runs several worker processes and in-process cache can't be
+        # invalidated across them
+        app.config["VALUES_CACHE_SIZE"] = 0
+        app.config["RESOURCE_DEFINITIONS_CACHE"] = False
         return app
 
 
@@ -0,0 +1,190 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""JSON Merge Patch (RFC 7396) and JSON Patch (RFC 6902) for documents"""
+
+import copy
+
+try:
+    string_types = basestring  # noqa
+except NameError:
+    string_types = str  # in 3.x all strings are unicode
+
+MERGE_PATCH_MIMETYPE = 'application/merge-patch+json'
+JSON_PATCH_MIMETYPE = 'application/json-patch+json'
+
+
+class InvalidPatch(ValueError):
+    """Patch itself is malformed"""
+
+
+class PatchConflict(ValueError):
+    """Patch can't be applied to the document"""
+
+
+def merge_patch(document, patch):
+    """Apply JSON Merge Patch, return new document"""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if isinstance(document, dict):
+        result = dict(document)
+    else:
+        result = {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def parse_pointer(pointer):
+    """Split JSON Pointer into list of reference tokens"""
+    if not isinstance(pointer, string_types):
+        raise InvalidPatch("JSON Pointer must be a string: %r." % (pointer,))
+    if not pointer:
+        return []
+    if not pointer.startswith('/'):
+        raise InvalidPatch("JSON Pointer must start with '/': %r." % (
+            pointer,))
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in pointer[1:].split('/')]
+
+
+def _list_index(container, token, pointer, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchConflict("Invalid array index %r in %r." % (
+            token, pointer))
+    index = int(token)
+    if index > len(container) or (index == len(container) and
+                                  not allow_end):
+        raise PatchConflict("Array index %r in %r is out of range." % (
+            token, pointer))
+    return index
+
+
+def _resolve(document, tokens, pointer):
+    for token in tokens:
+        if isinstance(document, dict):
+            try:
+                document = document[token]
+            except KeyError:
+                raise PatchConflict("Path %r does not exist." % (pointer,))
+        elif isinstance(document, list):
+            document = document[_list_index(document, token, pointer)]
+        else:
+            raise PatchConflict("Path %r does not exist." % (pointer,))
+    return document
+
+
+def _add(document, tokens, value, pointer):
+    if not tokens:
+        return value
+    parent = _resolve(document, tokens[:-1], pointer)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_list_index(parent, token, pointer, allow_end=True),
+                      value)
+    else:
+        raise PatchConflict("Path %r does not exist." % (pointer,))
+    return document
+
+
+def _remove(document, tokens, pointer):
+    if not tokens:
+        raise PatchConflict("Can't remove the whole document.")
+    parent = _resolve(document, tokens[:-1], pointer)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        try:
+            return parent.pop(token)
+        except KeyError:
+            pass
+    elif isinstance(parent, list):
+        return parent.pop(_list_index(parent, token, pointer))
+    raise PatchConflict("Path %r does not exist." % (pointer,))
+
+
+def _json_equal(a, b):
+    # True == 1 in Python, but not in JSON
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return (set(a) == set(b) and
+                all(_json_equal(a[key], b[key]) for key in a))
+    if isinstance(a, list) and isinstance(b, list):
+        return (len(a) == len(b) and
+                all(_json_equal(x, y) for x, y in zip(a, b)))
+    return a == b
+
+
+def _get_member(operation, name):
+    try:
+        return operation[name]
+    except KeyError:
+        raise InvalidPatch("Operation %r has no %r member." % (
+            operation, name))
+
+
+def apply_patch(document, patch):
+    """Apply JSON Patch, return new document.
+
+    Either all operations are applied or document is left intact.
+    """
+    if not isinstance(patch, list):
+        raise InvalidPatch("JSON Patch must be a list of operations.")
+    document = copy.deepcopy(document)
+    for operation in patch:
+        if not isinstance(operation, dict):
+            raise InvalidPatch("Operation must be an object: %r." % (
+                operation,))
+        op = _get_member(operation, 'op')
+        pointer = _get_member(operation, 'path')
+        tokens = parse_pointer(pointer)
+        if op == 'add':
+            value = copy.deepcopy(_get_member(operation, 'value'))
+            document = _add(document, tokens, value, pointer)
+        elif op == 'remove':
+            _remove(document, tokens, pointer)
+        elif op == 'replace':
+            value = copy.deepcopy(_get_member(operation, 'value'))
+            _resolve(document, tokens, pointer)  # must exist
+            if tokens:
+                _remove(document, tokens, pointer)
+            document = _add(document, tokens, value, pointer)
+        elif op in ('move', 'copy'):
+            from_pointer = _get_member(operation, 'from')
+            from_tokens = parse_pointer(from_pointer)
+            if op == 'move':
+                if tokens[:len(from_tokens)] == from_tokens and \
+                        tokens != from_tokens:
+                    raise PatchConflict(
+                        "Can't move %r into itself." % (from_pointer,))
+                if not from_tokens:
+                    value = document
+                else:
+                    value = _remove(document, from_tokens, from_pointer)
+            else:
+                value = copy.deepcopy(
+                    _resolve(document, from_tokens, from_pointer))
+            document = _add(document, tokens, value, pointer)
+        elif op == 'test':
+            value = _get_member(operation, 'value')
+            if not _json_equal(_resolve(document, tokens, pointer), value):
+                raise PatchConflict("Test of path %r failed." % (pointer,))
+        else:
+            raise InvalidPatch("Unknown operation %r." % (op,))
+    return document
@@ -15,7 +15,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+
 from oslotest import base
+import sqlalchemy.event
 
 from tuning_box import db
 
@@ -24,6 +27,23 @@ class TestCase(base.BaseTestCase):
 
     """Test case base class for all unit tests."""
 
+    @contextlib.contextmanager
+    def count_queries(self):
+        """Collect all SQL statements sent to database in current app"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = db.db.engine
+        sqlalchemy.event.listen(
+            engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(
+                engine, 'before_cursor_execute', before_cursor_execute)
+
 
 class PrefixedTestCaseMixin(object):
     def setUp(self):
@@ -33,9 +33,9 @@ class Client(testing.FlaskClient):
 
     def open(self, *args, **kwargs):
         data = kwargs.get('data')
-        if data is not None:
+        if data is not None and not isinstance(data, bytes):
             kwargs['data'] = json.dumps(data)
-            kwargs['content_type'] = 'application/json'
+            kwargs.setdefault('content_type', 'application/json')
         return super(Client, self).open(*args, **kwargs)
 
 
@@ -44,6 +44,9 @@ class TestApp(base.TestCase):
         super(TestApp, self).setUp()
         self.app = app.build_app()
         self.app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///'
+        # one process serves the database, so caches can be enabled
+        self.app.config["VALUES_CACHE_SIZE"] = 1024
+        self.app.config["RESOURCE_DEFINITIONS_CACHE"] = True
         with self.app.app_context():
             db.fix_sqlite()
             db.db.create_all()
@@ -95,6 +98,84 @@ class TestApp(base.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(res.json, [self._component_json])
 
+    def test_get_components_query_count(self):
+        self._fixture()
+        self._add_components(10)
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get('/components')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json), 11)
+        selects = [query for query in queries if query.startswith('SELECT')]
+        self.assertEqual(len(selects), 2)
+
+    def _add_components(self, count):
+        with self.app.app_context():
+            for i in range(count):
+                db.db.session.add(db.Component(
+                    name='component%d' % (i + 2,),
+                    resource_definitions=[db.ResourceDefinition(
+                        name='resdef', content={'big': 'schema'})],
+                ))
+            db.db.session.commit()
+
+    def test_get_components_paginated(self):
+        self._fixture()
+        self._add_components(4)
+        res = self.client.get('/components?limit=2')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([c['id'] for c in res.json], [7, 8])
+        self.assertEqual(
+            res.headers['Link'],
+            '<http://localhost/components?limit=2&after=8>; rel="next"')
+        res = self.client.get('/components?limit=2&after=8')
+        self.assertEqual([c['id'] for c in res.json], [9, 10])
+        res = self.client.get('/components?limit=2&after=10')
+        self.assertEqual([c['id'] for c in res.json], [11])
+        self.assertNotIn('Link', res.headers)
+
+    def test_get_components_last_full_page(self):
+        self._fixture()
+        res = self.client.get('/components?limit=1')
+        self.assertEqual([c['id'] for c in res.json], [7])
+        self.assertNotIn('Link', res.headers)
+
+    def test_get_components_bad_limit(self):
+        for query in ['limit=x', 'limit=-1', 'limit=0', 'after=x']:
+            res = self.client.get('/components?' + query)
+            self.assertEqual(res.status_code, 400, query)
+
+    def test_get_components_fields(self):
+        self._fixture()
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get('/components?fields=id,name')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, [{'id': 7, 'name': 'component1'}])
+        self.assertEqual(
+            [query for query in queries if 'resource_definition' in query],
+            [])
+
+    def test_get_components_nested_fields(self):
+        self._fixture()
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get(
+                    '/components?fields=id,resource_definitions.name')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, [{
+            'id': 7,
+            'resource_definitions': [{'name': 'resdef1'}],
+        }])
+        self.assertEqual([query for query in queries if 'content' in query],
+                         [])
+
+    def test_get_components_unknown_field(self):
+        for query in ['fields=id,bad', 'fields=resource_definitions.bad',
+                      'fields=name.id']:
+            res = self.client.get('/components?' + query)
+            self.assertEqual(res.status_code, 400, query)
+
     def test_get_one_component(self):
         self._fixture()
         res = self.client.get('/components/7')
@@ -127,6 +208,42 @@ class TestApp(base.TestCase):
             component = db.Component.query.get(7)
             self.assertIsNone(component)
 
+    def _count_rows(self):
+        with self.app.app_context():
+            return dict(
+                (model.__name__, model.query.count()) for model in [
+                    db.Component, db.ResourceDefinition, db.Environment,
+                    db.EnvironmentHierarchyLevel,
+                    db.EnvironmentHierarchyLevelValue, db.ResourceValues,
+                    db.ResourceValuesKey,
+                ]
+            ), db.db.session.query(
+                db.Environment.environment_components_table).count()
+
+    def test_delete_component_cascades(self):
+        self._fixture()
+        self._put_overlays()
+        self.client.post('/environments/9/clone')
+        res = self.client.delete('/components/7')
+        self.assertEqual(res.status_code, 204)
+        self.assertEqual(self._count_rows(), ({
+            'Component': 0,
+            'ResourceDefinition': 0,
+            'Environment': 2,
+            'EnvironmentHierarchyLevel': 4,
+            'EnvironmentHierarchyLevelValue': 7,
+            'ResourceValues': 0,
+            'ResourceValuesKey': 0,
+        }, 0))
+
+    def test_collect_level_values(self):
+        self._fixture()
+        self._put_overlays()
+        self.client.delete('/components/7')
+        app.collect_level_values(self.app)
+        counts = self._count_rows()[0]
+        self.assertEqual(counts['EnvironmentHierarchyLevelValue'], 1)
+
     def test_delete_component_404(self):
         res = self.client.delete('/components/7')
         self.assertEqual(res.status_code, 404)
@@ -143,6 +260,43 @@ class TestApp(base.TestCase):
         self.assertEqual(res.json, [{'id': 9, 'components': [7],
                                      'hierarchy_levels': ['lvl1', 'lvl2']}])
 
+    def test_get_environments_query_count(self):
+        self._fixture()
+        for i in range(10):
+            res = self.client.post('/environments', data={
+                'components': [7],
+                'hierarchy_levels': ['lvl1', 'lvl2'],
+            })
+            self.assertEqual(res.status_code, 201)
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get('/environments')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json), 11)
+        self.assertEqual(
+            [env['hierarchy_levels'] for env in res.json],
+            [['lvl1', 'lvl2']] * 11)
+        selects = [query for query in queries if query.startswith('SELECT')]
+        self.assertEqual(len(selects), 3)
+
+    def test_get_environments_paginated(self):
+        self._fixture()
+        for i in range(2):
+            self.client.post('/environments', data={
+                'components': [7],
+                'hierarchy_levels': ['lvl1'],
+            })
+        res = self.client.get('/environments?limit=2&fields=id')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, [{'id': 9}, {'id': 10}])
+        self.assertEqual(
+            res.headers['Link'],
+            '<http://localhost/environments?limit=2&fields=id&after=10>; '
+            'rel="next"')
+        res = self.client.get('/environments?after=10')
+        self.assertEqual(res.json, [{'id': 11, 'components': [7],
+                                     'hierarchy_levels': ['lvl1']}])
+
     def test_get_one_environment(self):
         self._fixture()
         res = self.client.get('/environments/9')
@@ -177,6 +331,28 @@ class TestApp(base.TestCase):
             environment = db.Environment.query.get(9)
             self.assertIsNone(environment)
 
+    def test_delete_environment_cascades(self):
+        self._fixture()
+        self._put_overlays()
+        counts = self._count_rows()
+        clone_id = self.client.post('/environments/9/clone').json['id']
+        res = self.client.delete('/environments/9')
+        self.assertEqual(res.status_code, 204)
+        self.assertEqual(self._count_rows(), counts)
+        res = self.client.get(
+            '/environments/%d/lvl1/1/lvl2/3/resources/5/values' % (clone_id,))
+        self.assertEqual(res.json['a'], 'other node')
+        self.client.delete('/environments/%d' % (clone_id,))
+        self.assertEqual(self._count_rows(), ({
+            'Component': 1,
+            'ResourceDefinition': 1,
+            'Environment': 0,
+            'EnvironmentHierarchyLevel': 0,
+            'EnvironmentHierarchyLevelValue': 1,  # the root
+            'ResourceValues': 0,
+            'ResourceValuesKey': 0,
+        }, 0))
+
     def test_delete_environment_404(self):
         res = self.client.delete('/environments/9')
         self.assertEqual(res.status_code, 404)
@@ -202,13 +378,33 @@ class TestApp(base.TestCase):
             self.assertIsNotNone(level_value)
             self.assertEqual(level_value.level.name, 'lvl2')
             self.assertEqual(level_value.value, 'val2')
+            self.assertEqual(level_value.path, 'lvl1/val1/lvl2/val2')
             level_value = level_value.parent
             self.assertEqual(level_value.level.name, 'lvl1')
             self.assertEqual(level_value.value, 'val1')
+            self.assertEqual(level_value.path, 'lvl1/val1')
             level_value = level_value.parent
             self.assertIsNone(level_value.level)
             self.assertIsNone(level_value.parent)
             self.assertIsNone(level_value.value)
+            self.assertEqual(level_value.path, '')
+
+    def test_get_environment_level_value_other_environment(self):
+        self._fixture()
+        res = self.client.post('/environments', data={
+            'components': [7],
+            'hierarchy_levels': ['lvl1', 'lvl2'],
+        })
+        levels = [('lvl1', 'val1'), ('lvl2', 'val2')]
+        with self.app.app_context():
+            level_value9 = app.get_environment_level_value(
+                db.Environment(id=9), levels)
+            level_value10 = app.get_environment_level_value(
+                db.Environment(id=res.json['id']), levels)
+            self.assertEqual(level_value9.path, level_value10.path)
+            self.assertNotEqual(level_value9.id, level_value10.id)
+            self.assertEqual(level_value9.parent.parent,
+                             level_value10.parent.parent)
 
     def test_get_environment_level_value_bad_level(self):
         self._fixture()
@@ -224,6 +420,28 @@ class TestApp(base.TestCase):
                 "Unexpected level name 'lvlx'. Expected 'lvl1'.",
             )
 
+    def test_get_environment_level_value_queries_independent_of_depth(self):
+        self._fixture()
+        res = self.client.post('/environments', data={
+            'components': [7],
+            'hierarchy_levels': ['lvl1', 'lvl2', 'lvl3', 'lvl4'],
+        })
+        environment = db.Environment(id=res.json['id'])
+        levels = [('lvl1', 'a'), ('lvl2', 'b'), ('lvl3', 'c'), ('lvl4', 'd')]
+        with self.app.app_context():
+            app.get_environment_level_value(environment, levels)
+            db.db.session.commit()
+        query_counts = []
+        for depth in range(len(levels) + 1):
+            with self.app.app_context():
+                with self.count_queries() as queries:
+                    level_value = app.get_environment_level_value(
+                        environment, levels[:depth])
+                query_counts.append(len(queries))
+                self.assertEqual(level_value.value,
+                                 levels[depth - 1][1] if depth else None)
+        self.assertEqual(query_counts, [query_counts[0]] * len(query_counts))
+
     def test_put_esv_root(self):
         self._fixture()
         res = self.client.put('/environments/9/resources/5/values',
@@ -263,6 +481,43 @@ class TestApp(base.TestCase):
             self.assertIsNone(level_value.parent)
             self.assertIsNone(level_value.value)
 
+    def test_put_esv_extra_level(self):
+        self._fixture()
+        res = self.client.put(
+            '/environments/9/lvl1/a/lvl2/b/lvl3/c/resources/5/values',
+            data={'k': 'v'},
+        )
+        self.assertEqual(res.status_code, 204)
+        res = self.client.get(
+            '/environments/9/lvl1/a/lvl2/b/resources/5/values')
+        self.assertEqual(res.json, {'k': 'v'})
+
+    def test_put_esv_extra_level_invalidates_cache(self):
+        self._fixture()
+        url = '/environments/9/lvl1/a/lvl2/b/resources/5/values'
+        self.assertEqual(self.client.get(url).json, {})
+        self.client.put(
+            '/environments/9/lvl1/a/lvl2/b/lvl3/c/resources/5/values',
+            data={'k': 'v'})
+        self.assertEqual(self.client.get(url).json, {'k': 'v'})
+        self.client.patch(
+            '/environments/9/lvl1/a/lvl2/b/lvl3/c/resources/5/values',
+            data={'k': 'w'}, content_type='application/merge-patch+json')
+        self.assertEqual(self.client.get(url).json, {'k': 'w'})
+
+    def test_put_esv_not_object(self):
+        self._fixture()
+        url = '/environments/9/lvl1/1/resources/5/values'
+        for data in [[1, 2], 'str', None]:
+            res = self.client.put(url, data=json.dumps(data).encode(),
+                                  content_type='application/json')
+            self.assertEqual(res.status_code, 400, data)
+            self.assertEqual(res.json['message'],
+                             'Values should be an object.')
+        res = self.client.put(url, data=b'{"k": "v"}')  # not JSON type
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client.get(url).json, {})
+
     def test_put_esv_bad_level(self):
         self._fixture()
         res = self.client.put('/environments/9/lvlx/1/resources/5/values',
@@ -297,32 +552,1178 @@ class TestApp(base.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(res.json, {'key': 'value1'})
 
-    def test_put_resoruce_values_redirect(self):
+    def test_get_etv_no_writes(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        with self.app.app_context():
+            count = db.EnvironmentHierarchyLevelValue.query.count()
+            with self.count_queries() as queries:
+                res = self.client.get(
+                    '/environments/9/lvl1/1/lvl2/2/resources/5/values')
+            self.assertEqual(
+                db.EnvironmentHierarchyLevelValue.query.count(), count)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {'key': 'value'})
+        writes = [query for query in queries if query.split()[0] in
+                  ('INSERT', 'UPDATE', 'DELETE', 'SAVEPOINT')]
+        self.assertEqual(writes, [])
+
+    def test_get_etv_fetches_only_ancestors(self):
+        self._fixture()
+        for node in range(5):
+            self.client.put(
+                '/environments/9/lvl1/1/lvl2/%d/resources/5/values' % (node,),
+                data={'key': node})
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get(
+                    '/environments/9/lvl1/1/lvl2/3/resources/5/values')
+        self.assertEqual(res.json, {'key': 3})
+        values_queries = [query for query in queries
+                          if 'resource_values.level_value_id IN' in query]
+        self.assertEqual(len(values_queries), 1)
+
+    def _put_overlays(self):
+        overlays = [
+            ('', {'a': 1, 'b': 'root', 'c': [1, {'x': None}], 'd': True}),
+            ('lvl1/1/', {'b': u'\u043a"\\', 'e': 2.5, 'f': {'g': False}}),
+            ('lvl1/1/lvl2/2/', {'a': None, 'f': {}, 'h': 12345678901234,
+                                'i': 12345678901234567890,
+                                'n': 0.30000000000000004, 'm': -0.0}),
+            # databases can't merge these, they are merged in Python
+            ('lvl1/1/lvl2/3/', {'a': 'other node', 'q"x': 'quoted',
+                                'o': float('nan')}),
+        ]
+        for path, values in overlays:
+            res = self.client.put(
+                '/environments/9/%sresources/5/values' % (path,),
+                data=values)
+            self.assertEqual(res.status_code, 204)
+
+    def test_get_etv_sql_merge(self):
+        self._fixture()
+        self._put_overlays()
+        self.app.config['VALUES_SNAPSHOTS'] = False
+        for node, merged_in_database in (('2', True), ('3', False)):
+            url = '/environments/9/lvl1/1/lvl2/%s/resources/5/values' % (
+                node,)
+            results = []
+            for sql_merge in (False, True):
+                self.app.config['VALUES_SQL_MERGE'] = sql_merge
+                with self.app.app_context():
+                    app.get_values_cache().clear()
+                    with self.count_queries() as queries:
+                        res = self.client.get(url)
+                self.assertEqual(res.status_code, 200)
+                # compare text, equal floats can still be written differently
+                results.append((json.dumps(res.json, sort_keys=True),
+                                res.headers['ETag']))
+                loads_rows = any('resource_values."values" AS' in query
+                                 for query in queries)
+                self.assertEqual(loads_rows,
+                                 not (sql_merge and merged_in_database))
+            self.assertEqual(results[0], results[1])
+
+    def test_get_etv_sql_merge_empty(self):
+        self._fixture()
+        self.app.config['VALUES_SNAPSHOTS'] = False
+        self.app.config['VALUES_SQL_MERGE'] = True
+        for url in ('/environments/9/lvl1/1/resources/5/values',
+                    '/environments/9/resources/5/values'):
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json, {})
+        self.client.put('/environments/9/lvl1/1/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/resources/5/values')
+        self.assertEqual(res.json, {})
+
+    def test_get_etv_sql_merge_not_modified(self):
+        self._fixture()
+        self.app.config['VALUES_SNAPSHOTS'] = False
+        self.app.config['VALUES_SQL_MERGE'] = True
+        self._put_overlays()
+        url = '/environments/9/lvl1/1/resources/5/values'
+        res = self.client.get(url)
+        self.assertEqual(res.json['b'], u'\u043a"\\')
+        res = self.client.get(url, headers={
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_etv_sql_merge_disabled_with_compression(self):
+        self.app.config['VALUES_SNAPSHOTS'] = False
+        self.app.config['VALUES_SQL_MERGE'] = True
+        self.app.config['JSON_COMPRESS_THRESHOLD'] = 1
+        self._fixture()
+        self._put_overlays()
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['e'], 2.5)
+
+    def _get_snapshots(self, environment_id=9):
+        with self.app.app_context():
+            rows = db.db.session.query(
+                db.EnvironmentHierarchyLevelValue.path,
+                db.ResourceValues.snapshot,
+                db.ResourceValues.version,
+            ).join(db.ResourceValues.level_value).filter(
+                db.ResourceValues.environment_id == environment_id).all()
+        return {path: (snapshot, version) for path, snapshot, version in rows}
+
+    def test_put_updates_snapshots_below(self):
+        self._fixture()
+        self._put_overlays()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'a': 'new', 'z': 'new'})
+        snapshots = self._get_snapshots()
+        self.assertEqual(snapshots[''], ({'a': 'new', 'z': 'new'}, 2))
+        self.assertEqual(snapshots['lvl1/1'][0]['z'], 'new')
+        self.assertEqual(snapshots['lvl1/1'][1], 2)
+        self.assertEqual(snapshots['lvl1/1/lvl2/2'][0], {
+            'a': None,
+            'b': u'\u043a"\\',
+            'e': 2.5,
+            'f': {},
+            'h': 12345678901234,
+            'i': 12345678901234567890,
+            'm': -0.0,
+            'n': 0.30000000000000004,
+            'z': 'new',
+        })
+        self.assertEqual(snapshots['lvl1/1/lvl2/3'][0]['a'], 'other node')
+
+    def test_put_keeps_unchanged_snapshots(self):
+        self._fixture()
+        self._put_overlays()
+        # both nodes below override the only changed key
+        self.client.put('/environments/9/lvl1/1/resources/5/values', data={
+            'a': 'lvl1', 'b': u'\u043a"\\', 'e': 2.5, 'f': {'g': False}})
+        snapshots = self._get_snapshots()
+        self.assertEqual(snapshots['lvl1/1'][1], 2)
+        self.assertEqual(snapshots['lvl1/1/lvl2/2'][1], 1)
+        self.assertEqual(snapshots['lvl1/1/lvl2/3'][1], 1)
+        self.assertEqual(snapshots[''][1], 1)
+
+    def test_get_etv_from_snapshot(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/lvl1/1/lvl2/2/resources/5/values'
+        self.app.config['VALUES_SNAPSHOTS'] = False
+        expected = self.client.get(url).json
+        self.app.config['VALUES_SNAPSHOTS'] = True
+        with self.app.app_context():
+            app.get_values_cache().clear()
+            with self.count_queries() as queries:
+                res = self.client.get(url)
+        self.assertEqual(res.json, expected)
+        values_queries = [query for query in queries
+                          if 'resource_values.level_value_id IN' in query]
+        self.assertEqual(len(values_queries), 1)
+        self.assertIn('LIMIT', values_queries[0])
+        self.assertNotIn('resource_values."values"', values_queries[0])
+
+    def test_get_etv_etag_changes_with_ancestor(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/lvl1/1/lvl2/2/resources/5/values'
+        etag = self.client.get(url).headers['ETag']
+        self.client.put('/environments/9/resources/5/values',
+                        data={'z': 'new'})
+        res = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['z'], 'new')
+        res = self.client.get(url, headers={
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_etv_without_snapshot(self):
+        self._fixture()
+        self._put_overlays()
+        with self.app.app_context():
+            db.db.session.execute(
+                'UPDATE %s SET snapshot = NULL' % (
+                    db.ResourceValues.__tablename__,))
+            db.db.session.commit()
+            app.get_values_cache().clear()
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['e'], 2.5)
+        self.assertEqual(res.json['a'], 1)
+
+    def test_patch_merge_patch(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/lvl1/1/resources/5/values'
+        res = self.client.patch(url, data={'e': None, 'f': {'h': 1}},
+                                content_type='application/merge-patch+json')
+        self.assertEqual(res.status_code, 204)
+        res = self.client.get(url)
+        self.assertNotIn('e', res.json)
+        self.assertEqual(res.json['f'], {'g': False, 'h': 1})
+        self.assertEqual(res.json['a'], 1)
+        snapshots = self._get_snapshots()
+        self.assertEqual(snapshots['lvl1/1'][1], 2)
+        self.assertEqual(snapshots['lvl1/1/lvl2/3'][0]['f'],
+                         {'g': False, 'h': 1})
+
+    def test_patch_json_patch(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/resources/5/values'
+        res = self.client.patch(url, data=[
+            {'op': 'test', 'path': '/a', 'value': 1},
+            {'op': 'add', 'path': '/c/-', 'value': 'x'},
+            {'op': 'move', 'from': '/b', 'path': '/moved'},
+        ], content_type='application/json-patch+json')
+        self.assertEqual(res.status_code, 204)
+        res = self.client.get(url)
+        self.assertEqual(res.json, {'a': 1, 'c': [1, {'x': None}, 'x'],
+                                    'd': True, 'moved': 'root'})
+
+    def test_patch_creates_values(self):
+        self._fixture()
+        url = '/environments/9/lvl1/1/resources/5/values'
+        res = self.client.patch(url, data={'key': 'value'},
+                                content_type='application/merge-patch+json')
+        self.assertEqual(res.status_code, 204)
+        res = self.client.get(url)
+        self.assertEqual(res.json, {'key': 'value'})
+        with self.app.app_context():
+            esv = db.ResourceValues.query.one()
+            self.assertEqual(esv.version, 1)
+
+    def test_patch_conflict_creates_nothing(self):
+        self._fixture()
+        res = self.client.patch('/environments/9/resources/5/values', data=[
+            {'op': 'remove', 'path': '/a'},
+        ], content_type='application/json-patch+json')
+        self.assertEqual(res.status_code, 409)
+        with self.app.app_context():
+            self.assertEqual(db.ResourceValues.query.count(), 0)
+
+    def test_patch_not_object(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/lvl1/1/resources/5/values'
+        for patch, content_type in [
+                ('x', 'application/merge-patch+json'),
+                ([{'op': 'replace', 'path': '', 'value': [1]}],
+                 'application/json-patch+json')]:
+            res = self.client.patch(url, data=patch,
+                                    content_type=content_type)
+            self.assertEqual(res.status_code, 409)
+            self.assertEqual(res.json['message'],
+                             'Patched values must be a JSON object.')
+        self.assertEqual(self.client.get(url).json['e'], 2.5)
+
+    def test_patch_conflict(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/resources/5/values'
+        res = self.client.patch(url, data=[
+            {'op': 'remove', 'path': '/a'},
+            {'op': 'test', 'path': '/b', 'value': 'other'},
+        ], content_type='application/json-patch+json')
+        self.assertEqual(res.status_code, 409)
+        res = self.client.get(url)
+        self.assertEqual(res.json['a'], 1)
+
+    def test_patch_invalid(self):
+        self._fixture()
+        res = self.client.patch('/environments/9/resources/5/values',
+                                data=[{'op': 'frobnicate', 'path': ''}],
+                                content_type='application/json-patch+json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_patch_unsupported_media_type(self):
+        self._fixture()
+        res = self.client.patch('/environments/9/resources/5/values',
+                                data={'key': 'value'})
+        self.assertEqual(res.status_code, 415)
+
+    def test_patch_invalidates_cache(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        url = '/environments/9/lvl1/1/resources/5/values'
+        self.client.get(url)
+        self.client.patch('/environments/9/resources/5/values',
+                          data={'key': 'changed'},
+                          content_type='application/merge-patch+json')
+        res = self.client.get(url)
+        self.assertEqual(res.json, {'key': 'changed'})
+
+    def test_get_etv_empty_db(self):
+        self._fixture()
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {})
+        with self.app.app_context():
+            self.assertEqual(
+                db.EnvironmentHierarchyLevelValue.query.count(), 0)
+
+    def test_get_environment_level_values_no_create(self):
+        self._fixture()
+        with self.app.app_context():
+            app.get_environment_level_value(db.Environment(id=9),
+                                            [('lvl1', 'val1')])
+            level_values = list(app.iter_environment_level_values(
+                db.Environment(id=9),
+                [('lvl1', 'val1'), ('lvl2', 'val2')],
+                create=False,
+            ))
+            self.assertEqual([lv.value for lv in level_values],
+                             [None, 'val1'])
+            self.assertEqual(
+                db.EnvironmentHierarchyLevelValue.query.count(), 2)
+
+    def _update_values_directly(self, values):
+        with self.app.app_context():
+            esv = db.ResourceValues.query.filter_by(
+                environment_id=9, resource_definition_id=5).one()
+            esv.values = values
+            db.db.session.flush()
+            db.ResourceValues.refresh_snapshots(9, 5, [''])
+            db.db.session.commit()
+
+    def test_values_compressed(self):
+        self.app.config['JSON_COMPRESS_THRESHOLD'] = 100
+        self._fixture()
+        values = {'key': 'value' * 100}
+        self.client.put('/environments/9/resources/5/values', data=values)
+        with self.app.app_context():
+            raw = db.db.session.execute(
+                'SELECT "values" FROM %s' % (
+                    db.ResourceValues.__tablename__,)).scalar()
+        self.assertTrue(raw.startswith('zlib:'))
+        res = self.client.get('/environments/9/resources/5/values')
+        self.assertEqual(res.json, values)
+
+    def test_get_etv_cached(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.json, {'key': 'value'})
+        self._update_values_directly({'key': 'changed'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {'key': 'value'})
+
+    def test_caches_disabled_by_default(self):
+        config = app.build_app().config
+        self.assertEqual(config['VALUES_CACHE_SIZE'], 0)
+        self.assertFalse(config['RESOURCE_DEFINITIONS_CACHE'])
+
+    def test_get_etv_cache_disabled(self):
+        self.app.config['VALUES_CACHE_SIZE'] = 0
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.json, {'key': 'value'})
+        self._update_values_directly({'key': 'changed'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.json, {'key': 'changed'})
+
+    def test_get_etv_cache_invalidated_by_ancestor_put(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get(
+            '/environments/9/lvl1/1/lvl2/2/resources/5/values')
+        self.assertEqual(res.json, {'key': 'value'})
+        self.client.put('/environments/9/lvl1/1/resources/5/values',
+                        data={'key': 'value1'})
+        res = self.client.get(
+            '/environments/9/lvl1/1/lvl2/2/resources/5/values')
+        self.assertEqual(res.json, {'key': 'value1'})
+
+    def test_get_etv_cache_invalidated_by_environment_delete(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        self.client.get('/environments/9/resources/5/values')
+        self.client.delete('/environments/9')
+        res = self.client.get('/environments/9/resources/5/values')
+        self.assertEqual(res.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(len(app.get_values_cache()), 0)
+
+    def test_get_etv_etag(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(res.headers.get('ETag'))
+        self.assertIsNotNone(res.headers.get('Last-Modified'))
+        self.assertEqual(res.headers['Cache-Control'],
+                         'max-age=0, must-revalidate')
+        etag = res.headers['ETag']
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value1'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {'key': 'value1'})
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_etv_weak_etag(self):
+        self._fixture()
+        self._put_overlays()
+        url = '/environments/9/lvl1/1/resources/5/values'
+        for query in ['', '?keys=a,b']:
+            for snapshots, sql_merge in [(True, False), (False, False),
+                                         (False, True)]:
+                self.app.config['VALUES_SNAPSHOTS'] = snapshots
+                self.app.config['VALUES_SQL_MERGE'] = sql_merge
+                etag = self.client.get(url + query).headers['ETag']
+                res = self.client.get(url + query, headers={
+                    'If-None-Match': 'W/' + etag})
+                self.assertEqual(res.status_code, 304,
+                                 (query, snapshots, sql_merge))
+
+    def test_get_etv_etag_changes_with_new_level(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        etag = res.headers['ETag']
+        self.client.put('/environments/9/lvl1/1/resources/5/values',
+                        data={'key': 'value1'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {'key': 'value1'})
+
+    def test_get_etv_not_modified_without_cache(self):
+        self.app.config['VALUES_CACHE_SIZE'] = 0
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/resources/5/values')
+        etag = res.headers['ETag']
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get('/environments/9/resources/5/values',
+                                      headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        for query in queries:
+            self.assertNotIn('resource_values."values"', query)
+
+    def test_put_esv_bumps_version(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        with self.app.app_context():
+            esv = db.ResourceValues.query.one()
+            self.assertEqual(esv.version, 1)
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value1'})
+        self.client.put('/environments/9/values/batch', data=[
+            {'resource': 5, 'values': {'key': 'value2'}},
+        ])
+        with self.app.app_context():
+            esv = db.ResourceValues.query.one()
+            self.assertEqual(esv.version, 3)
+            self.assertIsNotNone(esv.updated_at)
+
+    def _add_resource_definitions(self, names):
+        with self.app.app_context():
+            for name in names:
+                db.db.session.add(db.ResourceDefinition(
+                    name=name, component_id=7, content={}))
+            db.db.session.commit()
+
+    def test_get_environment_values(self):
+        self._fixture()
+        self._add_resource_definitions(['resdef2', 'resdef3'])
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value', 'key1': 'value1'})
+        self.client.put('/environments/9/lvl1/1/resources/5/values',
+                        data={'key': 'value2'})
+        self.client.put('/environments/9/lvl1/1/resources/6/values',
+                        data={'key': 'value3'})
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                res = self.client.get('/environments/9/lvl1/1/values')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {
+            'resdef1': {'key': 'value2', 'key1': 'value1'},
+            'resdef2': {'key': 'value3'},
+            'resdef3': {},
+        })
+        values_queries = [query for query in queries
+                          if 'resource_values.level_value_id IN' in query]
+        self.assertEqual(len(values_queries), 1)
+
+    def test_get_environment_values_cached(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self._update_values_directly({'key': 'changed'})
+        res = self.client.get('/environments/9/lvl1/1/values')
+        self.assertEqual(res.json, {'resdef1': {'key': 'value'}})
+        res = self.client.get('/environments/9/lvl1/2/values')
+        self.assertEqual(res.json, {'resdef1': {'key': 'changed'}})
+
+    def test_get_environment_values_cached_etag(self):
+        self._fixture()
+        self._put_overlays()
+        cache = self.app.extensions['tuning_box_values_cache']
+        for snapshots in [True, False]:
+            self.app.config['VALUES_SNAPSHOTS'] = snapshots
+            for levels in ['lvl1/1/', 'lvl1/1/lvl2/2/', 'lvl1/2/']:
+                url = '/environments/9/%sresources/5/values' % (levels,)
+                cache.invalidate()
+                res = self.client.get(url)
+                cache.invalidate()
+                self.client.get('/environments/9/%svalues' % (levels,))
+                cached = self.client.get(url)
+                self.assertEqual(cached.json, res.json)
+                self.assertEqual(cached.headers['ETag'], res.headers['ETag'],
+                                 (snapshots, levels))
+
+    def test_get_environment_values_bad_level(self):
+        self._fixture()
+        res = self.client.get('/environments/9/lvlx/1/values')
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_environment_values_404(self):
+        res = self.client.get('/environments/9/values')
+        self.assertEqual(res.status_code, 404)
+
+    def test_put_values_batch(self):
+        self._fixture()
+        self._add_resource_definitions(['resdef2'])
+        self.client.put('/environments/9/lvl1/1/resources/5/values',
+                        data={'key': 'old'})
+        res = self.client.put('/environments/9/values/batch', data=[
+            {'resource': 5, 'values': {'key': 'root'}},
+            {'levels': [['lvl1', '1']], 'resource': 'resdef1',
+             'values': {'key': 'lvl1'}},
+            {'levels': [['lvl1', '1'], ['lvl2', '2']], 'resource': 'resdef2',
+             'values': {'key': 'lvl2'}},
+        ])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json,
+                         [{'status': 201}, {'status': 204}, {'status': 201}])
+        res = self.client.get('/environments/9/lvl1/1/lvl2/2/values')
+        self.assertEqual(res.json, {
+            'resdef1': {'key': 'lvl1'},
+            'resdef2': {'key': 'lvl2'},
+        })
+        res = self.client.get('/environments/9/lvl1/2/values')
+        self.assertEqual(res.json, {'resdef1': {'key': 'root'}, 'resdef2': {}})
+        with self.app.app_context():
+            self.assertEqual(
+                db.EnvironmentHierarchyLevelValue.query.count(), 3)
+
+    def test_put_values_batch_invalidates_cache(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'key': 'value'})
+        self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.client.put('/environments/9/values/batch', data=[
+            {'resource': 5, 'values': {'key': 'changed'}},
+        ])
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.json, {'key': 'changed'})
+
+    def test_put_values_batch_errors(self):
+        self._fixture()
+        res = self.client.put('/environments/9/values/batch', data=[
+            {'resource': 5, 'values': {'key': 'root'}},
+            {'resource': 'resdefx', 'values': {}},
+            {'levels': [['lvlx', '1']], 'resource': 5, 'values': {}},
+            {'levels': [['lvl1', 'a/b']], 'resource': 5, 'values': {}},
+            {'resource': 5, 'values': []},
+        ])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([result['status'] for result in res.json],
+                         [424, 404, 400, 400, 400])
+        self.assertEqual(res.json[2]['message'],
+                         "Unexpected level name 'lvlx'. Expected 'lvl1'.")
+        with self.app.app_context():
+            self.assertEqual(db.ResourceValues.query.count(), 0)
+
+    def test_put_values_batch_404(self):
+        res = self.client.put('/environments/9/values/batch', data=[])
+        self.assertEqual(res.status_code, 404)
+
+    def test_put_resource_values_by_name(self):
         self._fixture()
         res = self.client.put(
             '/environments/9/lvl1/val1/lvl2/val2/resources/resdef1/values',
             data={'k': 'v'},
         )
-        self.assertEqual(res.status_code, 308)
-        self.assertEqual(
-            res.headers['Location'],
-            'http://localhost'
-            '/environments/9/lvl1/val1/lvl2/val2/resources/5/values',
-        )
+        self.assertEqual(res.status_code, 204)
+        with self.app.app_context():
+            esv = db.ResourceValues.query.one()
+            self.assertEqual(esv.resource_definition_id, 5)
+            self.assertEqual(esv.values, {'k': 'v'})
 
-    def test_get_resoruce_values_redirect(self):
+    def test_get_resource_values_by_name(self):
         self._fixture()
         res = self.client.put('/environments/9/resources/5/values',
                               data={'key': 'value'})
         res = self.client.get(
             '/environments/9/lvl1/val1/lvl2/val2/resources/resdef1/values',
         )
-        self.assertEqual(res.status_code, 308)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, {'key': 'value'})
+
+    def _other_component_fixture(self):
+        with self.app.app_context():
+            db.db.session.add(db.Component(
+                id=8,
+                name='component2',
+                resource_definitions=[db.ResourceDefinition(
+                    id=6, name='resdef2', content={})],
+            ))
+            db.db.session.commit()
+
+    def test_get_resource_values_other_environment_404(self):
+        self._fixture()
+        self._other_component_fixture()
+        for resource in ('6', 'resdef2', '42', 'resdefx'):
+            res = self.client.get(
+                '/environments/9/resources/%s/values' % (resource,))
+            self.assertEqual(res.status_code, 404)
+        res = self.client.put('/environments/9/resources/resdef2/values',
+                              data={'key': 'value'})
+        self.assertEqual(res.status_code, 404)
+
+    def test_resource_definitions_cache_invalidated(self):
+        self._fixture()
+        res = self.client.get('/environments/9/resources/resdef1/values')
+        self.assertEqual(res.status_code, 200)
+        self.client.delete('/components/7')
+        res = self.client.get('/environments/9/resources/resdef1/values')
+        self.assertEqual(res.status_code, 404)
+
+    def test_resource_values_without_resource_definitions_cache(self):
+        self.app.config['RESOURCE_DEFINITIONS_CACHE'] = False
+        self._fixture()
+        self._other_component_fixture()
+        res = self.client.put('/environments/9/resources/resdef1/values',
+                              data={'key': 'value'})
+        self.assertEqual(res.status_code, 204)
+        res = self.client.get('/environments/9/resources/5/values')
+        self.assertEqual(res.json, {'key': 'value'})
+        for resource in ('6', 'resdef2'):
+            res = self.client.get(
+                '/environments/9/resources/%s/values' % (resource,))
+            self.assertEqual(res.status_code, 404)
+
+    def test_resource_values_do_not_load_content(self):
+        self.app.config['RESOURCE_DEFINITIONS_CACHE'] = False
+        self._fixture()
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                self.client.put('/environments/9/resources/resdef1/values',
+                                data={'key': 'value'})
+                res = self.client.get('/environments/9/resources/5/values')
+        self.assertEqual(res.json, {'key': 'value'})
+        self.assertTrue(
+            [query for query in queries if 'resource_definition.' in query])
+        self.assertEqual([query for query in queries if 'content' in query],
+                         [])
+
+    def _fan_out(self, path, status_code=200, query=''):
+        res = self.client.get('/environments/9/%sresources/5/values%s' % (
+            path, query))
+        self.assertEqual(res.status_code, status_code)
+        if status_code != 200:
+            return res.json
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line)
+                for line in res.data.decode('utf-8').splitlines()]
+
+    def test_fan_out(self):
+        self._fixture()
+        self._add_resource_definitions(['resdef2'])
+        self._put_overlays()
+        # level value with values of other resource only
+        res = self.client.put(
+            '/environments/9/lvl1/1/lvl2/5/resources/resdef2/values',
+            data={'other': 1})
+        self.assertEqual(res.status_code, 204)
+        expected = []
+        for node in ('2', '3', '5'):
+            levels = [['lvl1', '1'], ['lvl2', node]]
+            res = self.client.get(
+                '/environments/9/lvl1/1/lvl2/%s/resources/5/values' % (
+                    node,))
+            expected.append({'levels': levels, 'values': res.json})
+        self.assertEqual(self._fan_out('lvl1/1/lvl2/*/'), expected)
+        self.assertEqual(self._fan_out('lvl1/*/lvl2/*/'), expected)
+
+    def test_fan_out_first_level(self):
+        self._fixture()
+        self._put_overlays()
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(self._fan_out('lvl1/*/'), [
+            {'levels': [['lvl1', '1']], 'values': res.json}])
+
+    def test_fan_out_queries(self):
+        self._fixture()
+        self._put_overlays()
+        queries_counts = []
+        for node in ('4', '5'):
+            self.client.put(
+                '/environments/9/lvl1/1/lvl2/%s/resources/5/values' % (
+                    node,), data={'node': node})
+            self.app.extensions['tuning_box_values_cache'].invalidate()
+            with self.app.app_context():
+                with self.count_queries() as queries:
+                    lines = self._fan_out('lvl1/*/lvl2/*/')
+            queries_counts.append(len(queries))
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(queries_counts[0], queries_counts[1])
+
+    def test_fan_out_missing_path(self):
+        self._fixture()
+        self._put_overlays()
+        self.assertEqual(self._fan_out('lvl1/7/lvl2/*/'), [])
+
+    def test_fan_out_wildcard_in_the_middle(self):
+        self._fixture()
+        res = self._fan_out('lvl1/*/lvl2/1/', 400)
+        self.assertEqual(res['message'],
+                         'Only trailing levels can have wildcard values.')
+
+    def test_put_wildcard(self):
+        self._fixture()
+        res = self.client.put('/environments/9/lvl1/*/resources/5/values',
+                              data={'key': 'value'})
+        self.assertEqual(res.status_code, 400)
+
+    def _get_keys(self, path, keys, status_code=200, headers=None):
+        res = self.client.get(
+            '/environments/9/%sresources/5/values?keys=%s' % (path, keys),
+            headers=headers)
+        self.assertEqual(res.status_code, status_code)
+        return res
+
+    def test_get_keys(self):
+        self._fixture()
+        self._put_overlays()
+        res = self._get_keys('lvl1/1/lvl2/2/', 'a,e,f.g,x,d.x')
+        self.assertEqual(res.json, {'a': None, 'e': 2.5})
+        res = self._get_keys('lvl1/1/', 'f.g,c,f')
+        self.assertEqual(res.json, {'c': [1, {'x': None}],
+                                    'f': {'g': False}})
+        res = self._get_keys('lvl1/1/', 'f.g')
+        self.assertEqual(res.json, {'f': {'g': False}})
+        res = self._get_keys('lvl1/7/', 'b,e')
+        self.assertEqual(res.json, {'b': 'root'})
+
+    def test_get_keys_etag(self):
+        self._fixture()
+        self._put_overlays()
+        etag = self.client.get(
+            '/environments/9/lvl1/1/resources/5/values').headers['ETag']
+        res = self._get_keys('lvl1/1/', 'a,b')
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(self._get_keys('lvl1/1/', 'b,a').headers['ETag'],
+                         res.headers['ETag'])
+        self.assertNotEqual(self._get_keys('lvl1/1/', 'a').headers['ETag'],
+                            res.headers['ETag'])
+        self._get_keys('lvl1/1/', 'a,b', 304,
+                       {'If-None-Match': res.headers['ETag']})
+        self._get_keys('lvl1/1/', 'a,b', 200, {'If-None-Match': etag})
+
+    def test_get_keys_invalid(self):
+        self._fixture()
+        res = self._get_keys('', 'a,,b', 400)
         self.assertEqual(
-            res.headers['Location'],
-            'http://localhost'
-            '/environments/9/lvl1/val1/lvl2/val2/resources/5/values',
-        )
+            res.json['message'],
+            "Argument 'keys' must be a comma-separated list of keys, "
+            "nested keys joined with dots.")
+        self._get_keys('', 'a.', 400)
+
+    def test_fan_out_keys(self):
+        self._fixture()
+        self._put_overlays()
+        self.assertEqual(self._fan_out('lvl1/1/lvl2/*/', query='?keys=a,f'), [
+            {'levels': [['lvl1', '1'], ['lvl2', '2']],
+             'values': {'a': None, 'f': {}}},
+            {'levels': [['lvl1', '1'], ['lvl2', '3']],
+             'values': {'a': 'other node', 'f': {'g': False}}},
+        ])
+
+    def _corrupt_values(self):
+        with self.app.app_context():
+            db.ResourceValues.query.update({'values': {'corrupted': True},
+                                            'snapshot': {'corrupted': True}})
+            db.db.session.commit()
+        self.app.extensions['tuning_box_values_cache'].invalidate()
+
+    def test_get_keys_from_key_storage(self):
+        self.app.config['VALUES_KEY_STORAGE'] = True
+        self._fixture()
+        self._put_overlays()
+        expected = [self._get_keys(path, 'a,e,f.g,x').json
+                    for path in ('lvl1/1/lvl2/2/', 'lvl1/1/', '')]
+        self.assertEqual(expected[0], {'a': None, 'e': 2.5})
+        self._corrupt_values()
+        self.assertEqual([self._get_keys(path, 'a,e,f.g,x').json
+                          for path in ('lvl1/1/lvl2/2/', 'lvl1/1/', '')],
+                         expected)
+        res = self.client.get('/environments/9/lvl1/1/resources/5/values')
+        self.assertEqual(res.json, {'corrupted': True})
+
+    def test_get_keys_from_key_storage_etag(self):
+        self.app.config['VALUES_KEY_STORAGE'] = True
+        self._fixture()
+        self._put_overlays()
+        res = self._get_keys('lvl1/1/', 'a,b')
+        self.app.extensions['tuning_box_values_cache'].invalidate()
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                self._get_keys('lvl1/1/', 'a,b', 304,
+                               {'If-None-Match': res.headers['ETag']})
+        self.assertFalse(any('resource_values_key' in query
+                             for query in queries))
+        self.client.put('/environments/9/resources/5/values',
+                        data={'a': 2})
+        res = self._get_keys('lvl1/1/', 'a,b', 200,
+                             {'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.json, {'a': 2, 'b': u'\u043a"\\'})
+
+    def test_get_keys_without_indexed_keys(self):
+        self.app.config['VALUES_KEY_STORAGE'] = True
+        self._fixture()
+        self._put_overlays()
+        self.client.put('/environments/9/lvl1/1/resources/5/values',
+                        data={})
+        with self.app.app_context():
+            level_value_id = db.EnvironmentHierarchyLevelValue.query.filter_by(
+                path='lvl1/1/lvl2/3').one().id
+            db.ResourceValuesKey.query.filter_by(
+                level_value_id=level_value_id).delete()
+            db.db.session.commit()
+        self.app.extensions['tuning_box_values_cache'].invalidate()
+        res = self._get_keys('lvl1/1/lvl2/3/', 'a,b')
+        self.assertEqual(res.json, {'a': 'other node', 'b': 'root'})
+        res = self._get_keys('lvl1/1/lvl2/2/', 'a,b')
+        self.assertEqual(res.json, {'a': None, 'b': 'root'})
+
+    def test_get_keys_without_stored_values(self):
+        self._fixture()
+        self._put_overlays()
+        self.app.config['VALUES_KEY_STORAGE'] = True
+        self.client.put('/environments/9/lvl1/1/lvl2/2/resources/5/values',
+                        data={'a': 3})
+        self.app.extensions['tuning_box_values_cache'].invalidate()
+        res = self._get_keys('lvl1/1/lvl2/2/', 'a,b')
+        self.assertEqual(res.json, {'a': 3, 'b': u'\u043a"\\'})
+
+    def _export(self, environment_id=9):
+        res = self.client.get('/environments/%d/export' % (environment_id,))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line)
+                for line in res.data.decode('utf-8').splitlines()]
+
+    def test_export(self):
+        self._fixture()
+        self._put_overlays()
+        lines = self._export()
+        self.assertEqual(lines[:2], [
+            {'type': 'component', 'name': 'component1',
+             'resource_definitions': [
+                 {'name': 'resdef1', 'content': {'key': 'nsname.key'}}]},
+            {'type': 'environment', 'id': 9, 'components': ['component1'],
+             'hierarchy_levels': ['lvl1', 'lvl2']},
+        ])
+        # compare text, NaN is not equal to itself
+        self.assertEqual(json.dumps(
+            [(line['levels'], line['values']) for line in lines[2:]],
+            sort_keys=True,
+        ), json.dumps([
+            ([], {'a': 1, 'b': 'root', 'c': [1, {'x': None}], 'd': True}),
+            ([['lvl1', '1']],
+             {'b': u'\u043a"\\', 'e': 2.5, 'f': {'g': False}}),
+            ([['lvl1', '1'], ['lvl2', '2']],
+             {'a': None, 'f': {}, 'h': 12345678901234,
+              'i': 12345678901234567890, 'n': 0.30000000000000004,
+              'm': -0.0}),
+            ([['lvl1', '1'], ['lvl2', '3']],
+             {'a': 'other node', 'q"x': 'quoted', 'o': float('nan')}),
+        ], sort_keys=True))
+        self.assertEqual(set(line['resource'] for line in lines[2:]),
+                         set(['resdef1']))
+
+    def test_export_in_chunks(self):
+        self._fixture()
+        self._put_overlays()
+        lines = self._export()
+        self.app.config['EXPORT_CHUNK_SIZE'] = 1
+        self.assertEqual(self._export(), lines)
+
+    def test_export_empty(self):
+        self._fixture()
+        lines = self._export()
+        self.assertEqual([line['type'] for line in lines],
+                         ['component', 'environment'])
+
+    def test_export_not_found(self):
+        res = self.client.get('/environments/9/export')
+        self.assertEqual(res.status_code, 404)
+
+    def test_clone(self):
+        self._fixture()
+        self._put_overlays()
+        lines = self._export()
+        res = self.client.post('/environments/9/clone')
+        self.assertEqual(res.status_code, 201)
+        clone_id = res.json['id']
+        self.assertEqual(res.json['components'], [7])
+        self.assertEqual(res.json['hierarchy_levels'], ['lvl1', 'lvl2'])
+        lines[1]['id'] = clone_id
+        self.assertEqual(self._export(clone_id), lines)
+        self.assertEqual(self._get_snapshots(clone_id),
+                         self._get_snapshots())
+        with self.app.app_context():
+            level_names = db.db.session.query(
+                db.EnvironmentHierarchyLevel.environment_id,
+                db.EnvironmentHierarchyLevel.name,
+            ).select_from(db.ResourceValues).join(
+                db.ResourceValues.level_value,
+            ).outerjoin(
+                db.EnvironmentHierarchyLevelValue.level,
+            ).filter(
+                db.ResourceValues.environment_id == clone_id,
+            ).order_by(db.ResourceValues.id).all()
+        self.assertEqual(level_names, [(None, None), (clone_id, 'lvl1'),
+                                       (clone_id, 'lvl2'),
+                                       (clone_id, 'lvl2')])
+
+    def test_clone_is_independent(self):
+        self._fixture()
+        self._put_overlays()
+        clone_id = self.client.post('/environments/9/clone').json['id']
+        url = '/environments/%d/lvl1/1/resources/5/values'
+        self.client.put(url % (clone_id,), data={'changed': True})
+        self.client.put('/environments/%d/lvl1/2/resources/5/values' % (
+            clone_id,), data={'new': True})
+        self.assertEqual(self.client.get(url % (clone_id,)).json,
+                         {'a': 1, 'b': 'root', 'c': [1, {'x': None}],
+                          'd': True, 'changed': True})
+        res = self.client.get(url % (9,))
+        self.assertEqual(res.json['e'], 2.5)
+        self.assertNotIn('changed', res.json)
+        res = self.client.get('/environments/9/lvl1/2/resources/5/values')
+        self.assertNotIn('new', res.json)
+
+    def test_clone_not_found(self):
+        res = self.client.post('/environments/9/clone')
+        self.assertEqual(res.status_code, 404)
+
+    def _overrides(self, key, path='', environment_id=9):
+        res = self.client.get(
+            '/environments/%d/%sresources/5/overrides?key=%s' % (
+                environment_id, path, key))
+        self.assertEqual(res.status_code, 200)
+        return res.json
+
+    def test_overrides(self):
+        self._fixture()
+        self._put_overlays()
+        self.assertEqual(self._overrides('a'), [
+            [],
+            [['lvl1', '1'], ['lvl2', '2']],
+            [['lvl1', '1'], ['lvl2', '3']],
+        ])
+        self.assertEqual(self._overrides('f.g'), [[['lvl1', '1']]])
+        self.assertEqual(self._overrides('f'), [
+            [['lvl1', '1']],
+            [['lvl1', '1'], ['lvl2', '2']],
+        ])
+        self.assertEqual(self._overrides('x'), [])
+        self.assertEqual(self._overrides('c.x'), [])
+
+    def test_overrides_subtree(self):
+        self._fixture()
+        self._put_overlays()
+        self.assertEqual(self._overrides('a', 'lvl1/1/lvl2/3/'),
+                         [[['lvl1', '1'], ['lvl2', '3']]])
+        self.assertEqual(self._overrides('f', 'lvl1/1/'), [
+            [['lvl1', '1']],
+            [['lvl1', '1'], ['lvl2', '2']],
+        ])
+        self.assertEqual(self._overrides('a', 'lvl1/2/'), [])
+
+    def test_overrides_follow_writes(self):
+        self._fixture()
+        self._put_overlays()
+        self.client.put('/environments/9/lvl1/1/lvl2/3/resources/5/values',
+                        data={'b': 1})
+        res = self.client.patch('/environments/9/lvl1/1/resources/5/values',
+                                data={'a': 2, 'e': None},
+                                content_type='application/merge-patch+json')
+        self.assertEqual(res.status_code, 204)
+        self.assertEqual(self._overrides('a'), [
+            [],
+            [['lvl1', '1']],
+            [['lvl1', '1'], ['lvl2', '2']],
+        ])
+        self.assertEqual(self._overrides('e'), [])
+        self.assertEqual(self._overrides('b'), [
+            [],
+            [['lvl1', '1']],
+            [['lvl1', '1'], ['lvl2', '3']],
+        ])
+
+    def test_overrides_of_clone(self):
+        self._fixture()
+        self._put_overlays()
+        clone_id = self.client.post('/environments/9/clone').json['id']
+        self.client.delete('/environments/9')
+        self.assertEqual(self._overrides('a', environment_id=clone_id), [
+            [],
+            [['lvl1', '1'], ['lvl2', '2']],
+            [['lvl1', '1'], ['lvl2', '3']],
+        ])
+
+    def test_overrides_without_key(self):
+        self._fixture()
+        res = self.client.get('/environments/9/resources/5/overrides')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json['message'], "Argument 'key' is required.")
+
+    def test_overrides_key_too_long(self):
+        self._fixture()
+        self.client.put('/environments/9/resources/5/values',
+                        data={'k' * 255: 1, 'l' * 256: 2})
+        self.assertEqual(self._overrides('k' * 255), [[]])
+        res = self.client.get(
+            '/environments/9/resources/5/overrides?key=' + 'l' * 256)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json['message'],
+                         "Argument 'key' must be at most 255 characters "
+                         "long.")
+
+    def test_overrides_bad_level(self):
+        self._fixture()
+        res = self.client.get(
+            '/environments/9/lvl2/1/resources/5/overrides?key=a')
+        self.assertEqual(res.status_code, 400)
+
+    def _import(self, body, status_code=201):
+        res = self.client.post('/environments/import', data=body,
+                               content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, status_code)
+        return res.json
+
+    def _export_body(self):
+        return self.client.get('/environments/9/export').data
+
+    def test_import_exported(self):
+        self._fixture()
+        self._put_overlays()
+        lines = self._export()
+        self.app.config['IMPORT_CHUNK_SIZE'] = 3
+        res = self._import(self._export_body())
+        self.assertEqual(res['components'], [7])
+        self.assertEqual(res['hierarchy_levels'], ['lvl1', 'lvl2'])
+        lines[1]['id'] = res['id']
+        self.assertEqual(self._export(res['id']), lines)
+        for path in ('', 'lvl1/1/', 'lvl1/1/lvl2/2/', 'lvl1/1/lvl2/3/'):
+            res_values = [self.client.get(
+                '/environments/%d/%sresources/resdef1/values' % (
+                    environment_id, path)).json
+                for environment_id in (9, res['id'])]
+            self.assertEqual(res_values[1], res_values[0])
+        with self.app.app_context():
+            rows = db.ResourceValues.query.filter_by(
+                environment_id=res['id']).all()
+            self.assertEqual(len(rows), 4)
+            for row in rows:
+                self.assertIsNotNone(row.snapshot)
+                self.assertEqual(row.version, 1)
+
+    def test_import_json_array(self):
+        records = [
+            {'type': 'component', 'name': 'component2',
+             'resource_definitions': [{'name': 'resdef2', 'content': {}}]},
+            {'type': 'environment', 'components': ['component2'],
+             'hierarchy_levels': ['lvl1']},
+            {'type': 'values', 'levels': [], 'resource': 'resdef2',
+             'values': {'a': 1}},
+            {'type': 'values', 'levels': [['lvl1', '1']],
+             'resource': 'resdef2', 'values': {'b': 2}},
+        ]
+        res = self._import(json.dumps(records).encode('utf-8'))
+        res = self.client.get(
+            '/environments/%d/lvl1/1/resources/resdef2/values' % (
+                res['id'],))
+        self.assertEqual(res.json, {'a': 1, 'b': 2})
+
+    def test_import_adds_resource_definitions(self):
+        self._fixture()
+        self.client.get('/environments/9/resources/resdef1/values')
+        records = [
+            {'type': 'component', 'name': 'component1',
+             'resource_definitions': [{'name': 'resdef2', 'content': {}}]},
+            {'type': 'environment', 'components': ['component1']},
+        ]
+        self._import(json.dumps(records).encode('utf-8'))
+        res = self.client.put('/environments/9/resources/resdef2/values',
+                              data={'a': 1})
+        self.assertEqual(res.status_code, 204)
+
+    def test_import_unknown_component(self):
+        body = b'{"type": "environment", "components": ["missing"]}'
+        res = self._import(body, 400)
+        self.assertEqual(res['message'],
+                         'Line 1: Unknown components: missing.')
+        with self.app.app_context():
+            self.assertEqual(db.Environment.query.count(), 0)
+
+    def test_import_bad_values_record(self):
+        self._fixture()
+        body = self._export_body() + b'\n{"type": "values", "levels": []}\n'
+        res = self._import(body, 404)
+        self.assertEqual(
+            res['message'],
+            'Line 4: Resource None not found in environment.')
+        with self.app.app_context():
+            self.assertEqual([e.id for e in db.Environment.query], [9])
+            self.assertEqual(db.ResourceValues.query.filter_by(
+                environment_id=10).count(), 0)
+
+    def test_import_bad_values_record_after_chunks(self):
+        self._fixture()
+        self._put_overlays()
+        self.app.config['IMPORT_CHUNK_SIZE'] = 1
+        body = self._export_body() + b'\n{"type": "values", "levels": []}\n'
+        self._import(body, 404)
+        with self.app.app_context():
+            self.assertEqual([e.id for e in db.Environment.query], [9])
+            self.assertEqual(db.ResourceValues.query.filter(
+                db.ResourceValues.environment_id != 9).count(), 0)
+            self.assertEqual(db.EnvironmentHierarchyLevel.query.filter(
+                db.EnvironmentHierarchyLevel.environment_id != 9).count(), 0)
+
+    def test_import_invalid_json(self):
+        res = self._import(b'\n{"type": ', 400)
+        self.assertIn('Invalid JSON on line 2', res['message'])
+
+    def test_import_without_environment(self):
+        res = self._import(b'{"type": "component", "name": "c"}\n', 400)
+        self.assertEqual(res['message'], 'No environment to import.')
 
 
 class TestAppPrefixed(base.PrefixedTestCaseMixin, TestApp):
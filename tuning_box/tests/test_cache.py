@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from tuning_box import cache
+from tuning_box.tests import base
+
+
+class TestValuesCache(base.TestCase):
+    def setUp(self):
+        super(TestValuesCache, self).setUp()
+        self.cache = cache.ValuesCache(3)
+
+    def _set(self, key, value):
+        self.cache.set(key, value, self.cache.generation)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get((1, 2, ())))
+
+    def test_set_get(self):
+        self._set((1, 2, ()), {'k': 'v'})
+        self.assertEqual(self.cache.get((1, 2, ())), {'k': 'v'})
+
+    def test_disabled(self):
+        self.cache = cache.ValuesCache(0)
+        self._set((1, 2, ()), {'k': 'v'})
+        self.assertIsNone(self.cache.get((1, 2, ())))
+
+    def test_evict_least_recently_used(self):
+        for i in range(3):
+            self._set((1, i, ()), i)
+        self.cache.get((1, 0, ()))
+        self._set((1, 3, ()), 3)
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get((1, 0, ())), 0)
+        self.assertIsNone(self.cache.get((1, 1, ())))
+
+    def test_set_stale_generation(self):
+        generation = self.cache.generation
+        self.cache.invalidate(environment_id=1)
+        self.cache.set((1, 2, ()), {'k': 'v'}, generation)
+        self.assertIsNone(self.cache.get((1, 2, ())))
+
+    def test_invalidate_levels_prefix(self):
+        self._set((1, 2, ()), 'root')
+        self._set((1, 2, (('lvl1', '1'),)), 'lvl1')
+        self._set((1, 2, (('lvl1', '1'), ('lvl2', '2'))), 'lvl2')
+        self.cache.invalidate(1, 2, [('lvl1', '1')])
+        self.assertEqual(self.cache.get((1, 2, ())), 'root')
+        self.assertIsNone(self.cache.get((1, 2, (('lvl1', '1'),))))
+        self.assertIsNone(
+            self.cache.get((1, 2, (('lvl1', '1'), ('lvl2', '2')))))
+
+    def test_invalidate_other_levels(self):
+        self._set((1, 2, (('lvl1', '1'),)), 'lvl1')
+        self.cache.invalidate(1, 2, [('lvl1', '2')])
+        self.assertEqual(self.cache.get((1, 2, (('lvl1', '1'),))), 'lvl1')
+
+    def test_invalidate_environment(self):
+        self._set((1, 2, ()), 'env1')
+        self._set((3, 2, ()), 'env3')
+        self.cache.invalidate(environment_id=1)
+        self.assertIsNone(self.cache.get((1, 2, ())))
+        self.assertEqual(self.cache.get((3, 2, ())), 'env3')
+
+    def test_invalidate_resource_definition(self):
+        self._set((1, 2, ()), 'res2')
+        self._set((1, 3, ()), 'res3')
+        self.cache.invalidate(resource_definition_id=2)
+        self.assertIsNone(self.cache.get((1, 2, ())))
+        self.assertEqual(self.cache.get((1, 3, ())), 'res3')
+
+
+class TestResourceDefinitionsCache(base.TestCase):
+    def setUp(self):
+        super(TestResourceDefinitionsCache, self).setUp()
+        self.cache = cache.ResourceDefinitionsCache()
+
+    def _set(self, environment_id, value):
+        self.cache.set(environment_id, value, self.cache.generation)
+
+    def test_set_get(self):
+        self._set(1, {'name': (2, 'name')})
+        self.assertEqual(self.cache.get(1), {'name': (2, 'name')})
+        self.assertIsNone(self.cache.get(2))
+
+    def test_disabled(self):
+        self.cache = cache.ResourceDefinitionsCache(enabled=False)
+        self._set(1, {})
+        self.assertIsNone(self.cache.get(1))
+
+    def test_set_stale_generation(self):
+        generation = self.cache.generation
+        self.cache.invalidate()
+        self.cache.set(1, {}, generation)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_invalidate_environment(self):
+        self._set(1, {})
+        self._set(2, {})
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.get(2), {})
+
+    def test_invalidate_all(self):
+        self._set(1, {})
+        self._set(2, {})
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get(1))
+        self.assertIsNone(self.cache.get(2))
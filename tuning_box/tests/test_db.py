@@ -18,9 +18,11 @@ os.environ.setdefault("OS_TEST_DBAPI_ADMIN_CONNECTION", "sqlite:///testdb")
 
 from alembic import command as alembic_command
 from alembic import config as alembic_config
+import fixtures
 import flask
 from oslo_db.sqlalchemy import test_base
 from oslo_db.sqlalchemy import test_migrations
+import sqlalchemy
 import testscenarios
 from werkzeug import exceptions
 
@@ -56,6 +58,45 @@ class TestDB(_DBTestCase):
             self.assertIsNotNone(res.id)
             self.assertEqual(res.name, "nsname")
 
+    def test_get_or_create_relationships(self):
+        with self.app.app_context():
+            environment = db.Environment()
+            db.db.session.add(environment)
+            lvl1 = db.get_or_create(db.EnvironmentHierarchyLevel,
+                                    environment=environment, name='lvl1',
+                                    parent=None)
+            lvl2 = db.get_or_create(db.EnvironmentHierarchyLevel,
+                                    environment=environment, name='lvl2',
+                                    parent=lvl1)
+            self.assertEqual(lvl2.environment_id, environment.id)
+            self.assertEqual(lvl2.parent, lvl1)
+            self.assertIsNone(lvl1.parent_id)
+            self.assertEqual(
+                db.get_or_create(db.EnvironmentHierarchyLevel,
+                                 environment=environment, name='lvl2',
+                                 parent=lvl1),
+                lvl2)
+
+    def test_lock_resource_values(self):
+        with self.app.app_context():
+            with self.count_queries() as queries:
+                db.lock_resource_values(1, [2])
+        # SQLite has one writer at a time, it is taken by a no-op UPDATE
+        self.assertEqual([q.split()[0] for q in queries if q != 'BEGIN'],
+                         ['UPDATE'])
+
+    def test_lock_resource_values_postgresql(self):
+        keys = []
+        with self.app.app_context():
+            self.useFixture(fixtures.MockPatchObject(
+                db.db.session.get_bind().dialect, 'name', 'postgresql'))
+            self.useFixture(fixtures.MockPatchObject(
+                db.db.session, 'execute',
+                lambda statement, params: keys.append(params['key'])))
+            db.lock_resource_values(1, [3, 2, 3])
+        table_name = db.ResourceValues.__tablename__
+        self.assertEqual(keys, [table_name + ':1:2', table_name + ':1:3'])
+
 
 class TestGetByIdOrName(_DBTestCase):
     def setUp(self):
@@ -89,6 +130,29 @@ class TestGetByIdOrName(_DBTestCase):
             self.component.name + "_",
         )
 
+    def test_id_by_id(self):
+        res = db.Component.query.get_id_by_id_or_name(self.component.id)
+        self.assertEqual(self.component.id, res)
+
+    def test_id_by_name(self):
+        res = db.Component.query.get_id_by_id_or_name(self.component.name)
+        self.assertEqual(self.component.id, res)
+
+    def test_id_by_id_fail(self):
+        self.assertRaises(
+            exceptions.NotFound,
+            db.Component.query.get_id_by_id_or_name,
+            self.component.id + 1,
+        )
+
+    def test_id_by_filtered_name_fail(self):
+        self.assertRaises(
+            exceptions.NotFound,
+            db.Component.query.filter_by(id=self.component.id + 1)
+            .get_id_by_id_or_name,
+            self.component.name,
+        )
+
 
 class TestDBPrefixed(base.PrefixedTestCaseMixin, TestDB):
     pass
@@ -140,6 +204,161 @@ class TestEnvironmentHierarchyLevelPrefixed(base.PrefixedTestCaseMixin,
     pass
 
 
+class TestUpsert(_DBTestCase):
+    def setUp(self):
+        super(TestUpsert, self).setUp()
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        session = db.db.session
+        component = db.Component(name="compname")
+        environment = db.Environment()
+        session.add_all([component, environment])
+        session.flush()
+        self.level = db.EnvironmentHierarchyLevel(
+            environment_id=environment.id, name="lvl1")
+        self.resdef = db.ResourceDefinition(name="res", component=component)
+        session.add_all([self.level, self.resdef])
+        session.flush()
+        self.environment_id = environment.id
+
+    def _get_level_value_ids(self):
+        return db.EnvironmentHierarchyLevelValue.get_or_create_ids(
+            [self.level], [(('lvl1', 'val1'),)])
+
+    def _get_values(self):
+        return [(esv.level_value_id, esv.values, esv.version)
+                for esv in db.ResourceValues.query.order_by(
+                    db.ResourceValues.level_value_id)]
+
+    def test_get_or_create_ids_twice(self):
+        ids = self._get_level_value_ids()
+        self.assertEqual(self._get_level_value_ids(), ids)
+        self.assertEqual(db.EnvironmentHierarchyLevelValue.query.count(), 2)
+
+    def test_skip_conflicting_root(self):
+        ids = self._get_level_value_ids()
+        db.upsert(db.EnvironmentHierarchyLevelValue.__table__, [{
+            'level_id': None, 'parent_id': None, 'value': None, 'path': '',
+        }])
+        root_ids = [lv.id for lv in db.EnvironmentHierarchyLevelValue.query
+                    .filter_by(level_id=None)]
+        self.assertEqual(root_ids, [ids[()]])
+
+    def test_set_values(self):
+        ids = self._get_level_value_ids()
+        db.ResourceValues.set_values(self.environment_id, [
+            (self.resdef.id, ids[()], {'k': 'root'}),
+        ])
+        db.ResourceValues.set_values(self.environment_id, [
+            (self.resdef.id, ids[()], {'k': 'new root'}),
+            (self.resdef.id, ids[(('lvl1', 'val1'),)], {'k': 'lvl1'}),
+        ])
+        self.assertEqual(self._get_values(), [
+            (ids[()], {'k': 'new root'}, 2),
+            (ids[(('lvl1', 'val1'),)], {'k': 'lvl1'}, 1),
+        ])
+
+
+class TestUpsertFallback(TestUpsert):
+    def setUp(self):
+        super(TestUpsertFallback, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'tuning_box.db.supports_upsert', lambda: False))
+
+
+class TestUpsertPrefixed(base.PrefixedTestCaseMixin, TestUpsert):
+    pass
+
+
+class TestCollectLevelValues(_DBTestCase):
+    def setUp(self):
+        super(TestCollectLevelValues, self).setUp()
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        session = db.db.session
+        environment = db.Environment()
+        lvl1 = db.EnvironmentHierarchyLevel(environment=environment,
+                                            name='lvl1')
+        lvl2 = db.EnvironmentHierarchyLevel(environment=environment,
+                                            name='lvl2', parent=lvl1)
+        resdef = db.ResourceDefinition(
+            name='res', component=db.Component(name='compname'))
+        session.add_all([environment, resdef])
+        session.flush()
+        ids = db.EnvironmentHierarchyLevelValue.get_or_create_ids(
+            [lvl1, lvl2], [
+                (('lvl1', '1'), ('lvl2', '1')),
+                (('lvl1', '1'), ('lvl2', '2')),
+                (('lvl1', '2'), ('lvl2', '1')),
+                (('lvl1', '3'), ('lvl2', '1')),
+            ])
+        db.ResourceValues.set_values(environment.id, [
+            (resdef.id, ids[(('lvl1', '1'), ('lvl2', '1'))], {}),
+            (resdef.id, ids[(('lvl1', '3'),)], {}),
+        ])
+        session.commit()
+
+    def _get_paths(self):
+        return sorted(level_value.path for level_value in
+                      db.EnvironmentHierarchyLevelValue.query)
+
+    def _test_collect(self, batch_size):
+        self.assertEqual(db.collect_level_values(batch_size), 4)
+        self.assertEqual(self._get_paths(), [
+            '', 'lvl1/1', 'lvl1/1/lvl2/1', 'lvl1/3'])
+        self.assertEqual(db.collect_level_values(batch_size), 0)
+
+    def test_collect(self):
+        self._test_collect(1000)
+
+    def test_collect_in_batches(self):
+        self._test_collect(1)
+
+    def test_collect_retries_conflicts(self):
+        execute = db.db.session.execute
+        conflicts = []
+
+        def execute_conflicting_once(statement, *args, **kwargs):
+            if not conflicts and isinstance(statement, sqlalchemy.sql.Delete):
+                conflicts.append(statement)
+                raise sqlalchemy.exc.IntegrityError(str(statement), {}, None)
+            return execute(statement, *args, **kwargs)
+
+        self.useFixture(fixtures.MockPatchObject(
+            db.db.session, 'execute', execute_conflicting_once))
+        self._test_collect(1)
+        self.assertEqual(len(conflicts), 1)
+
+    def test_collect_keeps_root(self):
+        db.ResourceValues.query.delete()
+        self.assertEqual(db.collect_level_values(), 7)
+        self.assertEqual(self._get_paths(), [''])
+
+
+class TestCollectLevelValuesPrefixed(base.PrefixedTestCaseMixin,
+                                     TestCollectLevelValues):
+    pass
+
+
+class TestResourceValuesKey(base.TestCase):
+    def test_key_paths(self):
+        paths = db.ResourceValuesKey.key_paths(
+            {'a': 1, 'b': {'c': {'d': None}, 'e': []}, 'f': {}})
+        self.assertEqual(sorted(paths), ['a', 'b', 'b.c', 'b.c.d', 'b.e',
+                                         'f'])
+
+    def test_key_paths_not_object(self):
+        self.assertEqual(list(db.ResourceValuesKey.key_paths([{'a': 1}])),
+                         [])
+
+    def test_key_paths_too_long(self):
+        paths = db.ResourceValuesKey.key_paths(
+            {'a': {'b' * 254: 1, 'c': 2}, 'd' * 256: {'e': 3}})
+        self.assertEqual(sorted(paths), ['a', 'a.c'])
+
+
 class TestMigrationsSync(testscenarios.WithScenarios,
                          test_migrations.ModelsMigrationsSync,
                          base.TestCase,
@@ -168,6 +387,61 @@ class TestMigrationsSync(testscenarios.WithScenarios,
         alembic_command.upgrade(config, 'head')
 
 
+class TestLevelValuePathMigration(base.TestCase):
+    def setUp(self):
+        super(TestLevelValuePathMigration, self).setUp()
+        path = self.useFixture(fixtures.TempDir()).path
+        url = 'sqlite:///' + os.path.join(path, 'test.db')
+        self.engine = sqlalchemy.create_engine(url)
+        self.addCleanup(self.engine.dispose)
+        self.config = alembic_config.Config()
+        self.config.set_main_option('sqlalchemy.url', url)
+        self.config.set_main_option('script_location',
+                                    'tuning_box/migrations')
+        self.config.set_main_option('version_table', 'alembic_version')
+
+    def _insert(self, table_name, *rows):
+        table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(),
+                                 autoload_with=self.engine)
+        self.engine.execute(table.insert(), list(rows))
+
+    def test_merge_duplicates(self):
+        alembic_command.upgrade(self.config, '3b2a0f134e45')
+        self._insert('environment', {'id': 1})
+        self._insert('environment_hierarchy_level',
+                     {'id': 1, 'environment_id': 1, 'name': 'lvl1'},
+                     {'id': 2, 'environment_id': 1, 'name': 'lvl2',
+                      'parent_id': 1})
+        self._insert(
+            'environment_hierarchy_level_value',
+            {'id': 1, 'level_id': None, 'parent_id': None, 'value': None},
+            {'id': 2, 'level_id': 1, 'parent_id': 1, 'value': 'a'},
+            {'id': 3, 'level_id': 1, 'parent_id': 1, 'value': 'a'},
+            {'id': 4, 'level_id': 2, 'parent_id': 2, 'value': 'b'},
+            {'id': 5, 'level_id': 2, 'parent_id': 3, 'value': 'b'},
+            {'id': 6, 'level_id': 2, 'parent_id': 3, 'value': 'c'},
+        )
+        self._insert('component', {'id': 1, 'name': 'c'})
+        self._insert('resource_definition',
+                     {'id': 1, 'name': 'r', 'component_id': 1})
+        self._insert('resource_values', *[
+            {'id': values_id, 'environment_id': 1,
+             'resource_definition_id': 1, 'level_value_id': level_value_id,
+             'values': '{}'}
+            for values_id, level_value_id in [(1, 2), (2, 3), (3, 5), (4, 6)]
+        ])
+        alembic_command.upgrade(self.config, '7552feaaf6a1')
+        self.assertEqual(self.engine.execute(
+            'SELECT id, parent_id, path FROM environment_hierarchy_level_value'
+            ' ORDER BY id').fetchall(),
+            [(1, None, ''), (2, 1, 'lvl1/a'), (4, 2, 'lvl1/a/lvl2/b'),
+             (6, 2, 'lvl1/a/lvl2/c')])
+        self.assertEqual(self.engine.execute(
+            'SELECT id, level_value_id FROM resource_values'
+            ' ORDER BY id').fetchall(),
+            [(2, 2), (3, 4), (4, 6)])
+
+
 class TestMigrationsSyncPrefixed(base.PrefixedTestCaseMixin,
                                  TestMigrationsSync):
     def include_object(self, object_, name, type_, reflected, compare_to):
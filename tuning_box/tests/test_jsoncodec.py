@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import math
+
+import flask
+
+from tuning_box import jsoncodec
+from tuning_box.tests import base
+
+VALUE = {'key': ['value', 1, 2.5, None, True], u'\u043a': {'nested': {}}}
+
+
+class TestJsonCodec(base.TestCase):
+    def test_roundtrip(self):
+        for backend in jsoncodec.BACKENDS:
+            codec = jsoncodec.JsonCodec(backend)
+            self.assertEqual(codec.loads(codec.dumps(VALUE)), VALUE, backend)
+
+    def test_auto(self):
+        codec = jsoncodec.JsonCodec()
+        self.assertIn(codec.backend, jsoncodec.BACKENDS)
+        self.assertEqual(codec.loads(codec.dumps(VALUE)), VALUE)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, jsoncodec.JsonCodec, 'nosuchjson')
+
+    def test_big_integer(self):
+        for backend in jsoncodec.BACKENDS:
+            codec = jsoncodec.JsonCodec(backend)
+            for number in (2 ** 70, -2 ** 63 - 1, 2 ** 64 - 1):
+                value = codec.loads(codec.dumps({'key': number}))['key']
+                self.assertIs(type(value), int, backend)
+                self.assertEqual(value, number, backend)
+
+    def test_non_finite_floats(self):
+        for backend in jsoncodec.BACKENDS:
+            codec = jsoncodec.JsonCodec(backend)
+            data = codec.dumps([float('nan'), float('inf'), -float('inf'),
+                                None])
+            value = codec.loads(data)
+            self.assertTrue(math.isnan(value[0]), backend)
+            self.assertEqual(value[1:], [float('inf'), -float('inf'), None],
+                             backend)
+
+    def test_read_stdlib_json(self):
+        data = json.dumps({'big': 2 ** 70, 'nan': float('nan'),
+                           'inf': float('inf'), 's': 'NaN'})
+        for backend in jsoncodec.BACKENDS:
+            value = jsoncodec.JsonCodec(backend).loads(data)
+            self.assertIs(type(value['big']), int, backend)
+            self.assertTrue(math.isnan(value['nan']), backend)
+            self.assertEqual(value['inf'], float('inf'), backend)
+            self.assertEqual(value['s'], 'NaN', backend)
+
+    def test_compress_above_threshold(self):
+        codec = jsoncodec.JsonCodec(compress_threshold=100)
+        big = {'key': 'value' * 100}
+        data = codec.dumps(big)
+        self.assertTrue(data.startswith(jsoncodec.ZLIB_PREFIX))
+        self.assertLess(len(data), 100)
+        self.assertEqual(codec.loads(data), big)
+
+    def test_no_compress_below_threshold(self):
+        codec = jsoncodec.JsonCodec(compress_threshold=100)
+        data = codec.dumps({'key': 'value'})
+        self.assertFalse(data.startswith(jsoncodec.ZLIB_PREFIX))
+
+    def test_read_other_codec(self):
+        plain = jsoncodec.JsonCodec('json')
+        compressing = jsoncodec.JsonCodec(compress_threshold=1)
+        self.assertEqual(compressing.loads(plain.dumps(VALUE)), VALUE)
+        self.assertEqual(plain.loads(compressing.dumps(VALUE)), VALUE)
+
+    def test_get_codec_from_app_config(self):
+        app = flask.Flask(__name__)
+        app.config['JSON_CODEC'] = 'json'
+        app.config['JSON_COMPRESS_THRESHOLD'] = 10
+        with app.app_context():
+            codec = jsoncodec.get_codec()
+            self.assertIs(jsoncodec.get_codec(), codec)
+        self.assertEqual(codec.backend, 'json')
+        self.assertEqual(codec.compress_threshold, 10)
+
+    def test_get_codec_without_app(self):
+        self.assertIs(jsoncodec.get_codec(), jsoncodec._default_codec)
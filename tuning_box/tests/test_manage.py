@@ -0,0 +1,160 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+
+import fixtures
+
+from tuning_box import app
+from tuning_box import db
+from tuning_box import manage
+from tuning_box.tests import base
+
+
+class _ManageTestCase(base.TestCase):
+    def setUp(self):
+        super(_ManageTestCase, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.database_url = 'sqlite:///' + os.path.join(tempdir, 'db.sqlite')
+        self.app = app.build_app()
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = self.database_url
+        with self.app.app_context():
+            db.db.create_all()
+            component = db.Component(name='component1', resource_definitions=[
+                db.ResourceDefinition(name='resdef1', content={})])
+            level = db.EnvironmentHierarchyLevel(name='lvl1')
+            environment = db.Environment(components=[component],
+                                         hierarchy_levels=[level])
+            db.db.session.add(environment)
+            db.db.session.commit()
+            self.environment_id = environment.id
+        client = self.app.test_client()
+        for path, values in [('', {'a': 1, 'b': 1}), ('lvl1/1/', {'b': 2})]:
+            client.put(
+                '/environments/%d/%sresources/1/values' % (
+                    self.environment_id, path),
+                data=json.dumps(values),
+                content_type='application/json')
+        self.stdout = self.useFixture(fixtures.StringStream('stdout')).stream
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout', self.stdout))
+
+    def _manage(self, *args):
+        return manage.main(['--database-url', self.database_url] + list(args))
+
+
+class TestSnapshots(_ManageTestCase):
+    def _corrupt_snapshot(self):
+        with self.app.app_context():
+            db.db.session.execute(
+                "UPDATE resource_values SET snapshot = '{}'"
+                " WHERE level_value_id != ("
+                "  SELECT min(level_value_id) FROM resource_values)")
+            db.db.session.commit()
+
+    def _get_rows(self):
+        with self.app.app_context():
+            return db.db.session.query(
+                db.ResourceValues.snapshot, db.ResourceValues.version,
+            ).order_by(db.ResourceValues.id).all()
+
+    def test_check_clean(self):
+        self.assertEqual(self._manage('snapshots', 'check'), 0)
+
+    def test_check_drift(self):
+        self._corrupt_snapshot()
+        rows = self._get_rows()
+        self.assertEqual(self._manage('snapshots', 'check'), 1)
+        self.assertEqual(self._get_rows(), rows)
+        self.stdout.seek(0)
+        self.assertIn('environment %d resource 1: 1 rows out of date' % (
+            self.environment_id,), self.stdout.read())
+
+    def test_rebuild(self):
+        self._corrupt_snapshot()
+        self.assertEqual(self._manage('snapshots', 'rebuild'), 0)
+        self.assertEqual(self._manage('snapshots', 'check'), 0)
+        self.assertEqual(self._get_rows(), [
+            ({'a': 1, 'b': 1}, 1),
+            ({'a': 1, 'b': 2}, 2),
+        ])
+
+    def test_check_other_environment(self):
+        self._corrupt_snapshot()
+        self.assertEqual(self._manage('snapshots', 'check', '--environment',
+                                      str(self.environment_id + 1)), 0)
+
+
+class TestKeys(_ManageTestCase):
+    def _get_keys(self):
+        with self.app.app_context():
+            return db.db.session.query(
+                db.ResourceValuesKey.level_value_id,
+                db.ResourceValuesKey.key,
+            ).order_by(db.ResourceValuesKey.level_value_id,
+                       db.ResourceValuesKey.key).all()
+
+    def test_rebuild(self):
+        keys = self._get_keys()
+        self.assertEqual(len(keys), 3)
+        with self.app.app_context():
+            db.ResourceValuesKey.query.delete()
+            db.db.session.commit()
+        self.assertEqual(self._manage('keys', 'rebuild',
+                                      '--chunk-size', '1'), 0)
+        self.assertEqual(self._get_keys(), keys)
+        self.stdout.seek(0)
+        self.assertEqual(self.stdout.read(), 'rebuilt keys of 2 rows\n')
+
+    def test_rebuild_values(self):
+        self.assertEqual(self._manage('keys', 'rebuild', '--values'), 0)
+        with self.app.app_context():
+            rows = db.db.session.query(
+                db.ResourceValuesKey.key, db.ResourceValuesKey.value,
+            ).order_by(db.ResourceValuesKey.id).all()
+        self.assertEqual(sorted(rows), [('a', 1), ('b', 1), ('b', 2)])
+
+
+class TestExportImport(_ManageTestCase):
+    def test_export_import(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        filename = os.path.join(tempdir, 'export.ndjson')
+        self.assertEqual(self._manage('export', str(self.environment_id),
+                                      '--output', filename), 0)
+        self.assertEqual(self._manage('import', filename,
+                                      '--chunk-size', '1'), 0)
+        self.stdout.seek(0)
+        self.assertEqual(self.stdout.read(), 'imported environment %d\n' % (
+            self.environment_id + 1,))
+        client = self.app.test_client()
+        res = client.get('/environments/%d/lvl1/1/resources/1/values' % (
+            self.environment_id + 1,))
+        self.assertEqual(json.loads(res.data.decode('utf-8')),
+                         {'a': 1, 'b': 2})
+        self.assertEqual(self._manage('snapshots', 'check'), 0)
+
+    def test_export_not_found(self):
+        stderr = self.useFixture(fixtures.StringStream('stderr')).stream
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', stderr))
+        self.assertEqual(self._manage('export', '42'), 1)
+
+
+class TestGC(_ManageTestCase):
+    def test_gc(self):
+        self.assertEqual(self._manage('gc'), 0)
+        self.app.test_client().delete('/components/1')
+        self.assertEqual(self._manage('gc', '--batch-size', '1'), 0)
+        self.stdout.seek(0)
+        self.assertEqual(self.stdout.read().splitlines(), [
+            'deleted 0 orphaned level values',
+            'deleted 1 orphaned level values',
+        ])
@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from tuning_box import patching
+from tuning_box.tests import base
+
+
+class TestMergePatch(base.TestCase):
+    def test_rfc_example(self):
+        document = {
+            'title': 'Goodbye!',
+            'author': {'givenName': 'John', 'familyName': 'Doe'},
+            'tags': ['example', 'sample'],
+            'content': 'This will be unchanged',
+        }
+        patch = {
+            'title': 'Hello!',
+            'phoneNumber': '+01-123-456-7890',
+            'author': {'familyName': None},
+            'tags': ['example'],
+        }
+        self.assertEqual(patching.merge_patch(document, patch), {
+            'title': 'Hello!',
+            'author': {'givenName': 'John'},
+            'tags': ['example'],
+            'content': 'This will be unchanged',
+            'phoneNumber': '+01-123-456-7890',
+        })
+        self.assertEqual(document['title'], 'Goodbye!')
+
+    def test_non_object_patch(self):
+        self.assertEqual(patching.merge_patch({'a': 1}, ['b']), ['b'])
+
+    def test_non_object_document(self):
+        self.assertEqual(patching.merge_patch(['a'], {'b': 1}), {'b': 1})
+
+
+class TestApplyPatch(base.TestCase):
+    def _apply(self, document, *operations):
+        return patching.apply_patch(document, list(operations))
+
+    def test_add(self):
+        self.assertEqual(
+            self._apply({'a': [1, 2]},
+                        {'op': 'add', 'path': '/a/1', 'value': 'x'},
+                        {'op': 'add', 'path': '/a/-', 'value': 'y'},
+                        {'op': 'add', 'path': '/b', 'value': {}}),
+            {'a': [1, 'x', 2, 'y'], 'b': {}})
+
+    def test_add_root(self):
+        self.assertEqual(self._apply({'a': 1},
+                                     {'op': 'add', 'path': '', 'value': []}),
+                         [])
+
+    def test_remove(self):
+        self.assertEqual(
+            self._apply({'a': [1, 2], 'b': 1},
+                        {'op': 'remove', 'path': '/a/0'},
+                        {'op': 'remove', 'path': '/b'}),
+            {'a': [2]})
+
+    def test_replace(self):
+        self.assertEqual(
+            self._apply({'a': [1, 2]},
+                        {'op': 'replace', 'path': '/a/1', 'value': 3}),
+            {'a': [1, 3]})
+
+    def test_move_copy(self):
+        self.assertEqual(
+            self._apply({'a': {'b': [1]}},
+                        {'op': 'copy', 'from': '/a/b', 'path': '/c'},
+                        {'op': 'move', 'from': '/a/b', 'path': '/d'}),
+            {'a': {}, 'c': [1], 'd': [1]})
+
+    def test_escaped_pointer(self):
+        self.assertEqual(
+            self._apply({'a/b': 1, 'm~n': 2},
+                        {'op': 'replace', 'path': '/a~1b', 'value': 3},
+                        {'op': 'test', 'path': '/m~0n', 'value': 2}),
+            {'a/b': 3, 'm~n': 2})
+
+    def test_test_failed(self):
+        self.assertRaises(patching.PatchConflict, self._apply, {'a': 1},
+                          {'op': 'test', 'path': '/a', 'value': True})
+
+    def test_atomic(self):
+        document = {'a': 1}
+        self.assertRaises(patching.PatchConflict, self._apply, document,
+                          {'op': 'remove', 'path': '/a'},
+                          {'op': 'remove', 'path': '/a'})
+        self.assertEqual(document, {'a': 1})
+
+    def test_conflicts(self):
+        for operation in [
+                {'op': 'remove', 'path': '/x'},
+                {'op': 'replace', 'path': '/x', 'value': 1},
+                {'op': 'add', 'path': '/x/y', 'value': 1},
+                {'op': 'add', 'path': '/a/5', 'value': 1},
+                {'op': 'add', 'path': '/a/01', 'value': 1},
+                {'op': 'move', 'from': '/a', 'path': '/a/0'}]:
+            self.assertRaises(patching.PatchConflict, self._apply,
+                              {'a': [1]}, operation)
+
+    def test_invalid(self):
+        for patch in [{}, ['op'], [{'path': ''}], [{'op': 'add', 'path': ''}],
+                      [{'op': 'add', 'path': 'a', 'value': 1}],
+                      [{'op': 'bad', 'path': ''}]]:
+            self.assertRaises(patching.InvalidPatch, patching.apply_patch,
+                              {}, patch)